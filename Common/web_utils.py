@@ -0,0 +1,372 @@
+# This script contains functions for accessing web APIs shared by Sampling/, Visualizations/ and GRIB/.
+# Add the directory to the path and import it as the other scripts do:
+#
+# sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+# from web_utils import *
+
+
+
+
+import os
+import json
+import time
+import codecs
+import threading
+import requests
+import numpy as np
+
+
+
+
+# Stream historic json LANTMET data from an url into typed columns.
+# The response is decoded one observation at a time while it is downloaded, so the full
+# list of observation dicts is never held in memory. Columns are preallocated from the
+# response size and grown if needed.
+# @params url: url to be accessed.
+#         session: optional, requests.Session to reuse keep-alive connections.
+#         chunk_bytes: optional, number of bytes read from the response at a time.
+#         hourly: optional, if True only observations with timestamps on the form
+#                 'YYYY-MM-DDTHH:00:00+01:00' are kept.
+# @returns dict of columns, None if request failed or data is not a JSON list.
+#          {'time': int64 array of hours since 1970-01-01T00:00 (the time zone is ignored),
+#           'param': int16 array of indices into 'params',
+#           'value': float64 array, NaN for missing values,
+#           'logIntervalId': int32 array,
+#           'params': list of parameter names (elementMeasurementTypeId),
+#           'startTime': timeMeasured of first kept observation,
+#           'endTime': timeMeasured of last kept observation}
+def stream_LANTMET(url, session=None, chunk_bytes=65536, hourly=False):
+
+    try:
+        # Try accessing API.
+        if session is None:
+            r = requests.get(url, stream=True)
+        else:
+            r = session.get(url, stream=True)
+        # Error responses are not decoded, even if the body is JSON.
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # If accessing API fails
+        print('stream_LANTMET() >>> Request failed.\n' + str(e.__str__()))
+        return None
+
+    # Roughly 100 bytes per observation.
+    capacity = max(int(r.headers.get('Content-Length', 0)) // 100, 1024)
+    hours = np.empty(capacity, dtype=np.int64)
+    param = np.empty(capacity, dtype=np.int16)
+    value = np.empty(capacity, dtype=np.float64)
+    log_interval = np.empty(capacity, dtype=np.int32)
+    params = {}
+    hour_cache = {}
+    columns = {'startTime': None, 'endTime': None}
+    n = 0
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    started = False
+    finished = False
+    try:
+        for chunk in r.iter_content(chunk_size=chunk_bytes):
+            buf = buf + text_decoder.decode(chunk)
+            pos = 0
+            while True:
+                # Skip whitespace and separators between observations.
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos = pos + 1
+                if pos == len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError
+                    started = True
+                    pos = pos + 1
+                    continue
+                if buf[pos] == ']':
+                    finished = True
+                    pos = len(buf)
+                    break
+
+                # Decode one observation. If it is incomplete, wait for more data.
+                try:
+                    e, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break
+                pos = end
+
+                ts = e['timeMeasured']
+                if hourly and (len(ts) != 25 or not ts.endswith(':00:00+01:00')):
+                    continue
+                if ts not in hour_cache:
+                    hour_cache[ts] = np.datetime64(ts[:13], 'h').astype(np.int64)
+
+                if n == capacity:
+                    capacity = capacity * 2
+                    hours = np.resize(hours, capacity)
+                    param = np.resize(param, capacity)
+                    value = np.resize(value, capacity)
+                    log_interval = np.resize(log_interval, capacity)
+
+                if e['elementMeasurementTypeId'] not in params:
+                    params[e['elementMeasurementTypeId']] = len(params)
+                hours[n] = hour_cache[ts]
+                param[n] = params[e['elementMeasurementTypeId']]
+                value[n] = np.nan if e['value'] is None else e['value']
+                log_interval[n] = e.get('logIntervalId') or 0
+                if columns['startTime'] is None:
+                    columns['startTime'] = ts
+                columns['endTime'] = ts
+                n = n + 1
+            buf = buf[pos:]
+    except (ValueError, KeyError, TypeError, requests.exceptions.RequestException):
+        print('stream_LANTMET() >>> Data is not a JSON list of observations.')
+        return None
+
+    if not finished:
+        print('stream_LANTMET() >>> Data is not a JSON list of observations.')
+        return None
+
+    columns['time'] = hours[:n].copy()
+    columns['param'] = param[:n].copy()
+    columns['value'] = value[:n].copy()
+    columns['logIntervalId'] = log_interval[:n].copy()
+    columns['params'] = list(params.keys())
+    return columns
+
+
+
+
+# ========== DISK CACHE ==========
+# Downloaded data is kept on disk, so repeated queries are read locally and work offline.
+# Every entry is one file in the cache directory. The modification time of an entry is
+# when it was downloaded and the access time is when it was last used. Data for days
+# older than settle_days never expires, newer data expires after ttl seconds (see max_age).
+# The size of the cache is counted once and then kept up to date as entries are added.
+# Only when it grows larger than max_bytes is the directory listed, and least recently
+# used entries are removed until it is at most low_water*max_bytes.
+#
+# cache = DiskCache('API_CACHE/')
+# filename = cache.get(key, cache.max_age('2020-01-02'))
+# if filename is None:
+#     cache.put(key, save_json, data)
+
+# Disk cache of downloaded data in one directory.
+# @attr directory: directory of entries, ex. 'API_CACHE/'.
+#       max_bytes: size limit in bytes.
+#       ttl: seconds before data of the last settle_days days expires.
+#       settle_days: days before data no longer changes and never expires.
+#       low_water: fraction of max_bytes the cache is reduced to when it is full.
+#       stats: dict with number of hits and misses since created.
+class DiskCache:
+    __slots__ = ['directory', 'max_bytes', 'ttl', 'settle_days', 'low_water', 'stats', '_bytes', '_lock']
+
+    def __init__(self, directory, max_bytes=1024**3, ttl=3600, settle_days=2, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.settle_days = settle_days
+        self.low_water = low_water
+        self.stats = {'hits': 0, 'misses': 0}
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    # Get maximum age of cached data ending at a given day.
+    # @params end_day: last day in data as a string, ex. '2020-01-02'.
+    # @returns maximum age in seconds, None if data never expires.
+    def max_age(self, end_day):
+        if end_day < time.strftime('%Y-%m-%d', time.localtime(time.time() - self.settle_days*86400)):
+            return None
+        return self.ttl
+
+    # Look up an entry. Counts as a hit if the entry exists and is not too old.
+    # @params key: name of entry, ex. 'LANTMET_40010_2020-01-01_2020-03-31.npz'.
+    #         max_age: optional, maximum age in seconds. None if entry never expires.
+    # @returns filename of entry, None if entry is missing or too old.
+    def get(self, key, max_age=None):
+        filename = self.directory + key
+        try:
+            stat = os.stat(filename)
+            hit = max_age is None or time.time() - stat.st_mtime <= max_age
+            if hit:
+                # Mark entry as recently used.
+                os.utime(filename, (time.time(), stat.st_mtime))
+        except OSError:
+            hit = False
+
+        with self._lock:
+            self.stats['hits' if hit else 'misses'] += 1
+        if hit:
+            return filename
+        return None
+
+    # Look up an entry no matter how old it is, ex. to use expired data when offline.
+    # Not counted in stats.
+    # @params key: name of entry.
+    # @returns filename of entry, None if entry is missing.
+    def get_expired(self, key):
+        if os.path.isfile(self.directory + key):
+            return self.directory + key
+        return None
+
+    # Add an entry. The entry is written to a temporary file first,
+    # so an interrupted write never leaves a broken entry.
+    # @params key: name of entry.
+    #         save: function save(data, filename) writing data to a file.
+    #         data: data to be saved.
+    # @returns None.
+    def put(self, key, save, data):
+        filename = self.directory + key
+        tmp_filename = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            save(data, tmp_filename)
+            size = os.path.getsize(tmp_filename)
+            try:
+                old_size = os.path.getsize(filename)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_filename, filename)
+        except OSError:
+            print('DiskCache.put() >>> Could not write ' + filename + '.')
+            return
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes = self._bytes + size - old_size
+            full = self._bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    # Remove least recently used entries until the cache is at most low_water*max_bytes large.
+    # @params max_bytes: optional, size limit in bytes. Default is the limit of the cache.
+    # @returns number of removed entries.
+    def evict(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        target = self.low_water*max_bytes
+
+        with self._lock:
+            entries, total = self._scan()
+            removed = 0
+            if total > max_bytes:
+                for _, size, file in sorted(entries):
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(self.directory + file)
+                    except OSError:
+                        continue
+                    total = total - size
+                    removed = removed + 1
+            self._bytes = total
+        return removed
+
+    # Get cache statistics.
+    # @returns dict with number of hits and misses since created, number of entries and size in bytes.
+    def info(self):
+        with self._lock:
+            entries, total = self._scan()
+            self._bytes = total
+        return {'hits': self.stats['hits'],
+                'misses': self.stats['misses'],
+                'entries': len(entries),
+                'bytes': total}
+
+    # Remove all entries.
+    # @returns None.
+    def clear(self):
+        with self._lock:
+            if os.path.isdir(self.directory):
+                for file in os.listdir(self.directory):
+                    os.remove(self.directory + file)
+            self._bytes = 0
+
+    # List entries. Entries being written are left out.
+    # @returns list of (access time, size, file) and total size in bytes.
+    def _scan(self):
+        entries = []
+        if os.path.isdir(self.directory):
+            for file in os.listdir(self.directory):
+                if file.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(self.directory + file)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, file))
+        return entries, sum([size for _, size, _ in entries])
+
+
+
+
+# ========== SESSIONS ==========
+# requests.Session keeps connections alive between requests to the same host, but is not
+# guaranteed to be thread safe. ThreadSessions gives every thread its own session and
+# closes all of them when done.
+#
+# with ThreadSessions() as sessions:
+#     with ThreadPoolExecutor(max_workers=4) as executor:
+#         executor.map(lambda url: sessions.get().get(url), urls)
+
+# One requests.Session per thread.
+# @attr pool_size: number of connections kept alive per host by every session.
+class ThreadSessions:
+    __slots__ = ['pool_size', '_sessions', '_lock']
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Get the session of the calling thread. Creates it on first use.
+    # @returns requests.Session.
+    def get(self):
+        thread = threading.get_ident()
+        with self._lock:
+            session = self._sessions.get(thread)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[thread] = session
+        return session
+
+    # Close the sessions of all threads. Threads get new sessions if they are used again.
+    # @returns None.
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+
+
+
+# Sessions of single requests made outside a ThreadSessions block.
+SESSIONS = ThreadSessions()
+
+
+
+
+# Get the session of the calling thread from SESSIONS.
+# @returns requests.Session.
+def get_session():
+    return SESSIONS.get()
+
+
+
+
+# Close the sessions in SESSIONS, ex. when a script is done downloading.
+# @returns None.
+def close_sessions():
+    SESSIONS.close()
@@ -0,0 +1,970 @@
+# This script contains functions extracting MESAN data for points from GRIB files
+# without calling grib_filter and grib_get.
+#
+# Every GRIB message is decoded once with ecCodes and values are picked for all
+# points at once. Grid indices of the points are computed once per grid (see
+# spatial_index.py) and reused for every message on the same grid. Parameters are
+# named <shortName>_<levelType> as the files written by grib_filter in Grib2CSV.ipynb.
+#
+# extractor = PointExtractor(points)
+# records = extractor.extract(grib_bytes)
+# frames = records_to_frames(records, points, timestamps)
+# write_point_CSVs(frames, '2020-09-01')
+#
+# Hourly archive files are downloaded by a pool of threads while the main thread
+# decodes and extracts, see download_GRIBs.
+#
+# GRIB_to_CSV keeps an ingestion manifest (see IngestManifest) of downloaded hours
+# and written points, so a rerun only does the work that is missing. It can keep a
+# cropped, compressed archive of the hours (see GRIBCropper) to extract from later.
+#
+# ecCodes (pip install eccodes) is only needed for decoding.
+
+
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+import requests
+import threading
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from spatial_index import *
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from web_utils import *
+
+try:
+    import eccodes
+except ImportError:
+    eccodes = None
+
+
+
+
+ARCHIVE_URL = 'https://opendata-download-grid-archive.smhi.se/data/6/'
+CSV_DIR = 'MESAN_CSV/'
+GRID_DIR = 'GRID_INDEX/'
+RAW_DIR = 'GRIBS/Raw/'
+ARCHIVE_DIR = 'GRIBS/Archive/'
+MANIFEST_FILE = 'manifest.jsonl'
+
+
+
+
+# Check that ecCodes is installed.
+# @params caller: name of calling function, used in message.
+# @returns True if ecCodes can be used.
+def has_eccodes(caller):
+    if eccodes is None:
+        print(caller + '() >>> ecCodes is not installed. Install with: pip install eccodes')
+        return False
+    return True
+
+
+
+
+# Get url of one hour in the MESAN archive.
+# @params dt: datetime object of the hour.
+#         base_url: optional, url of archive. Ex. a local file server when testing.
+# @returns url as a string.
+def archive_url(dt, base_url=ARCHIVE_URL):
+    return base_url + dt.strftime('%Y%m') + '/MESAN_' + dt.strftime('%Y%m%d%H') + '00+000H00M'
+
+
+
+
+# Download one file. Failed requests and server errors are retried with increasing delay.
+# @params url: url of file.
+#         retries: optional, number of attempts.
+#         timeout: optional, seconds to wait for the server.
+#         session: optional, requests.Session to reuse keep-alive connections. Default is the
+#                  session of the calling thread in SESSIONS (see web_utils.py).
+# @returns content as bytes. None if the file could not be downloaded.
+def fetch_GRIB(url, retries=3, timeout=60, session=None):
+    if session is None:
+        session = get_session()
+    for attempt in range(0, retries):
+        if attempt > 0:
+            time.sleep(2**(attempt - 1))
+        try:
+            r = session.get(url, allow_redirects=True, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            print('fetch_GRIB() >>> Request failed.\n' + str(e.__str__()))
+            continue
+        if r.status_code == 200:
+            return r.content
+        print('fetch_GRIB() >>> ' + url + ' returned ' + str(r.status_code) + '.')
+        if r.status_code < 500:
+            return None
+    return None
+
+
+
+
+# Download files concurrently and hand them over in the same order as items.
+# This is a generator: while the caller works on one file, the next ones are downloaded.
+# At most max_pending files are downloading or waiting for the caller at a time, which
+# caps memory use to max_pending files.
+#
+# for url, content in download_GRIBs(urls):
+#     records = extractor.extract(content)
+#
+# Every download thread keeps its own session alive between files. The sessions are closed
+# when the generator is done or closed.
+#
+# @params items: list of urls, or anything fetch accepts.
+#         max_workers: optional, number of simultaneous downloads.
+#         max_pending: optional, number of files downloaded ahead of the caller.
+#         retries: optional, number of attempts per file.
+#         fetch: optional, function getting the content of an item with the requests.Session
+#                of the download thread, fetch(item, session). Default is fetch_GRIB.
+# @returns generator of (item, content). content is None for files that could not be downloaded.
+def download_GRIBs(items, max_workers=4, max_pending=32, retries=3, fetch=None):
+    if fetch is None:
+        def fetch(url, session):
+            return fetch_GRIB(url, retries, session=session)
+
+    max_pending = max(max_pending, max_workers)
+    with ThreadSessions(max_workers) as sessions, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def work(item):
+            return fetch(item, sessions.get())
+
+        pending = deque()
+        items = iter(items)
+        try:
+            for item in items:
+                pending.append((item, executor.submit(work, item)))
+                if len(pending) >= max_pending:
+                    break
+            while pending:
+                item, future = pending.popleft()
+                content = future.result()
+                for next_item in items:
+                    pending.append((next_item, executor.submit(work, next_item)))
+                    break
+                yield item, content
+        finally:
+            # Stop downloads not started if the caller quits early.
+            for item, future in pending:
+                future.cancel()
+
+
+
+
+# Save a downloaded hour as a raw GRIB file. The file is replaced, never appended to.
+# @params filename: name of file.
+#         content: bytes of GRIB file.
+# @returns None.
+def save_raw_GRIB(filename, content):
+    tmp_filename = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+
+
+# Get timestamps of every hour of a day.
+# @params date: date object.
+# @returns list of timestamps, ex. ['2020-09-01T00:00:00Z', ..., '2020-09-01T23:00:00Z']
+def day_timestamps(date):
+    return [date.strftime('%Y-%m-%d') + 'T' + str(h).zfill(2) + ':00:00Z' for h in range(0, 24)]
+
+
+
+
+# Get length of a GRIB message from its indicator section.
+# @params data: bytes with GRIB messages.
+#         offset: position of 'GRIB' at the start of the message.
+# @returns length in bytes. None if it is not given in the indicator section (large GRIB 1 messages).
+def GRIB_message_length(data, offset):
+    edition = data[offset + 7] if offset + 8 <= len(data) else None
+    if edition == 1:
+        length = int.from_bytes(data[offset + 4:offset + 7], 'big')
+        # Messages larger than 8 MB store the length in units of 120 bytes and need ecCodes.
+        return None if length & 0x800000 else length
+    if edition == 2 and offset + 16 <= len(data):
+        return int.from_bytes(data[offset + 8:offset + 16], 'big')
+    return None
+
+
+
+
+# Decode GRIB messages one at a time.
+# The handle is released when the next message is decoded, so use it before continuing.
+# @params data: bytes with one or more GRIB messages, ex. the content of one archive file.
+#         params: optional, list of parameters (<shortName>_<levelType>) to decode. None for all.
+#         caller: optional, name of calling function, used in messages.
+# @returns generator of (gid, parameter, timestamp, values) where gid is the ecCodes handle and
+#          values a float array of all grid cells. Missing values are NaN.
+def decode_GRIB(data, params=None, caller='decode_GRIB'):
+    # Messages are passed to ecCodes as views, slicing bytes would copy the rest of the file for every message.
+    view = memoryview(data)
+    offset = 0
+    while True:
+        offset = data.find(b'GRIB', offset)
+        if offset < 0:
+            break
+        length = GRIB_message_length(data, offset)
+        if length is not None and offset + length > len(data):
+            print(caller + '() >>> Message at byte ' + str(offset) + ' is incomplete.')
+            break
+        gid = None
+        try:
+            gid = eccodes.codes_new_from_message(view[offset:] if length is None else view[offset:offset + length])
+            length = eccodes.codes_get(gid, 'totalLength')
+            if offset + length > len(data):
+                print(caller + '() >>> Message at byte ' + str(offset) + ' is incomplete.')
+                break
+            key = eccodes.codes_get(gid, 'shortName') + '_' + eccodes.codes_get(gid, 'levelType')
+            if params is None or key in params:
+                date = str(eccodes.codes_get(gid, 'validityDate'))
+                hour = str(eccodes.codes_get(gid, 'validityTime')).zfill(4)[:2]
+                timestamp = date[0:4] + '-' + date[4:6] + '-' + date[6:8] + 'T' + hour + ':00:00Z'
+
+                values = eccodes.codes_get_values(gid)
+                if eccodes.codes_get(gid, 'bitmapPresent'):
+                    values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+                yield gid, key, timestamp, values
+        except eccodes.CodesInternalError as e:
+            print(caller + '() >>> Could not decode message at byte ' + str(offset) + '.\n' + str(e))
+            break
+        finally:
+            if gid is not None:
+                eccodes.codes_release(gid)
+        offset = offset + length
+
+
+
+
+# Get spatial index of the grid of a message. The index is saved as grid_<md5>.npz
+# and shared by all messages on the same grid.
+# @params gid: ecCodes handle.
+#         grid_dir: directory where grid indices are saved. None to not save.
+# @returns index: GridIndex.
+#          lats: latitudes of all grid cells.
+#          lons: longitudes of all grid cells.
+def grid_index(gid, grid_dir=GRID_DIR):
+    lats = eccodes.codes_get_array(gid, 'latitudes')
+    lons = eccodes.codes_get_array(gid, 'longitudes')
+    filename = None
+    if grid_dir is not None:
+        os.makedirs(grid_dir, exist_ok=True)
+        filename = grid_dir + 'grid_' + eccodes.codes_get(gid, 'md5GridSection') + '.npz'
+    return load_grid_index(lats, lons, filename), lats, lons
+
+
+
+
+# Point extraction from GRIB messages.
+# @attr points: list of dicts with station id, lat and lon.
+#               example: {'id': '149', 'lat': 65.59405, 'lon': 19.26423}
+#       params: list of parameters (<shortName>_<levelType>) to extract. None for all.
+#       grid_dir: directory where grid indices are saved. None to not save.
+#       cells: dict with grid cell of every point for every grid (by md5 of grid section)
+#              and every cropped grid (see GRIBCropper).
+class PointExtractor:
+    __slots__ = ['points', 'params', 'grid_dir', 'cells']
+
+    def __init__(self, points, params=None, grid_dir=GRID_DIR):
+        self.points = points
+        self.params = params
+        self.grid_dir = grid_dir
+        self.cells = {}
+
+    # Extract values for all points from GRIB messages.
+    # @params data: bytes with one or more GRIB messages, ex. the content of one archive file.
+    # @returns list of (timestamp, parameter, values) where values is a float array with one
+    #          value per point. Missing values are NaN.
+    def extract(self, data):
+        if not has_eccodes('PointExtractor.extract'):
+            return []
+
+        records = []
+        for gid, key, timestamp, values in decode_GRIB(data, self.params, 'PointExtractor.extract'):
+            records.append((timestamp, key, values[self._cells(gid)]))
+        return records
+
+    # Extract values for all points from a cropped hour, see GRIBCropper.
+    # Points whose nearest grid cell may be outside the crop get NaN.
+    # @params cropped: dict as returned from GRIBCropper.crop or load_cropped_GRIB.
+    # @returns list of (timestamp, parameter, values), same as extract.
+    def extract_cropped(self, cropped):
+        crop = cropped['grid'] + '_' + hashlib.sha1(cropped['cells'].tobytes()).hexdigest()
+        if crop not in self.cells:
+            index = GridIndex.build(cropped['lats'], cropped['lons'])
+            cells = index.nearest([p['lat'] for p in self.points], [p['lon'] for p in self.points])[0]
+            cells[~cropped['interior'][cells]] = -1
+            if (cells < 0).any():
+                print('PointExtractor.extract_cropped() >>> Points ' + ', '.join([p['id'] for p, c in zip(self.points, cells) if c < 0]) +
+                      ' are outside the cropped grid.')
+            self.cells[crop] = cells
+
+        cells = self.cells[crop]
+        records = []
+        for k, key in enumerate(cropped['params']):
+            if self.params is None or key in self.params:
+                values = np.where(cells >= 0, cropped['values'][k][cells], np.nan)
+                records.append((cropped['timestamp'], key, values))
+        return records
+
+    # Get grid cell of every point on the grid of a message.
+    # @params gid: ecCodes handle.
+    # @returns int array of flat grid indices.
+    def _cells(self, gid):
+        grid = eccodes.codes_get(gid, 'md5GridSection')
+        if grid not in self.cells:
+            index = grid_index(gid, self.grid_dir)[0]
+            self.cells[grid] = index.nearest([p['lat'] for p in self.points], [p['lon'] for p in self.points])[0]
+        return self.cells[grid]
+
+
+
+
+# Cropping of GRIB files for a local archive.
+# Only grid cells within a bounding box, or within margin cells of registered points, and
+# only selected parameters are kept. Values are stored as float32 in compressed .npz files
+# (see save_cropped_GRIB), a small part of the full MESAN domain.
+#
+# A grid cell is interior if all its neighbours are kept (or outside the grid). Points are only
+# extracted from a cropped grid if their nearest cell is interior, since the nearest cell of
+# other points may have been cropped away.
+#
+# cropper = GRIBCropper(points=points, params=['t_105', 'r_105', 'prec1h_sfc'])
+# save_cropped_GRIB('MESAN_2020090100.npz', cropper.crop(grib_bytes))
+#
+# At least one of bbox and points must be given, otherwise no grid cell would be kept.
+#
+# @attr bbox: (lat_min, lat_max, lon_min, lon_max) of grid cells kept, or None.
+#       points: list of dicts with station id, lat and lon, or None.
+#       margin: number of grid cells kept around the nearest cell of every point.
+#       params: list of parameters (<shortName>_<levelType>) to keep. None for all.
+#       grid_dir: directory where grid indices are saved. None to not save.
+#       grids: dict with kept cells of every grid (by md5 of grid section).
+class GRIBCropper:
+    __slots__ = ['bbox', 'points', 'margin', 'params', 'grid_dir', 'grids']
+
+    def __init__(self, bbox=None, points=None, margin=2, params=None, grid_dir=GRID_DIR):
+        if bbox is None and not points:
+            raise ValueError('GRIBCropper() >>> A bounding box or points are needed to know which grid cells to keep.')
+        self.bbox = bbox
+        self.points = points
+        self.margin = margin
+        self.params = params
+        self.grid_dir = grid_dir
+        self.grids = {}
+
+    # Check if all parameters to extract are kept.
+    # @params params: list of parameters (<shortName>_<levelType>), None for all.
+    # @returns True if every parameter is kept.
+    def keeps(self, params):
+        return self.params is None or (params is not None and set(params) <= set(self.params))
+
+    # Crop the messages of one hour.
+    # @params data: bytes with the GRIB messages of one hour.
+    # @returns dict with timestamp, params, values (float32 array (params, cells)), grid (md5 of
+    #          grid section), shape (of grid), cells (flat grid indices), lats, lons and interior.
+    #          None if no message was decoded.
+    def crop(self, data):
+        if not has_eccodes('GRIBCropper.crop'):
+            return None
+
+        cropped = None
+        for gid, key, timestamp, values in decode_GRIB(data, self.params, 'GRIBCropper.crop'):
+            grid = eccodes.codes_get(gid, 'md5GridSection')
+            if cropped is None:
+                cropped = dict(self._grid(gid, grid), timestamp=timestamp, grid=grid, params=[], values=[])
+            elif grid != cropped['grid']:
+                print('GRIBCropper.crop() >>> ' + key + ' is on another grid. Skipping.')
+                continue
+            cropped['params'].append(key)
+            cropped['values'].append(values[cropped['cells']].astype(np.float32))
+
+        if cropped is not None:
+            cropped['values'] = np.array(cropped['values'], dtype=np.float32).reshape(len(cropped['params']), len(cropped['cells']))
+        return cropped
+
+    # Get kept grid cells of the grid of a message.
+    # @params gid: ecCodes handle.
+    #         grid: md5 of grid section.
+    # @returns dict with shape, cells, lats, lons and interior.
+    def _grid(self, gid, grid):
+        if grid not in self.grids:
+            index, lats, lons = grid_index(gid, self.grid_dir)
+            shape = (eccodes.codes_get(gid, 'Nj'), eccodes.codes_get(gid, 'Ni'))
+            keep = np.zeros(shape, dtype=np.bool_)
+            if self.bbox is not None:
+                lat_min, lat_max, lon_min, lon_max = self.bbox
+                keep |= ((lats >= lat_min) & (lats <= lat_max) & (lons >= lon_min) & (lons <= lon_max)).reshape(shape)
+            if self.points:
+                cells = index.nearest([p['lat'] for p in self.points], [p['lon'] for p in self.points])[0]
+                for j, i in zip(*np.unravel_index(cells, shape)):
+                    keep[max(j - self.margin, 0):j + self.margin + 1, max(i - self.margin, 0):i + self.margin + 1] = True
+
+            # Cells outside the grid count as kept.
+            padded = np.pad(keep, 1, constant_values=True)
+            interior = np.ones(shape, dtype=np.bool_)
+            for dj in (0, 1, 2):
+                for di in (0, 1, 2):
+                    interior &= padded[dj:dj + shape[0], di:di + shape[1]]
+
+            cells = np.flatnonzero(keep)
+            self.grids[grid] = {'shape': shape, 'cells': cells, 'lats': lats[cells], 'lons': lons[cells],
+                                'interior': interior.ravel()[cells]}
+        return self.grids[grid]
+
+
+
+
+# Save a cropped hour as a compressed .npz file.
+# @params filename: name of file, ex. 'GRIBS/Archive/MESAN_2020090100.npz'.
+#         cropped: dict as returned from GRIBCropper.crop.
+# @returns None.
+def save_cropped_GRIB(filename, cropped):
+    tmp_filename = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez_compressed(f, timestamp=np.array(cropped['timestamp']), grid=np.array(cropped['grid']),
+                            params=np.array(cropped['params']), values=cropped['values'],
+                            shape=np.array(cropped['shape']), cells=cropped['cells'],
+                            lats=cropped['lats'], lons=cropped['lons'], interior=cropped['interior'])
+    os.replace(tmp_filename, filename)
+
+
+
+
+# Load a cropped hour saved with save_cropped_GRIB.
+# @params filename: name of file.
+# @returns dict, same as GRIBCropper.crop. None if the file can not be read.
+def load_cropped_GRIB(filename):
+    try:
+        with np.load(filename) as f:
+            return {'timestamp': str(f['timestamp']), 'grid': str(f['grid']), 'params': f['params'].tolist(),
+                    'values': f['values'], 'shape': tuple(f['shape'].tolist()), 'cells': f['cells'],
+                    'lats': f['lats'], 'lons': f['lons'], 'interior': f['interior']}
+    except (OSError, ValueError, KeyError) as e:
+        print('load_cropped_GRIB() >>> Could not read ' + filename + '.\n' + str(e))
+        return None
+
+
+
+
+# Get name of the archive file of an hour.
+# @params archive_dir: directory of cropped archive.
+#         timestamp: timestamp of hour, ex. '2020-09-01T00:00:00Z'.
+# @returns name of file, ex. 'GRIBS/Archive/MESAN_2020090100.npz'.
+def archive_file(archive_dir, timestamp):
+    return archive_dir + 'MESAN_' + timestamp[0:4] + timestamp[5:7] + timestamp[8:10] + timestamp[11:13] + '.npz'
+
+
+
+
+# Collect extracted records into one dataframe per point.
+# @params records: list of (timestamp, parameter, values) as returned from PointExtractor.extract.
+#         points: list of dicts with station id, lat and lon, same as given to PointExtractor.
+#         timestamps: list of timestamps, one row each. Default is timestamps in records.
+# @returns dict with one dataframe per point id. Columns Timestamp and one column per parameter
+#          in order of first appearance.
+def records_to_frames(records, points, timestamps=None):
+    if timestamps is None:
+        timestamps = sorted(set([timestamp for timestamp, _, _ in records]))
+    row = {timestamp: i for i, timestamp in enumerate(timestamps)}
+
+    params = {}
+    for _, key, _ in records:
+        params.setdefault(key, len(params))
+    table = np.full((len(points), len(timestamps), len(params)), np.nan)
+    for timestamp, key, values in records:
+        if timestamp in row:
+            table[:, row[timestamp], params[key]] = values
+
+    frames = {}
+    for i, point in enumerate(points):
+        df = pd.DataFrame(table[i], columns=list(params))
+        df.insert(0, 'Timestamp', timestamps)
+        frames[point['id']] = df
+    return frames
+
+
+
+
+# Save one day of extracted data as MESAN_<date>.csv in the folder of each point.
+# Every file is written to a temporary file first and renamed when complete.
+# @params frames: dict with one dataframe per point id, as returned from records_to_frames.
+#         date_str: date as a string, ex. '2020-09-01'.
+#         csv_dir: optional, directory with one folder per point.
+#         merge: optional, if True rows are added to existing files. Rows with the same
+#                timestamp are replaced.
+# @returns list of written files.
+def write_point_CSVs(frames, date_str, csv_dir=CSV_DIR, merge=False):
+    written = []
+    for point_id in frames:
+        os.makedirs(csv_dir + point_id + '/', exist_ok=True)
+        filename = csv_dir + point_id + '/' + 'MESAN_' + date_str + '.csv'
+        df = frames[point_id]
+        if merge and os.path.isfile(filename):
+            df = pd.concat([pd.read_csv(filename), df], ignore_index=True)
+            df = df.drop_duplicates('Timestamp', keep='last').sort_values('Timestamp')
+        df.to_csv(filename + '.tmp', index=False)
+        os.replace(filename + '.tmp', filename)
+        written.append(filename)
+    return written
+
+
+
+
+# Ingestion manifest of GRIB_to_CSV.
+# Every downloaded hour is recorded with status ('ok' or 'failed'), size and sha1 checksum
+# (or number of failed attempts), and every day with the points written for it. Entries are
+# kept in dicts and sets, so every lookup is O(1).
+#
+# The manifest file is a journal with one JSON object per line. Changes are appended,
+# so saving does not rewrite the file, and a line cut off by an interrupted run is ignored.
+# compact rewrites the file with one line per hour and day.
+#
+# @attr filename: name of manifest file. None for a manifest only kept in memory.
+#       hours: dict with entry for every attempted hour, by timestamp.
+#              example: {'status': 'ok', 'bytes': 10443120, 'sha1': '2fd4e1c6...'}
+#                       {'status': 'failed', 'attempts': 2}
+#                       {'status': 'ok', 'source': 'csv'} for hours seeded from CSV files, see seed.
+#       points: dict with set of written point ids, by date.
+#       pending: list of lines not yet written to file.
+class IngestManifest:
+    __slots__ = ['filename', 'hours', 'points', 'pending']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hours = {}
+        self.points = {}
+        self.pending = []
+
+    # Load manifest from file. An empty manifest is returned if the file does not exist.
+    # @params filename: name of manifest file.
+    # @returns IngestManifest.
+    @classmethod
+    def load(cls, filename):
+        manifest = cls(filename)
+        if not os.path.isfile(filename):
+            return manifest
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    manifest._read(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return manifest
+
+    # Update hours and points with a journal line.
+    # @params entry: dict of journal line.
+    # @returns None.
+    def _read(self, entry):
+        if 'hour' in entry:
+            self.hours[entry['hour']] = {k: entry[k] for k in entry if k != 'hour'}
+        elif 'day' in entry:
+            self.points.setdefault(entry['day'], set()).update(entry['points'])
+
+    # Add changes recorded in another manifest, ex. by a worker process.
+    # @params entries: list of journal lines, the pending attribute of the other manifest.
+    # @returns None.
+    def apply(self, entries):
+        for entry in entries:
+            self._read(entry)
+            self.pending.append(entry)
+
+    # Check if an hour has been downloaded.
+    # @params timestamp: timestamp of hour, ex. '2020-09-01T00:00:00Z'.
+    # @returns True if the hour was downloaded.
+    def hour_ok(self, timestamp):
+        entry = self.hours.get(timestamp)
+        return entry is not None and entry['status'] == 'ok'
+
+    # Check if an hour has failed too many times to be retried.
+    # @params timestamp: timestamp of hour.
+    #         max_attempts: number of failed attempts before giving up. None to always retry.
+    # @returns True if the hour should not be downloaded again.
+    def given_up(self, timestamp, max_attempts):
+        entry = self.hours.get(timestamp)
+        return (max_attempts is not None and entry is not None and entry['status'] == 'failed' and
+                entry['attempts'] >= max_attempts)
+
+    # Record result of downloading an hour.
+    # @params timestamp: timestamp of hour.
+    #         content: bytes of file, None if download failed.
+    # @returns None.
+    def record_hour(self, timestamp, content):
+        if content is None:
+            entry = {'status': 'failed', 'attempts': self.hours.get(timestamp, {}).get('attempts', 0) + 1}
+        else:
+            entry = {'status': 'ok', 'bytes': len(content), 'sha1': hashlib.sha1(content).hexdigest()}
+        self.hours[timestamp] = entry
+        self.pending.append(dict(entry, hour=timestamp))
+
+    # Get points written for a day.
+    # @params date_str: date as a string, ex. '2020-09-01'.
+    # @returns set of point ids.
+    def day_points(self, date_str):
+        return self.points.get(date_str, set())
+
+    # Record points written for a day.
+    # @params date_str: date as a string.
+    #         point_ids: list of point ids.
+    # @returns None.
+    def record_points(self, date_str, point_ids):
+        if point_ids:
+            self.points.setdefault(date_str, set()).update(point_ids)
+            self.pending.append({'day': date_str, 'points': list(point_ids)})
+
+    # Record the CSV files of points written without a manifest, ex. by Grib2CSV.ipynb or before
+    # the manifest file was removed. A point is written for every day it has a file. An hour counts
+    # as downloaded if it has a row in the files of all those points, other hours are retried.
+    # Nothing is known about the downloaded files, so kept raw files of seeded hours are not used.
+    # @params csv_dir: directory with one folder per point.
+    #         point_ids: list of point ids.
+    # @returns number of days seeded.
+    def seed(self, csv_dir, point_ids):
+        days = {}
+        for point_id in point_ids:
+            folder = csv_dir + point_id + '/'
+            if not os.path.isdir(folder):
+                continue
+            for file in os.listdir(folder):
+                if not (file.startswith('MESAN_') and file.endswith('.csv')):
+                    continue
+                date_str = file[len('MESAN_'):-len('.csv')]
+                try:
+                    timestamps = pd.read_csv(folder + file, usecols=['Timestamp'])['Timestamp']
+                except ValueError:
+                    print('IngestManifest.seed() >>> Could not read ' + folder + file + '.')
+                    continue
+                timestamps = set([timestamp for timestamp in timestamps if str(timestamp).startswith(date_str)])
+                if date_str in days:
+                    days[date_str]['points'].append(point_id)
+                    days[date_str]['hours'] &= timestamps
+                else:
+                    days[date_str] = {'points': [point_id], 'hours': timestamps}
+
+        for date_str in sorted(days):
+            for timestamp in sorted(days[date_str]['hours']):
+                if timestamp not in self.hours:
+                    self.hours[timestamp] = {'status': 'ok', 'source': 'csv'}
+                    self.pending.append(dict(self.hours[timestamp], hour=timestamp))
+            self.record_points(date_str, days[date_str]['points'])
+        return len(days)
+
+    # Append recorded changes to file. Nothing is written if the manifest has no file.
+    # @returns None.
+    def save(self):
+        if not self.pending or self.filename is None:
+            return
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + '\n')
+        self.pending = []
+
+    # Rewrite file with one line per hour and day.
+    # @returns None.
+    def compact(self):
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+            for timestamp in sorted(self.hours):
+                f.write(json.dumps(dict(self.hours[timestamp], hour=timestamp)) + '\n')
+            for date_str in sorted(self.points):
+                f.write(json.dumps({'day': date_str, 'points': sorted(self.points[date_str])}) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
+        self.pending = []
+
+
+
+
+# Download MESAN GRIB data for a list of points and save as one CSV file per point and day,
+# same as GRIB_to_CSV in Grib2CSV.ipynb but without temporary GRIB and tabular files.
+# All hours of all days are downloaded through one pipeline, so the next day is downloaded
+# while a day is extracted.
+#
+# Work done is recorded in a manifest (see IngestManifest), so a rerun only does what is
+# missing: days are skipped if all points are written and all hours were downloaded,
+# points not written for a day get files from all hours, and hours that failed are
+# retried and added to the files already written. If raw_dir is given, every downloaded
+# hour is kept as one raw GRIB file and reused instead of downloaded again. Hours that
+# failed max_attempts times are not retried. If the manifest file is missing, it is seeded
+# from the CSV files already in csv_dir (see IngestManifest.seed).
+#
+# If archive is given, every downloaded hour is also cropped and kept in archive_dir
+# (see GRIBCropper). If the archive keeps all params, days with every hour archived are
+# read from the archive instead of downloaded, ex. for new points. Values of those days are
+# float32. A day is never read partly from the archive, so all its values have the same precision.
+# To extract only from the archive, see archive_to_CSV.
+#
+# With processes > 1, days are spread over a pool of processes. Every day is processed
+# in memory by one process, with its own downloads, and written the same way as in
+# serial mode, so the files are the same. Only the main process writes the manifest.
+# At most processes*max_workers files are downloaded at the same time.
+#
+# points = [{'id': '149', 'lat': 65.59405, 'lon': 19.26423}, {'id': '171', 'lat': 65.81389, 'lon': 21.63525}]
+# GRIB_to_CSV(points, datetime.date(2020, 9, 1), datetime.date(2020, 9, 7))
+#
+# @params points: list of dicts with station id, lat and lon.
+#                 example: {'id': '149', 'lat': 65.59405, 'lon': 19.26423}
+#         start_date: date object. fetched data will include start_date.
+#         end_date: date object. fetched data will include end_date.
+#         params: optional, list of parameters (<shortName>_<levelType>) to extract. Default is all.
+#         csv_dir: optional, directory with one folder per point.
+#         max_workers: optional, number of simultaneous downloads (per process).
+#         max_pending: optional, number of hourly files downloaded ahead of extraction (per process).
+#         base_url: optional, url of archive.
+#         raw_dir: optional, directory to keep raw hourly GRIB files in, ex. RAW_DIR. Default is to not keep them.
+#         manifest_file: optional, name of manifest file. Default is MANIFEST_FILE in csv_dir.
+#         processes: optional, number of processes days are spread over.
+#         archive: optional, GRIBCropper used to keep a cropped archive. Default is no archive.
+#         archive_dir: optional, directory of cropped archive.
+#         max_attempts: optional, number of failed downloads of an hour before it is no longer retried.
+#                       None to always retry.
+# @returns list of written files.
+def GRIB_to_CSV(points, start_date, end_date, params=None, csv_dir=CSV_DIR,
+                max_workers=4, max_pending=32, base_url=ARCHIVE_URL, raw_dir=None, manifest_file=None,
+                processes=1, archive=None, archive_dir=ARCHIVE_DIR, max_attempts=5):
+    if not has_eccodes('GRIB_to_CSV'):
+        return []
+    if manifest_file is None:
+        manifest_file = csv_dir + MANIFEST_FILE
+    manifest = IngestManifest.load(manifest_file)
+    if not os.path.isfile(manifest_file):
+        seeded = manifest.seed(csv_dir, [point['id'] for point in points])
+        if seeded > 0:
+            print('GRIB_to_CSV() >>> No manifest found. Recorded existing .csv files of ' + str(seeded) + ' days.')
+            manifest.save()
+    if raw_dir is not None:
+        os.makedirs(raw_dir, exist_ok=True)
+    if archive is not None:
+        os.makedirs(archive_dir, exist_ok=True)
+    sources = {'base_url': base_url, 'raw_dir': raw_dir, 'archive': archive, 'archive_dir': archive_dir}
+
+    # Plan work of every day: points to write and hours to fetch.
+    plans = {}
+    current_date = start_date
+    for n in range(0, (end_date - start_date + datetime.timedelta(days=1)).days):
+        date_str = current_date.strftime('%Y-%m-%d')
+        done = manifest.day_points(date_str)
+        new_points = [point['id'] for point in points if point['id'] not in done]
+        hours = [timestamp for timestamp in day_timestamps(current_date) if not manifest.given_up(timestamp, max_attempts)]
+        retry = [timestamp for timestamp in hours if not manifest.hour_ok(timestamp)]
+        if len(hours) < 24:
+            print('GRIB_to_CSV() >>> ' + str(24 - len(hours)) + ' hours of ' + date_str + ' failed ' + str(max_attempts) +
+                  ' times and are not retried.')
+        if new_points and hours:
+            plans[date_str] = {'new_points': new_points, 'retry': set(retry), 'hours': hours}
+        elif retry:
+            plans[date_str] = {'new_points': new_points, 'retry': set(retry), 'hours': retry}
+        elif not new_points:
+            print('GRIB_to_CSV() >>> .csv files already written for all stations for ' + date_str + '.')
+        else:
+            # Every hour is given up, so there is nothing to write for the new points.
+            print('GRIB_to_CSV() >>> No hours of ' + date_str + ' can be downloaded. No .csv files written for points ' +
+                  ', '.join(new_points) + '.')
+        current_date = current_date + datetime.timedelta(days=1)
+
+    written = []
+    if processes <= 1:
+        written = _ingest(plans, points, params, csv_dir, sources, manifest, max_workers, max_pending)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = []
+            for date_str in plans:
+                hours = {timestamp: manifest.hours[timestamp] for timestamp in plans[date_str]['hours'] if timestamp in manifest.hours}
+                futures.append(executor.submit(_ingest_day, date_str, plans[date_str], points, params, csv_dir,
+                                               sources, hours, max_workers, max_pending))
+            for future in as_completed(futures):
+                day_written, entries = future.result()
+                written.extend(day_written)
+                manifest.apply(entries)
+                manifest.save()
+        written.sort()
+    manifest.compact()
+
+    return written
+
+
+
+
+# Download, extract and write the planned days.
+# @params plans: dict with 'new_points', 'retry' and 'hours' of every day, in date order.
+#         points: list of dicts with station id, lat and lon.
+#         params: list of parameters to extract, None for all.
+#         csv_dir: directory with one folder per point.
+#         sources: dict with base_url, raw_dir, archive and archive_dir, see GRIB_to_CSV.
+#         manifest: IngestManifest. Downloaded hours and written points are recorded.
+#         max_workers: number of simultaneous downloads.
+#         max_pending: number of hourly files downloaded ahead of extraction.
+# @returns list of written files.
+def _ingest(plans, points, params, csv_dir, sources, manifest, max_workers, max_pending):
+    raw_dir = sources['raw_dir']
+    archive = sources['archive']
+
+    # Days read from the archive. Every hour of them must be archived.
+    archive_days = set()
+    if archive is not None and archive.keeps(params):
+        for date_str in plans:
+            if all([manifest.hour_ok(timestamp) and os.path.isfile(archive_file(sources['archive_dir'], timestamp))
+                    for timestamp in plans[date_str]['hours']]):
+                archive_days.add(date_str)
+
+    # Get hour from cropped archive or raw file if it was kept and is unchanged, otherwise download it.
+    def load_hour(timestamp, session):
+        if timestamp[:10] in archive_days:
+            cropped = load_cropped_GRIB(archive_file(sources['archive_dir'], timestamp))
+            if cropped is not None:
+                return cropped
+        dt = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+        raw_file = None
+        if raw_dir is not None:
+            raw_file = raw_dir + 'MESAN_' + dt.strftime('%Y%m%d%H') + '.grib'
+            entry = manifest.hours.get(timestamp)
+            if entry is not None and 'sha1' in entry and os.path.isfile(raw_file):
+                with open(raw_file, 'rb') as f:
+                    content = f.read()
+                if hashlib.sha1(content).hexdigest() == entry['sha1']:
+                    return content
+                print('GRIB_to_CSV() >>> ' + raw_file + ' does not match manifest. Downloading again.')
+        content = fetch_GRIB(archive_url(dt, sources['base_url']), session=session)
+        if content is not None and raw_file is not None:
+            save_raw_GRIB(raw_file, content)
+        return content
+
+    hours = [timestamp for date_str in plans for timestamp in plans[date_str]['hours']]
+    extractor = PointExtractor(points, params)
+    written = []
+    day = {'date': None, 'timestamps': [], 'records': []}
+    for timestamp, content in download_GRIBs(hours, max_workers, max_pending, fetch=load_hour):
+        date_str = timestamp[:10]
+        if date_str != day['date']:
+            written.extend(_write_day(day, plans, points, csv_dir, manifest))
+            day = {'date': date_str, 'timestamps': [], 'records': []}
+
+        if isinstance(content, dict):
+            day['timestamps'].append(timestamp)
+            day['records'].extend(extractor.extract_cropped(content))
+            continue
+
+        manifest.record_hour(timestamp, content)
+        # Only hours which could be fetched get a row.
+        if content is None:
+            continue
+        day['timestamps'].append(timestamp)
+
+        # Cropped here rather than in the download threads, so ecCodes is used by one thread.
+        cropped = None
+        if archive is not None:
+            cropped = archive.crop(content)
+            if cropped is not None:
+                save_cropped_GRIB(archive_file(sources['archive_dir'], timestamp), cropped)
+
+        # An hour of an archived day which could not be read from the archive is extracted
+        # from the cropped hour, so the day keeps the precision of the archive.
+        if date_str in archive_days and cropped is not None:
+            day['records'].extend(extractor.extract_cropped(cropped))
+        else:
+            day['records'].extend(extractor.extract(content))
+    written.extend(_write_day(day, plans, points, csv_dir, manifest))
+
+    return written
+
+
+
+
+# Process one day in a worker process. Changes are recorded in a manifest kept in memory
+# and returned, so only the main process writes the manifest file.
+# @params date_str: date as a string, ex. '2020-09-01'.
+#         plan: dict with 'new_points', 'retry' and 'hours' of the day.
+#         hours: dict with manifest entries of the hours of the day.
+#         See _ingest for other parameters.
+# @returns written: list of written files.
+#          entries: list of manifest journal lines.
+def _ingest_day(date_str, plan, points, params, csv_dir, sources, hours, max_workers, max_pending):
+    manifest = IngestManifest(None)
+    manifest.hours = hours
+    written = _ingest({date_str: plan}, points, params, csv_dir, sources, manifest, max_workers, max_pending)
+    return written, manifest.pending
+
+
+
+
+# Extract points from the cropped archive and save as one CSV file per point and day.
+# Nothing is downloaded, so new points or parameters kept in the archive are extracted from
+# a small part of the MESAN domain. Existing files are replaced. Hours not in the archive
+# get no row and days without archived hours are skipped.
+#
+# archive_to_CSV(points, datetime.date(2020, 9, 1), datetime.date(2020, 9, 7))
+#
+# @params points: list of dicts with station id, lat and lon.
+#         start_date: date object. data will include start_date.
+#         end_date: date object. data will include end_date.
+#         params: optional, list of parameters (<shortName>_<levelType>) to extract. Default is all archived.
+#         archive_dir: optional, directory of cropped archive.
+#         csv_dir: optional, directory with one folder per point.
+# @returns list of written files.
+def archive_to_CSV(points, start_date, end_date, params=None, archive_dir=ARCHIVE_DIR, csv_dir=CSV_DIR):
+    extractor = PointExtractor(points, params)
+    written = []
+    current_date = start_date
+    for n in range(0, (end_date - start_date + datetime.timedelta(days=1)).days):
+        date_str = current_date.strftime('%Y-%m-%d')
+        timestamps = []
+        records = []
+        for timestamp in day_timestamps(current_date):
+            if not os.path.isfile(archive_file(archive_dir, timestamp)):
+                continue
+            cropped = load_cropped_GRIB(archive_file(archive_dir, timestamp))
+            if cropped is not None:
+                timestamps.append(timestamp)
+                records.extend(extractor.extract_cropped(cropped))
+
+        if timestamps:
+            print('archive_to_CSV() >>> Saving MESAN_' + date_str + '.csv for ' + str(len(points)) + ' points.')
+            written.extend(write_point_CSVs(records_to_frames(records, points, timestamps), date_str, csv_dir))
+        else:
+            print('archive_to_CSV() >>> No archived hours for ' + date_str + '.')
+        current_date = current_date + datetime.timedelta(days=1)
+
+    return written
+
+
+
+
+# Save the extracted hours of one day and record it in the manifest.
+# New points get all hours, points already written get the retried hours added.
+# @params day: dict with 'date', 'timestamps' and 'records' of the day.
+#         plans: dict with 'new_points', 'retry' and 'hours' of every day.
+#         points: list of dicts with station id, lat and lon.
+#         csv_dir: directory with one folder per point.
+#         manifest: IngestManifest.
+# @returns list of written files.
+def _write_day(day, plans, points, csv_dir, manifest):
+    if day['date'] is None:
+        return []
+    plan = plans[day['date']]
+    frames = records_to_frames(day['records'], points, day['timestamps'])
+
+    written = []
+    if plan['new_points']:
+        print('GRIB_to_CSV() >>> Saving MESAN_' + day['date'] + '.csv for ' + str(len(plan['new_points'])) + ' points.')
+        written.extend(write_point_CSVs({i: frames[i] for i in plan['new_points']}, day['date'], csv_dir))
+
+    # Rows of retried hours which are now downloaded.
+    old_points = [point['id'] for point in points if point['id'] not in plan['new_points']]
+    retried = [timestamp for timestamp in day['timestamps'] if timestamp in plan['retry']]
+    if old_points and retried:
+        print('GRIB_to_CSV() >>> Adding ' + str(len(retried)) + ' hours to MESAN_' + day['date'] + '.csv for ' + str(len(old_points)) + ' points.')
+        rows = {i: frames[i][frames[i]['Timestamp'].isin(retried)] for i in old_points}
+        written.extend(write_point_CSVs(rows, day['date'], csv_dir, merge=True))
+
+    manifest.record_points(day['date'], plan['new_points'])
+    manifest.save()
+    return written
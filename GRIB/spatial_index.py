@@ -0,0 +1,280 @@
+# This script contains a spatial index for finding the nearest MESAN grid cell of
+# a point and the nearest LantMet stations.
+#
+# Points are placed on the unit sphere as (x, y, z) and grid cells are put into
+# cubic buckets of size cell_km. The nearest grid cell of a point is searched for
+# in the 27 buckets around it, so a query only looks at a few hundred cells instead
+# of the whole grid. Queries are answered for many points at once with array
+# operations. The index is saved to disk and reused as long as the grid is the same.
+#
+# index = load_grid_index(lats, lons)          # lats, lons of every grid cell
+# cells, km = index.nearest([55.67], [13.10])  # flat index into the grid and distance
+# i, j = np.unravel_index(cells, index.shape)
+
+
+
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+
+
+EARTH_RADIUS = 6371.0
+GRID_INDEX_FILE = 'grid_index.npz'
+
+# Number of points compared at a time. Limits memory use of large queries.
+QUERY_CHUNK = 4096
+
+
+
+
+# Convert coordinates to points on the unit sphere.
+# @params lats: latitudes in degrees.
+#         lons: longitudes in degrees.
+# @returns float array (points, 3).
+def to_xyz(lats, lons):
+    lat = np.radians(np.asarray(lats, dtype=np.float64).ravel())
+    lon = np.radians(np.asarray(lons, dtype=np.float64).ravel())
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=1)
+
+
+
+
+# Convert straight line distance between points on the unit sphere to km along the surface.
+# @params chord: array of distances on the unit sphere.
+# @returns array of distances in km.
+def chord_to_km(chord):
+    return 2*EARTH_RADIUS*np.arcsin(np.minimum(chord/2, 1))
+
+
+
+
+# Find nearest points by comparing with every point.
+# @params xyz: float array (queries, 3).
+#         points: float array (points, 3).
+#         k: number of nearest points.
+# @returns indices: int array (queries, k) sorted by distance, k is at most the number of points.
+#          chords: float array (queries, k).
+def _brute_force(xyz, points, k):
+    k = max(min(k, len(points)), 0)
+    indices = np.empty((len(xyz), k), dtype=np.int64)
+    chords = np.empty((len(xyz), k))
+    if k == 0:
+        return indices, chords
+    step = max(QUERY_CHUNK*256 // max(len(points), 1), 1)
+    for q0 in range(0, len(xyz), step):
+        d2 = ((xyz[q0:q0 + step, None, :] - points[None, :, :])**2).sum(axis=2)
+        nearest = np.argpartition(d2, k - 1, axis=1)[:, :k] if k < len(points) else np.tile(np.arange(len(points)), (len(d2), 1))
+        d2 = np.take_along_axis(d2, nearest, axis=1)
+        order = np.argsort(d2, axis=1)
+        indices[q0:q0 + step] = np.take_along_axis(nearest, order, axis=1)
+        chords[q0:q0 + step] = np.sqrt(np.take_along_axis(d2, order, axis=1))
+    return indices, chords
+
+
+
+
+# Spatial index of grid cells.
+# @attr shape: shape of the grid the coordinates were given in.
+#       cell: bucket size on the unit sphere.
+#       keys: sorted bucket keys of grid cells.
+#       order: flat grid index of every grid cell, in the same order as keys.
+#       xyz: float array (cells, 3) of grid cells, in the same order as keys.
+#       max_count: largest number of grid cells in one bucket.
+#       fingerprint: hash of coordinates and bucket size, used to check a saved index.
+class GridIndex:
+    __slots__ = ['shape', 'cell', 'keys', 'order', 'xyz', 'max_count', 'fingerprint']
+
+    def __init__(self, shape, cell, keys, order, xyz, max_count, fingerprint):
+        self.shape = tuple(shape)
+        self.cell = cell
+        self.keys = keys
+        self.order = order
+        self.xyz = xyz
+        self.max_count = max_count
+        self.fingerprint = fingerprint
+
+    # Build index from coordinates of all grid cells.
+    # @params lats: array of latitudes in degrees, any shape (ex. the 2D grid).
+    #         lons: array of longitudes in degrees, same shape as lats.
+    #         cell_km: optional, bucket size in km. Should be larger than the grid spacing.
+    # @returns GridIndex.
+    @classmethod
+    def build(cls, lats, lons, cell_km=10.0):
+        xyz = to_xyz(lats, lons)
+        cell = cell_km/EARTH_RADIUS
+        keys = _bucket_keys(xyz, cell)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        max_count = int(np.unique(keys, return_counts=True)[1].max()) if len(keys) else 0
+        return cls(np.shape(lats), cell, keys, order, xyz[order], max_count, grid_fingerprint(lats, lons, cell_km))
+
+    # Find nearest grid cell of points.
+    # @params lats: latitudes in degrees.
+    #         lons: longitudes in degrees.
+    #         max_km: optional, points further away than max_km from every grid cell get cell -1
+    #                 and distance inf. Points outside the grid are found quickly if max_km is at
+    #                 most the bucket size. Default is no limit.
+    # @returns cells: int array of flat grid indices, use np.unravel_index(cells, index.shape) for grid indices.
+    #                 -1 for every point if the grid is empty.
+    #          km: float array of distances in km.
+    def nearest(self, lats, lons, max_km=None):
+        xyz = to_xyz(lats, lons)
+        if len(self.keys) == 0:
+            return np.full(len(xyz), -1, dtype=np.int64), np.full(len(xyz), np.inf)
+        limit = None if max_km is None else max_km/EARTH_RADIUS
+        cells = np.empty(len(xyz), dtype=np.int64)
+        chords = np.empty(len(xyz))
+        for q0 in range(0, len(xyz), QUERY_CHUNK):
+            cells[q0:q0 + QUERY_CHUNK], chords[q0:q0 + QUERY_CHUNK] = self._nearest(xyz[q0:q0 + QUERY_CHUNK], limit)
+        km = chord_to_km(chords)
+        cells = self.order[cells]
+        if max_km is not None:
+            cells[km > max_km] = -1
+            km[km > max_km] = np.inf
+        return cells, km
+
+    # Find nearest grid cell among the 27 buckets around every point.
+    # A point further away than one bucket from every grid cell in them is compared with all grid cells,
+    # unless it is further away than limit.
+    # @params xyz: float array (points, 3).
+    #         limit: largest distance on the unit sphere of interest, None for no limit.
+    # @returns positions in keys and distances on the unit sphere.
+    def _nearest(self, xyz, limit=None):
+        n = _bucket_size(self.cell)
+        base = _bucket_keys(xyz, self.cell)
+        best = np.full(len(xyz), -1, dtype=np.int64)
+        best_d2 = np.full(len(xyz), np.inf)
+        offsets = np.arange(self.max_count)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    key = base + (dx*n + dy)*n + dz
+                    start = np.searchsorted(self.keys, key, side='left')
+                    end = np.searchsorted(self.keys, key, side='right')
+                    candidates = start[:, None] + offsets[None, :]
+                    valid = candidates < end[:, None]
+                    candidates = np.where(valid, candidates, 0)
+                    d2 = ((self.xyz[candidates] - xyz[:, None, :])**2).sum(axis=2)
+                    d2[~valid] = np.inf
+                    j = np.argmin(d2, axis=1)
+                    d2 = d2[np.arange(len(xyz)), j]
+                    better = d2 < best_d2
+                    best[better] = candidates[better, j[better]]
+                    best_d2[better] = d2[better]
+
+        # Grid cells closer than one bucket are always in the searched buckets.
+        far = best_d2 > self.cell**2
+        if limit is not None and limit <= self.cell:
+            far = np.zeros(len(xyz), dtype=np.bool_)
+        if far.any():
+            indices, chords = _brute_force(xyz[far], self.xyz, 1)
+            best[far] = indices[:, 0]
+            best_d2[far] = chords[:, 0]**2
+        return best, np.sqrt(best_d2)
+
+    # Save index to a .npz file.
+    # @params filename: optional, name of file.
+    # @returns None.
+    def save(self, filename=GRID_INDEX_FILE):
+        header = {'shape': list(self.shape), 'cell': self.cell, 'max_count': self.max_count,
+                  'fingerprint': self.fingerprint}
+        # Processes may save the same index at the same time, so each writes its own file.
+        tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, header=np.frombuffer(json.dumps(header).encode('utf8'), dtype=np.uint8),
+                     keys=self.keys, order=self.order, xyz=self.xyz)
+        os.replace(tmp_filename, filename)
+
+    # Load index saved with save.
+    # @params filename: optional, name of file.
+    # @returns GridIndex.
+    @classmethod
+    def load(cls, filename=GRID_INDEX_FILE):
+        with np.load(filename) as f:
+            header = json.loads(f['header'].tobytes().decode('utf8'))
+            return cls(header['shape'], header['cell'], f['keys'], f['order'], f['xyz'],
+                       header['max_count'], header['fingerprint'])
+
+
+
+
+# Get number of buckets along each axis of the cube around the unit sphere.
+# @params cell: bucket size on the unit sphere.
+# @returns int.
+def _bucket_size(cell):
+    return int(np.ceil(2/cell)) + 3
+
+
+
+
+# Get bucket key of points. Neighbouring buckets have keys differing by
+# (dx*n + dy)*n + dz, where n = _bucket_size(cell).
+# @params xyz: float array (points, 3).
+#         cell: bucket size on the unit sphere.
+# @returns int64 array of keys.
+def _bucket_keys(xyz, cell):
+    n = _bucket_size(cell)
+    b = np.floor((xyz + 1)/cell).astype(np.int64) + 1
+    return (b[:, 0]*n + b[:, 1])*n + b[:, 2]
+
+
+
+
+# Get hash identifying grid coordinates and bucket size.
+# @params lats: array of latitudes.
+#         lons: array of longitudes.
+#         cell_km: bucket size in km.
+# @returns hex string.
+def grid_fingerprint(lats, lons, cell_km):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lats, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lons, dtype=np.float64).tobytes())
+    h.update(str(np.shape(lats)).encode('utf8') + str(cell_km).encode('utf8'))
+    return h.hexdigest()
+
+
+
+
+# Get spatial index of a grid. A saved index is used if it was built from the same coordinates,
+# otherwise the index is built and saved.
+# @params lats: array of latitudes of every grid cell in degrees.
+#         lons: array of longitudes of every grid cell in degrees.
+#         filename: optional, file index is saved to. None to not save.
+#         cell_km: optional, bucket size in km.
+# @returns GridIndex.
+def load_grid_index(lats, lons, filename=GRID_INDEX_FILE, cell_km=10.0):
+    if filename is not None and os.path.isfile(filename):
+        index = GridIndex.load(filename)
+        if index.fingerprint == grid_fingerprint(lats, lons, cell_km):
+            return index
+        print('load_grid_index() >>> ' + filename + ' was built for another grid. Rebuilding.')
+
+    index = GridIndex.build(lats, lons, cell_km)
+    if filename is not None:
+        index.save(filename)
+    return index
+
+
+
+
+# Find the k nearest stations of points.
+# @params lats: latitudes of points in degrees.
+#         lons: longitudes of points in degrees.
+#         stations: list of stations as given by the LantMet API, dicts with
+#                   'weatherStationId', 'wgs84N' and 'wgs84e'.
+#         k: optional, number of stations per point.
+# @returns ids: array (points, k) of station ids as strings, nearest first. k is at most the
+#               number of stations and 0 if there are no stations.
+#          km: float array (points, k) of distances in km.
+def nearest_stations(lats, lons, stations, k=1):
+    ids = np.array([str(station['weatherStationId']) for station in stations], dtype=object)
+    xyz = to_xyz(lats, lons)
+    if k <= 0 or len(stations) == 0:
+        return np.empty((len(xyz), 0), dtype=object), np.empty((len(xyz), 0))
+    points = to_xyz([station['wgs84N'] for station in stations], [station['wgs84e'] for station in stations])
+    indices, chords = _brute_force(xyz, points, k)
+    return ids[indices], chord_to_km(chords)
@@ -0,0 +1,18 @@
+from MESAN_storage import *
+import sys
+
+# Converts recorded MESAN day files between storage backends.
+# Default converts the JSON archive (MESAN_YYYY-MM-DD.txt) to npz (MESAN_YYYY-MM-DD.npz).
+# Usage: python Convert_MESAN_archive.py [source] [target]
+# example: python Convert_MESAN_archive.py json npz
+
+directory = 'MESAN_RECORDED/'
+
+source = 'json'
+target = 'npz'
+if len(sys.argv) > 2:
+    source = sys.argv[1]
+    target = sys.argv[2]
+
+written = convert_MESAN_archive(directory, source, target)
+print('Converted ' + str(len(written)) + ' files from ' + source + ' to ' + target + '.')
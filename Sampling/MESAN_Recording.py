@@ -1,127 +1,69 @@
 from METCOMP_utils import *
+from MESAN_storage import *
 import os
 
 
 
 
-def combine_data(old_data, new_data):
-
-    old_stations = list(old_data.keys())
-
-    comb_data = old_data
-    for s in new_data:
-        # If there exist station in new data which does not exist in old_data, skip it.
-        if s not in old_data.keys():
-            print('combine_data() >>> station ' + s + ' not in old data. Skipping station')
-            continue
-
-        # Combine data
-        for ts in new_data[s]['frames']:
-            # Do not overwrite old data.
-            if ts in old_data[s]['frames']:
-                continue
-            comb_data[s]['frames'][ts] = new_data[s]['frames'][ts]
-
-
-        old_stations.remove(s)
-
-    if not old_stations:
-        # All stations in old data have got new data.
-        pass
-    else:
-        print('combine_data() >>> The following stations did not receive new data:')
-        for e in old_stations:
-            print(e)
-
-
-    return comb_data
-
-
-
-
-def split_data(comb_data):
-    # res_data contains a regular data object for each day key.
-    # Content of each key in res_data should be written as a
-    # separate file.
-
-    # Collect all timestamps.
-    timestamps = {}
-    for s in comb_data:
-        for ts in comb_data[s]['frames']:
-            timestamps[ts] = None
-
-    # Get corresponding datetime objects
-    timestamps = list(timestamps.keys())
-    dt_timestamps = []
-    for ts in timestamps:
-        tmp_ts = ts.replace("T", " ").strip('Z')
-        dt_timestamps.append(datetime.strptime(tmp_ts, '%Y-%m-%d %H:%M:%S'))
-
-    # Sort string timestamps chronologically.
-    sorted_ts = sort_by_list(timestamps, dt_timestamps)
-
-
-    # Init day keys.
-    res_data = {}
-    for ts in sorted_ts:
-        day = ts.split('T')[0]
-        res_data[day] = {}
-
-    # Loop over days and init dict structure. Copy station data.
-    prev_day = ''
-    for ts in sorted_ts:
-
-        day = ts.split('T')[0]
-        if day == prev_day:
-            continue
-        else:
-            prev_day = day
-
-        # Add station data for each station and init frames dict.
-        res_data[day] = {}
-        for s in comb_data:
-            res_data[day][s] = {}
-            res_data[day][s]['name'] = comb_data[s]['name']
-            res_data[day][s]['municId'] = comb_data[s]['municId']
-            res_data[day][s]['regionId'] = comb_data[s]['regionId']
-            res_data[day][s]['realLong'] = comb_data[s]['realLong']
-            res_data[day][s]['realLat'] = comb_data[s]['realLat']
-            res_data[day][s]['gridLong'] = comb_data[s]['gridLong']
-            res_data[day][s]['gridLat'] = comb_data[s]['gridLat']
-            res_data[day][s]['frames'] = {}
-            pass
-
-    # Add frames chronologically.
-    for ts in sorted_ts:
-        day = ts.split('T')[0]
-        for s in comb_data:
-            res_data[day][s]['frames'][ts] = comb_data[s]['frames'][ts]
-
-    return res_data
+LANTMET_URL = os.environ.get('LANTMET_URL', 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm')
+SMHI_URL = os.environ.get('SMHI_URL', 'https://opendata-download-metanalys.smhi.se/api/category/mesan1g/version/2/geotype/point/lon/{lon}/lat/{lat}/data.json')
 
+# Maximum number of simultaneous requests to SMHI. Set to 1 for sequential fetching.
+MAX_WORKERS = int(os.environ.get('MESAN_MAX_WORKERS', '16'))
 
+# Storage backend for recorded day files, 'json' (MESAN_YYYY-MM-DD.txt) or 'npz' (MESAN_YYYY-MM-DD.npz).
+# See MESAN_storage.py. Use convert_MESAN_archive() before switching backend for an existing archive.
+STORAGE = os.environ.get('MESAN_STORAGE', 'json')
+backend = get_backend(STORAGE)
+if backend is None:
+    quit()
 
+directory = 'MESAN_RECORDED/'
 
-LANTMET_URL = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm'
-SMHI_URL = 'https://opendata-download-metanalys.smhi.se/api/category/mesan1g/version/2/geotype/point/lon/{lon}/lat/{lat}/data.json'
+# Station -> grid cell map kept between runs. MESAN is gridded, so stations
+# within the same grid cell get identical timeseries from SMHI.
+# Assumption: Grid coordinates are static, i.e. does not change over time.
+grid_map_file = directory + 'grid_cells.json'
+if os.path.isfile(grid_map_file):
+    grid_map = load_dict(grid_map_file)
+else:
+    grid_map = {}
 
 # Make a true copy of stations.
 stations = get_from_api(LANTMET_URL)
 
-# Collect current data.
+# Group stations by known grid cell. Stations without a known grid cell
+# get a group of their own and are added to the map after fetching.
+cells = {}
+station_cells = {}
+for station in stations:
+    station_id = str(station['weatherStationId'])
+    if station_id in grid_map:
+        cell = str(grid_map[station_id][0]) + ',' + str(grid_map[station_id][1])
+    else:
+        cell = 'station_' + station_id
+    station_cells[station_id] = cell
+    if cell not in cells:
+        cells[cell] = station
+print('MESAN_RECORDING: Fetching ' + str(len(cells)) + ' grid cells for ' + str(len(stations)) + ' stations.')
+
+# Fetch latest 24h MESAN data once per grid cell concurrently, using the
+# coordinates of the first station found in each cell.
+urls = []
+for cell in cells:
+    urls.append(SMHI_URL.replace('{lon}', str(cells[cell]['wgs84e'])).replace('{lat}', str(cells[cell]['wgs84N'])))
+cell_responses = dict(zip(cells, get_many_from_api(urls, max_workers=MAX_WORKERS)))
+
+# Collect current data. Every station gets the data of its grid cell.
 data = {}
 missing_stations = []
 for station in stations:
 
-    # ONLY FOR DEV PURPOSES!!!!
-    # REMOVE THIS LATER
-    #continue
+    MESAN = cell_responses[station_cells[str(station['weatherStationId'])]]
 
     real_lat = station['wgs84N']
     real_lon = station['wgs84e']
 
-    # Get latest 24h MESAN data.
-    MESAN = get_from_api(SMHI_URL.replace('{lon}', str(real_lon)).replace('{lat}', str(real_lat)))
     if not MESAN:
         # Deal with nonexistent data.
         missing_stations.append(str(station['weatherStationId']))
@@ -134,6 +76,7 @@ for station in stations:
     # Assumption: Grid coordinates are static, i.e. does not change over time. (Suggest confirming with SMHI)
     grid_lon = MESAN['geometry']['coordinates'][0][0]
     grid_lat = MESAN['geometry']['coordinates'][0][1]
+    grid_map[str(station['weatherStationId'])] = [grid_lon, grid_lat]
 
     data_station = data[str(station['weatherStationId'])] = {}
     data_station['name'] = station['weatherStationName']
@@ -164,6 +107,7 @@ else:
     for e in missing_stations:
         print(e)
 
+save_dict(grid_map, grid_map_file)
 
 
 #save_dict(data, 'MESAN_Test_Dict5.txt')
@@ -172,71 +116,24 @@ else:
 
 
 
-# ========== COMBING AND SPLITTING DATA ==========
-# Compare with stored files with similar data and
-# add frames which does not exist in stored data.
-
-# This should be data and not loaded from a file
-# Only doing this during development.
-#data = load_dict('MESAN_Test_Dict4.txt')
-
-
-directory = 'MESAN_RECORDED/'
-
-# Check dir for saved files
-files = []
-for r, d, f in os.walk(directory):
-    for file in f:
-        if '.txt' in file:
-            files.append(file)
+# ========== WRITING DATA ==========
+# Frames which does not exist in stored data are appended to
+# per-day segments (see MESAN_storage.py). Stored day files
+# are only written when a day is compacted.
 
+# Set MESAN_COMPACT=all to also compact days still receiving data.
+COMPACT_ALL = os.environ.get('MESAN_COMPACT', '') == 'all'
 
-# If directory empty.
-if not files:
-    print('MESAN_RECORDING: No previous files exists.')
-    res_data = split_data(data)
-    for d in res_data:
-        print('                 Writing MESAN_' + d + '.txt.')
-        save_dict(res_data[d], directory + 'MESAN_' + d + '.txt')
+appended = append_frames(directory, data, backend)
+for d in appended:
+    print('MESAN_RECORDING: Appended ' + str(appended[d]) + ' new frames for ' + d + '.')
 
-
-# Find latest file.
-# If files overlap, old file will get additional data while a new
-# file is written containing contents for the following day.
+# Days older than the oldest day in fetched data will not receive more data.
+data_dates = sorted(appended.keys())
+if data_dates:
+    compact_segments(directory, backend, before_day=data_dates[0], compact_all=COMPACT_ALL)
 else:
-    print('MESAN_RECORDING: Found previous files.')
-    # Third save logic attempt.
-    # Check if MESAN_X exists for first date in data.
-    # If so, load MESAN_X into old data and combine.
-
-    # Find all dates in data and sort chronologically.
-    data_dates = {}  # Dates within fetched data.
-    dt_data_dates = []
-    for s in data:
-        for ts in data[s]['frames']:
-            data_dates[ts.split('T')[0]] = None
-    data_dates = list(data_dates.keys())
-    for d in data_dates:
-        dt_data_dates.append(datetime.strptime(d, '%Y-%m-%d'))
-    data_dates = sort_by_list(data_dates, dt_data_dates)
-
-    # Check if file containing oldest data exists. If so load it. Otherwise, create two new files.
-    merge_file = 'MESAN_' + data_dates[0] + '.txt'
-    if merge_file in files:
-        print('                 Merging with ' + merge_file)
-        old_data = load_dict(directory + merge_file)
-        comb_data = combine_data(old_data, data)
-        res_data = split_data(comb_data)
-        for d in res_data:
-            print('                 Writing MESAN_' + d + '.txt.')
-            save_dict(res_data[d], directory + 'MESAN_' + d + '.txt')
-    # Should enter this if sampling did not occur for 24h.
-    else:
-        print('                 No file found for merging.')
-        res_data = split_data(data)
-        for d in res_data:
-            print('                 Writing MESAN_' + d + '.txt.')
-            save_dict(res_data[d], directory + 'MESAN_' + d + '.txt')
+    compact_segments(directory, backend, compact_all=COMPACT_ALL)
 
 
 
@@ -0,0 +1,284 @@
+# This script contains a memory mapped cube of the recorded MESAN archive.
+#
+# All recorded day files in a directory are written into one dense float32 array
+# (values.f32) with a station axis, an hourly time axis and a parameter axis. Hour i
+# of the time axis is hour index epoch + i (see timestamp_index.py), so finding a
+# timestamp is arithmetic instead of a search. A sidecar index (index.json) holds
+# the epoch, the stations, the parameters and the days written. Values missing in
+# the archive are NaN.
+#
+# The array is stored parameter by parameter, so one parameter for all stations
+# over a long period is contiguous on disk. The file is memory mapped when read:
+# only accessed pages are read from disk and processes reading the same cube
+# share the page cache.
+#
+# build_MESAN_cube('MESAN_RECORDED/')
+# cube = MESANCube.open('MESAN_RECORDED/cube/')
+# t = cube.select(params=['t'], start='2020-11-01T00:00:00Z', end='2020-11-30T23:00:00Z')
+
+
+
+
+import os
+import json
+import numpy as np
+from MESAN_frames import *
+from MESAN_storage import *
+
+
+
+
+CUBE_FORMAT = 'MESAN_cube'
+CUBE_VERSION = 1
+CUBE_DIR = 'cube/'
+
+
+
+
+# Load a recorded day file as MESANFrames.
+# @params filename: Name of day file (.txt or .npz).
+# @returns MESANFrames.
+def _load_day(filename):
+    if filename.endswith('.npz'):
+        return load_MESAN_frames(filename)
+    return MESANFrames.from_dict(load_MESAN_json(filename))
+
+
+
+
+# Get index of a cube.
+# @params cube_dir: directory of cube.
+# @returns index as a dict, None if no cube exists.
+def load_cube_index(cube_dir):
+    try:
+        with open(cube_dir + 'index.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+
+
+# Copy a cube into a new file with more stations, parameters or hours. Stations and
+# parameters are only appended, so old ones keep their index. Values not in the old cube
+# are NaN. Every value of the new file is written once.
+# @params values: float32 memmap of old cube, None if there is none.
+#         old: index of old cube.
+#         new: index of new cube.
+#         filename: name of new file.
+# @returns float32 memmap of new cube.
+def _copy_cube(values, old, new, filename):
+    out = np.memmap(filename, dtype=np.float32, mode='w+',
+                    shape=(len(new['parameters']), len(new['stations']), new['hours']))
+    n_stations = 0 if values is None else values.shape[1]
+    offset = 0 if values is None else old['epoch'] - new['epoch']
+    for k in range(out.shape[0]):
+        if values is None or k >= values.shape[0]:
+            out[k] = np.nan
+            continue
+        out[k, n_stations:] = np.nan
+        out[k, :n_stations, :offset] = np.nan
+        out[k, :n_stations, offset + old['hours']:] = np.nan
+        out[k, :n_stations, offset:offset + old['hours']] = values[k]
+    return out
+
+
+
+
+# Build or update the cube of all recorded day files in a directory.
+# Days already in the cube are skipped. The time axis covers all recorded days. A cube only
+# has to be copied into a larger one when a new day is outside its time axis or has stations
+# or parameters not in the cube. To avoid copying the cube every time a day is recorded, a
+# time axis that grows is extended by half of its length past the last recorded day.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         cube_dir: optional, directory of cube. Default is CUBE_DIR in directory.
+# @returns list of days written.
+def build_MESAN_cube(directory, cube_dir=None):
+    if cube_dir is None:
+        cube_dir = directory + CUBE_DIR
+    day_files = list_day_files(directory)
+    if not day_files:
+        print('build_MESAN_cube() >>> No recorded days in ' + directory + '.')
+        return []
+
+    index = load_cube_index(cube_dir)
+    new_days = sorted([day for day in day_files if index is None or day not in index['days']])
+    if not new_days:
+        return []
+
+    # Time axis needed for all recorded days.
+    first_hour = day_to_hour(min(day_files))
+    last_hour = day_to_hour(max(day_files)) + 24
+
+    values_file = cube_dir + 'values.f32'
+    os.makedirs(cube_dir, exist_ok=True)
+    # The memmap is kept in a dict, so it can be closed before its file is replaced.
+    cube = {'values': None, 'copied': False}
+    if index is None:
+        index = {'format': CUBE_FORMAT, 'version': CUBE_VERSION, 'epoch': first_hour,
+                 'hours': last_hour - first_hour, 'stations': [], 'parameters': [], 'days': []}
+    else:
+        cube['values'] = np.memmap(values_file, dtype=np.float32, mode='r+',
+                                   shape=(len(index['parameters']), len(index['stations']), index['hours']))
+
+    # Copy the cube into a larger one. The new cube is written next to the old one, so
+    # the old cube can be used until it is replaced.
+    def grow(old, new):
+        shape = (len(new['parameters']), len(new['stations']), new['hours'])
+        filename = values_file + ('.tmp2' if cube['copied'] else '.tmp')
+        values = _copy_cube(cube.pop('values'), old, new, filename)
+        if cube['copied']:
+            values.flush()
+            del values
+            os.replace(filename, values_file + '.tmp')
+            values = np.memmap(values_file + '.tmp', dtype=np.float32, mode='r+', shape=shape)
+        cube['values'] = values
+        cube['copied'] = True
+        print('build_MESAN_cube() >>> Cube has ' + str(shape[1]) + ' stations, ' +
+              str(shape[2]) + ' hours and ' + str(shape[0]) + ' parameters.')
+
+    if cube['values'] is not None and (first_hour < index['epoch'] or last_hour > index['epoch'] + index['hours']):
+        new = dict(index)
+        new['epoch'] = min(first_hour, index['epoch'])
+        end = max(last_hour, index['epoch'] + index['hours'])
+        if last_hour > index['epoch'] + index['hours']:
+            end = end + (end - new['epoch']) // 48 * 24
+        new['hours'] = end - new['epoch']
+        grow(index, new)
+        index = new
+
+    # Every day file is loaded once. New stations and parameters are appended.
+    station_index = {station_id: i for i, station_id in enumerate(index['stations'])}
+    param_index = {p['key']: k for k, p in enumerate(index['parameters'])}
+    for day in new_days:
+        frames = _load_day(day_files[day])
+        new_stations = [station.id for station in frames.stations if station.id not in station_index]
+        new_params = [p for p in frames.parameters if p['key'] not in param_index]
+        if new_stations or new_params or cube['values'] is None:
+            new = dict(index)
+            new['stations'] = index['stations'] + new_stations
+            new['parameters'] = index['parameters'] + new_params
+            grow(index, new)
+            index = new
+            station_index = {station_id: i for i, station_id in enumerate(index['stations'])}
+            param_index = {p['key']: k for k, p in enumerate(index['parameters'])}
+
+        values = cube['values']
+        rows = np.array([station_index[station.id] for station in frames.stations], dtype=np.int64)
+        hours = parse_timestamps(frames.times) - index['epoch']
+        within = (hours >= 0) & (hours < index['hours'])
+        for k, p in enumerate(frames.parameters):
+            values[param_index[p['key']]][np.ix_(rows, hours[within])] = frames.values[:, within, k]
+        del values
+        index['days'].append(day)
+    cube['values'].flush()
+    del cube['values']
+
+    if cube['copied']:
+        os.replace(values_file + '.tmp', values_file)
+    with open(cube_dir + 'index.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(cube_dir + 'index.json.tmp', cube_dir + 'index.json')
+
+    print('build_MESAN_cube() >>> Wrote ' + str(len(new_days)) + ' days.')
+    return new_days
+
+
+
+
+# Turn a list of indices into a slice if they are consecutive, so indexing gives a view.
+# @params indices: list of indices.
+# @returns slice or list of indices.
+def _as_slice(indices):
+    if indices and indices == list(range(indices[0], indices[-1] + 1)):
+        return slice(indices[0], indices[-1] + 1)
+    return indices
+
+
+
+
+# Memory mapped cube of recorded MESAN data.
+# @attr epoch: hour index of first hour in cube.
+#       stations: list of station ids.
+#       parameters: list of parameter dicts with key, name, levelType, level, unit and integer.
+#       values: float32 memmap (parameters, stations, hours).
+#       days: list of days written to cube.
+#       station_index, param_index: maps from station id and parameter key to index.
+class MESANCube:
+    __slots__ = ['epoch', 'stations', 'parameters', 'values', 'days', 'station_index', 'param_index']
+
+    def __init__(self, epoch, stations, parameters, values, days):
+        self.epoch = epoch
+        self.stations = stations
+        self.parameters = parameters
+        self.values = values
+        self.days = days
+        self.station_index = {s: i for i, s in enumerate(stations)}
+        self.param_index = {p['key']: k for k, p in enumerate(parameters)}
+
+    # Open a cube written by build_MESAN_cube. Values are not read until accessed.
+    # @params cube_dir: directory of cube, ex. 'MESAN_RECORDED/cube/'.
+    # @returns MESANCube. None if no cube exists.
+    @classmethod
+    def open(cls, cube_dir):
+        index = load_cube_index(cube_dir)
+        if index is None or index.get('format') != CUBE_FORMAT:
+            print('MESANCube.open() >>> No cube in ' + cube_dir + '.')
+            return None
+        values = np.memmap(cube_dir + 'values.f32', dtype=np.float32, mode='r',
+                           shape=(len(index['parameters']), len(index['stations']), index['hours']))
+        return cls(index['epoch'], index['stations'], index['parameters'], values, index['days'])
+
+    # Get timestamps of a time window.
+    # @params start: optional, first validTime included, ex. '2020-11-12T00:00:00Z'. Default first hour.
+    #         end: optional, last validTime included. Default last hour.
+    # @returns array of string timestamps.
+    def timestamps(self, start=None, end=None):
+        t = self._time_slice(start, end)
+        return format_timestamps(np.arange(self.epoch + t.start, self.epoch + t.stop))
+
+    # Select stations, parameters and a time window.
+    # The result is a view of the memory mapped file, i.e. nothing is read or copied, if
+    # stations and parameters are consecutive in the cube (or not given). Otherwise only
+    # the selected values are read.
+    # @params stations: optional, list of station ids. Default is all.
+    #         params: optional, list of parameter keys or names. Default is all.
+    #         start: optional, first validTime included, ex. '2020-11-12T00:00:00Z'.
+    #         end: optional, last validTime included.
+    # @returns float32 array (stations, hours, parameters).
+    def select(self, stations=None, params=None, start=None, end=None):
+        t = self._time_slice(start, end)
+        s = slice(None)
+        if stations is not None:
+            s = _as_slice([self.station_index[x] for x in stations if x in self.station_index])
+        k = slice(None)
+        if params is not None:
+            k = _as_slice([i for i, p in enumerate(self.parameters) if p['key'] in params or p['name'] in params])
+
+        # Index one axis at a time, so slices stay views.
+        values = self.values[k]
+        values = values[:, s]
+        values = values[:, :, t]
+        return values.transpose(1, 2, 0)
+
+    # Get values of one parameter.
+    # @params key: parameter key ('t_hl') or name ('t').
+    #         start: optional, first validTime included.
+    #         end: optional, last validTime included.
+    # @returns float32 array view (stations, hours). None if parameter not found.
+    def param(self, key, start=None, end=None):
+        k = [i for i, p in enumerate(self.parameters) if p['key'] == key or p['name'] == key]
+        if not k:
+            print('MESANCube.param() >>> No parameter ' + key + '.')
+            return None
+        return self.values[k[0], :, self._time_slice(start, end)]
+
+    # Get slice of the time axis for a time window.
+    # @params start: first validTime included or None.
+    #         end: last validTime included or None.
+    # @returns slice.
+    def _time_slice(self, start, end):
+        hours = self.values.shape[2]
+        j0 = 0 if start is None else min(max(ts_to_hour(start) - self.epoch, 0), hours)
+        j1 = hours if end is None else min(max(ts_to_hour(end) - self.epoch + 1, j0), hours)
+        return slice(j0, j1)
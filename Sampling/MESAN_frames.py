@@ -0,0 +1,275 @@
+# This script contains an array backed in-memory model of recorded MESAN data.
+#
+# The regular recorded format data[stationID]['frames'][validTime]['parameters']
+# holds a list of parameter dicts per station and hour. MESANFrames instead holds
+# all values in one float64 cube with shape (stations, times, parameters) and
+# maps from station id, timestamp and parameter key to index. Selecting a
+# parameter, a set of stations or a time window is then a slice of the cube.
+#
+# frames = MESANFrames.from_dict(data)
+# t = frames.param('t_hl')                  # (stations, times) view
+# day = frames.select(start='2020-11-12T00:00:00Z', end='2020-11-12T23:00:00Z')
+# data = frames.to_dict()                   # back to recorded format
+
+
+
+
+import numpy as np
+from timestamp_index import *
+
+
+
+
+# Station data kept for every station in addition to its frames.
+STATION_KEYS = ['name', 'municId', 'regionId', 'realLong', 'realLat', 'gridLong', 'gridLat']
+
+
+
+
+# Get the key identifying a parameter in a MESAN frame.
+# @params param: parameter dict as given by SMHI, ex. {'name': 't', 'levelType': 'hl', ...}
+# @returns key as a string, ex. 't_hl'.
+def param_key(param):
+    return param['name'] + '_' + param['levelType']
+
+
+
+
+# Keys of a parameter dict as given by SMHI.
+PARAM_KEYS = ['name', 'levelType', 'level', 'unit', 'values']
+
+
+
+
+# Convert a float64 value back to the value in the recorded data.
+# @params value: numpy float64.
+#         integer: True if the original value was an int.
+# @returns python int or float. None if value is NaN.
+def from_float64(value, integer):
+    if np.isnan(value):
+        return None
+    if integer:
+        return int(value)
+    return float(value)
+
+
+
+
+# Check if a value can be stored in the cube.
+# @params value: value from a parameter dict.
+# @returns True if value is None, an int or a finite float.
+def _is_number(value):
+    if value is None:
+        return True
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return bool(np.isfinite(value))
+
+
+
+
+# Select irregular frames of some stations and times, keeping only some parameters.
+# @params irregular: dict with (station id, validTime) as key and the frame as value.
+#         stations: list of station ids.
+#         times: list of validTimes.
+#         parameters: list of parameter dicts with key, or None for all parameters.
+# @returns dict on the same format as irregular.
+def select_irregular(irregular, stations, times, parameters=None):
+    stations = set(stations)
+    times = set(times)
+    selected = {}
+    for (s, ts), frame in irregular.items():
+        if s not in stations or ts not in times:
+            continue
+        if parameters is not None:
+            keys = set(p['key'] for p in parameters)
+            frame = dict(frame)
+            frame['parameters'] = [p for p in frame['parameters'] if param_key(p) in keys]
+        selected[(s, ts)] = frame
+    return selected
+
+
+
+
+# Station data of one station.
+# Only the keys given are written back by to_dict. Keys other than STATION_KEYS are kept in extra.
+class Station:
+    __slots__ = ['id', 'keys', 'extra'] + STATION_KEYS
+
+    def __init__(self, id, **kwargs):
+        self.id = id
+        self.keys = [k for k in kwargs if k != 'frames']
+        self.extra = {k: kwargs[k] for k in self.keys if k not in STATION_KEYS}
+        for k in STATION_KEYS:
+            setattr(self, k, kwargs.get(k))
+
+    # @returns station data as a dict, without id.
+    def to_dict(self):
+        return {k: self.extra[k] if k in self.extra else getattr(self, k) for k in self.keys}
+
+
+
+
+# Recorded MESAN data as a station x time x parameter cube.
+# to_dict() gives back exactly the data given to from_dict(). Frames that do not fit the
+# cube (several values, extra keys, other level or unit, other order of parameters) are
+# kept as they are in irregular, and their values are also in the cube where possible.
+# @attr stations: list of Station.
+#       times: sorted list of validTime strings.
+#       parameters: list of parameter dicts with key, name, levelType, level, unit and integer.
+#       values: float64 array (stations, times, parameters). Missing values are NaN.
+#       frames: bool array (stations, times). True if the station has a frame for the time.
+#       present: bool array (stations, times, parameters). True if the frame has the
+#                parameter, also when its value is None.
+#       irregular: dict with (station id, validTime) as key and the frame as value.
+#       station_index, time_index, param_index: maps from station id, validTime and
+#                                               parameter key to index.
+class MESANFrames:
+    __slots__ = ['stations', 'times', 'parameters', 'values', 'frames', 'present', 'irregular',
+                 'station_index', 'time_index', 'param_index']
+
+    def __init__(self, stations, times, parameters, values, frames, present=None, irregular=None):
+        self.stations = stations
+        self.times = times
+        self.parameters = parameters
+        self.values = values
+        self.frames = frames
+        if present is None:
+            present = frames[:, :, None] & ~np.isnan(values)
+        self.present = present
+        self.irregular = {} if irregular is None else irregular
+        self.station_index = {s.id: i for i, s in enumerate(stations)}
+        self.time_index = {ts: i for i, ts in enumerate(times)}
+        self.param_index = {p['key']: i for i, p in enumerate(parameters)}
+
+    # Build from data on recorded format.
+    # @params data: Dictionary on recorded format.
+    # @returns MESANFrames.
+    @classmethod
+    def from_dict(cls, data):
+        station_ids = list(data.keys())
+
+        # Collect timestamps and parameters present in data.
+        times = {}
+        params = {}
+        for s in station_ids:
+            for ts in data[s]['frames']:
+                times[ts] = None
+                for p in data[s]['frames'][ts]['parameters']:
+                    key = param_key(p)
+                    if key not in params:
+                        params[key] = {'key': key, 'name': p['name'], 'levelType': p['levelType'],
+                                       'level': p.get('level'), 'unit': p.get('unit'), 'integer': True}
+                    for value in p.get('values', []):
+                        if value is not None and not (isinstance(value, int) and not isinstance(value, bool)):
+                            params[key]['integer'] = False
+        times = sort_timestamps(times)
+        time_index = {ts: i for i, ts in enumerate(times)}
+        param_index = {key: i for i, key in enumerate(params)}
+
+        values = np.full((len(station_ids), len(times), len(params)), np.nan, dtype=np.float64)
+        frames = np.zeros((len(station_ids), len(times)), dtype=np.bool_)
+        present = np.zeros((len(station_ids), len(times), len(params)), dtype=np.bool_)
+        irregular = {}
+        for i, s in enumerate(station_ids):
+            for ts, frame in data[s]['frames'].items():
+                j = time_index[ts]
+                frames[i, j] = True
+                regular = list(frame.keys()) == ['parameters']
+                last = -1
+                for p in frame['parameters']:
+                    k = param_index[param_key(p)]
+                    info = params[param_key(p)]
+                    p_values = p.get('values')
+                    # to_dict writes parameters in the order of the cube, one value each.
+                    if (k <= last or sorted(p.keys()) != sorted(PARAM_KEYS)
+                            or p['level'] != info['level'] or p['unit'] != info['unit']
+                            or not isinstance(p_values, list) or len(p_values) != 1
+                            or not _is_number(p_values[0])
+                            or (isinstance(p_values[0], int) and not info['integer'])):
+                        regular = False
+                    last = k
+                    if isinstance(p_values, list) and p_values and _is_number(p_values[0]) and not present[i, j, k]:
+                        present[i, j, k] = True
+                        if p_values[0] is not None:
+                            values[i, j, k] = p_values[0]
+                if not regular:
+                    irregular[(s, ts)] = frame
+
+        stations = [Station(s, **data[s]) for s in station_ids]
+        return cls(stations, times, list(params.values()), values, frames, present, irregular)
+
+    # Convert to recorded format.
+    # @returns Dictionary on recorded format.
+    def to_dict(self):
+        data = {}
+        for i, station in enumerate(self.stations):
+            data_station = data[station.id] = station.to_dict()
+            data_station['frames'] = {}
+            for j, ts in enumerate(self.times):
+                if not self.frames[i, j]:
+                    continue
+                if (station.id, ts) in self.irregular:
+                    data_station['frames'][ts] = self.irregular[(station.id, ts)]
+                    continue
+                parameters = []
+                for k, p in enumerate(self.parameters):
+                    if not self.present[i, j, k]:
+                        continue
+                    parameters.append({'name': p['name'],
+                                       'levelType': p['levelType'],
+                                       'level': p['level'],
+                                       'unit': p['unit'],
+                                       'values': [from_float64(self.values[i, j, k], p['integer'])]})
+                data_station['frames'][ts] = {'parameters': parameters}
+        return data
+
+    # Get values of one parameter for all stations and times.
+    # @params key: parameter key ('t_hl') or name ('t').
+    # @returns float64 array view (stations, times). None if parameter not found.
+    def param(self, key):
+        k = self._param_indices([key])
+        if not k:
+            print('MESANFrames.param() >>> No parameter ' + key + '.')
+            return None
+        return self.values[:, :, k[0]]
+
+    # Select a subset of stations, parameters and a time window.
+    # Time window and all parameters are slices of the cube.
+    # @params stations: optional, list of station ids. Default is all.
+    #         params: optional, list of parameter keys or names. Default is all.
+    #         start: optional, first validTime included, ex. '2020-11-12T00:00:00Z'.
+    #         end: optional, last validTime included.
+    # @returns MESANFrames.
+    def select(self, stations=None, params=None, start=None, end=None):
+        # Times are sorted, so a time window is a slice.
+        hours = parse_timestamps(self.times)
+        j0 = 0 if start is None else int(np.searchsorted(hours, ts_to_hour(start), side='left'))
+        j1 = len(self.times) if end is None else int(np.searchsorted(hours, ts_to_hour(end), side='right'))
+        t = slice(j0, j1)
+
+        if stations is None:
+            s = slice(None)
+            new_stations = self.stations
+        else:
+            s = [self.station_index[x] for x in stations if x in self.station_index]
+            new_stations = [self.stations[i] for i in s]
+
+        if params is None:
+            k = slice(None)
+            new_params = self.parameters
+        else:
+            k = self._param_indices(params)
+            new_params = [self.parameters[i] for i in k]
+
+        values = self.values[s][:, t][:, :, k]
+        frames = self.frames[s][:, t]
+        present = self.present[s][:, t][:, :, k]
+        irregular = select_irregular(self.irregular, [x.id for x in new_stations], self.times[j0:j1], new_params)
+        return MESANFrames(new_stations, self.times[j0:j1], new_params, values, frames, present, irregular)
+
+    # Find indices of parameters given by key or name.
+    # @params params: list of parameter keys or names.
+    # @returns list of indices.
+    def _param_indices(self, params):
+        return [i for i, p in enumerate(self.parameters) if p['key'] in params or p['name'] in params]
@@ -0,0 +1,520 @@
+# This script contains storage backends for recorded MESAN day files.
+#
+# The original backend writes each day as pretty printed JSON (MESAN_YYYY-MM-DD.txt).
+# The npz backend writes each day as a compressed NumPy archive (MESAN_YYYY-MM-DD.npz)
+# containing a small JSON header and one float64 array per parameter with
+# shape (stations, hours). Since every parameter is stored separately, a subset
+# of parameters can be loaded without decompressing the rest of the file.
+# Loading a npz file gives back exactly the data that was saved (version 1 files
+# stored float32 values and parameters with value None were dropped).
+#
+# Both backends take and return data on the regular recorded format:
+# data[stationID]['frames'][validTime]['parameters']
+# npz files can also be loaded directly as MESANFrames (see MESAN_frames.py).
+
+
+
+
+import os
+import json
+import numpy as np
+from METCOMP_utils import *
+from MESAN_frames import *
+
+
+
+
+NPZ_FORMAT = 'MESAN_npz'
+NPZ_VERSION = 2
+
+
+
+
+# Write recorded MESAN data for one day as a compressed npz file to an open file.
+# Errors are raised, see save_atomic.
+# @params data: Dictionary on recorded format or MESANFrames.
+#         f: file opened for binary writing.
+# @returns None.
+def write_MESAN_npz(data, f):
+
+    if isinstance(data, MESANFrames):
+        frames = data
+    else:
+        frames = MESANFrames.from_dict(data)
+
+    header = {'format': NPZ_FORMAT,
+              'version': NPZ_VERSION,
+              'stations': [],
+              'times': frames.times,
+              'parameters': frames.parameters,
+              'irregular': [[station, ts, frame] for (station, ts), frame in frames.irregular.items()]}
+    for station in frames.stations:
+        tmp_dict = {'id': station.id}
+        tmp_dict.update(station.to_dict())
+        header['stations'].append(tmp_dict)
+
+    arrays = {'header': np.frombuffer(json.dumps(header, ensure_ascii=False).encode('utf8'), dtype=np.uint8),
+              'frames': frames.frames}
+    for k, p in enumerate(frames.parameters):
+        arrays['param_' + p['key']] = frames.values[:, :, k]
+        arrays['present_' + p['key']] = frames.present[:, :, k]
+
+    np.savez_compressed(f, **arrays)
+
+
+
+
+# Save recorded MESAN data for one day as a compressed npz file.
+# @params data: Dictionary on recorded format or MESANFrames.
+#         filename: Name of saved file.
+# @returns None.
+def save_MESAN_npz(data, filename):
+    try:
+        with open(filename, 'wb') as f:
+            write_MESAN_npz(data, f)
+    except OSError:
+        print('save_MESAN_npz() >>> Something went wrong trying to save the file.')
+
+
+
+
+# Write JSON data to an open file, formatted as by save_dict.
+# Errors are raised, see save_atomic.
+# @params data: Dict with JSON data.
+#         f: file opened for binary writing.
+# @returns None.
+def write_dict(data, f):
+    f.write(json.dumps(data, indent=4, sort_keys=False, ensure_ascii=False).encode('utf8'))
+
+
+
+
+# Read the header of a npz MESAN file.
+# @params npz: opened npz file (np.load).
+# @returns header as a dict.
+def _read_header(npz):
+    return json.loads(npz['header'].tobytes().decode('utf8'))
+
+
+
+
+# Load recorded MESAN data from a npz file as MESANFrames.
+# @params filename: Name of npz file.
+#         stations: optional, list of station ids to load. Default is all.
+#         params: optional, list of parameters to load, either as key ('t_hl') or name ('t').
+#                 Default is all.
+# @returns MESANFrames. None if file is not a MESAN npz file.
+def load_MESAN_frames(filename, stations=None, params=None):
+
+    with np.load(filename) as npz:
+        header = _read_header(npz)
+        if header.get('format') != NPZ_FORMAT:
+            print('load_MESAN_frames() >>> ' + filename + ' is not a MESAN npz file.')
+            return None
+
+        # Select stations.
+        station_rows = []
+        for i, station in enumerate(header['stations']):
+            if stations is None or station['id'] in stations:
+                station_rows.append(i)
+
+        # Select parameters. Only selected parameters are decompressed.
+        selected = []
+        for p in header['parameters']:
+            if params is None or p['key'] in params or p['name'] in params:
+                selected.append(p)
+
+        values = np.empty((len(station_rows), len(header['times']), len(selected)), dtype=np.float64)
+        present = np.empty((len(station_rows), len(header['times']), len(selected)), dtype=np.bool_)
+        mask = npz['frames'][station_rows]
+        for k, p in enumerate(selected):
+            if header['version'] < 2:
+                # float32 values, restored to their shortest decimal representation.
+                values[:, :, k] = npz['param_' + p['key']][station_rows].astype(str).astype(np.float64)
+                present[:, :, k] = mask & ~np.isnan(values[:, :, k])
+            else:
+                values[:, :, k] = npz['param_' + p['key']][station_rows]
+                present[:, :, k] = npz['present_' + p['key']][station_rows]
+
+    station_list = []
+    for i in station_rows:
+        station = header['stations'][i]
+        station_list.append(Station(**station))
+
+    irregular = {(s, ts): frame for s, ts, frame in header.get('irregular', [])}
+    irregular = select_irregular(irregular, [x.id for x in station_list], header['times'],
+                                 None if params is None else selected)
+    return MESANFrames(station_list, header['times'], selected, values, mask, present, irregular)
+
+
+
+
+# Load recorded MESAN data from a npz file.
+# @params filename: Name of npz file.
+#         stations: optional, list of station ids to load. Default is all.
+#         params: optional, list of parameters to load, either as key ('t_hl') or name ('t').
+#                 Default is all.
+# @returns data: Dict on recorded format.
+def load_MESAN_npz(filename, stations=None, params=None):
+    frames = load_MESAN_frames(filename, stations=stations, params=params)
+    if frames is None:
+        return None
+    return frames.to_dict()
+
+
+
+
+# Load recorded MESAN data from a JSON file.
+# @params filename: Name of JSON file.
+#         stations: optional, list of station ids to load. Default is all.
+#         params: optional, list of parameters to load, either as key ('t_hl') or name ('t').
+#                 Default is all.
+# @returns data: Dict on recorded format.
+def load_MESAN_json(filename, stations=None, params=None):
+    data = load_dict(filename)
+    if stations is not None:
+        data = {s: data[s] for s in data if s in stations}
+    if params is not None:
+        for s in data:
+            for ts in data[s]['frames']:
+                parameters = data[s]['frames'][ts]['parameters']
+                data[s]['frames'][ts]['parameters'] = [p for p in parameters if param_key(p) in params or p['name'] in params]
+    return data
+
+
+
+
+# Available storage backends. Each backend has a file extension, a save and a load function
+# and a write function writing to an open file (used by save_atomic).
+# load functions take the optional arguments stations and params.
+STORAGE_BACKENDS = {
+    'json': {'extension': '.txt', 'save': save_dict, 'write': write_dict, 'load': load_MESAN_json},
+    'npz': {'extension': '.npz', 'save': save_MESAN_npz, 'write': write_MESAN_npz, 'load': load_MESAN_npz},
+}
+
+
+
+
+# Get storage backend by name.
+# @params name: 'json' or 'npz'.
+# @returns backend dict, None if no such backend exists.
+def get_backend(name):
+    try:
+        return STORAGE_BACKENDS[name]
+    except KeyError:
+        print('get_backend() >>> No storage backend named \'' + name + '\'.')
+        return None
+
+
+
+
+# Load a recorded MESAN file with the backend matching its file extension.
+# @params filename: Name of recorded file (.txt or .npz).
+#         stations: optional, list of station ids to load. Default is all.
+#         params: optional, list of parameters to load. Default is all.
+# @returns data: Dict on recorded format.
+def load_MESAN(filename, stations=None, params=None):
+    extension = os.path.splitext(filename)[1]
+    for name in STORAGE_BACKENDS:
+        if STORAGE_BACKENDS[name]['extension'] == extension:
+            return STORAGE_BACKENDS[name]['load'](filename, stations=stations, params=params)
+    print('load_MESAN() >>> Unknown file type: ' + filename)
+    return None
+
+
+
+
+# Find recorded day files in a directory.
+# If a day exists both as .txt and .npz, the .npz file is used.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+# @returns dict with day as key and filename as value, ex. {'2020-11-12': 'MESAN_RECORDED/MESAN_2020-11-12.npz'}
+def list_day_files(directory):
+    day_files = {}
+    for file in os.listdir(directory):
+        if not file.startswith('MESAN_'):
+            continue
+        day, extension = os.path.splitext(file[len('MESAN_'):])
+        if extension == '.npz' or (extension == '.txt' and day not in day_files):
+            day_files[day] = directory + file
+    return day_files
+
+
+
+
+# Convert all recorded MESAN files in a directory from one backend to another.
+# Files already converted are skipped.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         source: name of backend to convert from. Default 'json'.
+#         target: name of backend to convert to. Default 'npz'.
+#         remove: If True, source files are removed after conversion.
+# @returns list of written files.
+def convert_MESAN_archive(directory, source='json', target='npz', remove=False):
+    src = get_backend(source)
+    dst = get_backend(target)
+    if src is None or dst is None:
+        return []
+
+    written = []
+    for file in sorted(os.listdir(directory)):
+        if not (file.startswith('MESAN_') and file.endswith(src['extension'])):
+            continue
+        new_file = file[:-len(src['extension'])] + dst['extension']
+        if os.path.isfile(directory + new_file):
+            print('convert_MESAN_archive() >>> ' + new_file + ' exists. Skipping.')
+            continue
+
+        print('convert_MESAN_archive() >>> Converting ' + file + ' to ' + new_file + '.')
+        if not save_atomic(dst['write'], src['load'](directory + file), directory + new_file):
+            continue
+        written.append(new_file)
+        if remove:
+            os.remove(directory + file)
+
+    return written
+
+
+
+
+# ========== INCREMENTAL WRITING ==========
+# New frames are appended to a per-day segment file instead of rewriting day files.
+# Each segment (segments/MESAN_YYYY-MM-DD.seg) holds one JSON record per line:
+# {"station": id, "validTime": ts, "parameters": [...]}
+# The first record of a station for a day also holds its station data under "meta".
+# An index (segments/MESAN_YYYY-MM-DD.idx) holds all (station, validTime) pairs
+# that exist for the day, either in the day file or in the segment, one pair per line.
+# New pairs are appended together with the segment records.
+# compact_segments() merges segments into the final day files.
+
+SEGMENT_DIR = 'segments/'
+
+
+
+
+# Get path of segment file for a day.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         day: day as a string, ex. '2020-11-12'.
+# @returns path as a string.
+def segment_file(directory, day):
+    return directory + SEGMENT_DIR + 'MESAN_' + day + '.seg'
+
+
+
+
+# Get path of index file for a day.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         day: day as a string, ex. '2020-11-12'.
+# @returns path as a string.
+def index_file(directory, day):
+    return directory + SEGMENT_DIR + 'MESAN_' + day + '.idx'
+
+
+
+
+# Write a file by first writing a temporary file and then renaming it.
+# The file is only replaced when the write succeeded, so an interrupted or failed
+# write never leaves a truncated file behind.
+# @params write: function taking data and a file opened for binary writing, ex. write_dict.
+#         data: data to be saved.
+#         filename: Name of saved file.
+# @returns True if the file was written, otherwise False.
+def save_atomic(write, data, filename):
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            write(data, f)
+        os.replace(tmp_filename, filename)
+    except (OSError, ValueError, TypeError) as e:
+        print('save_atomic() >>> Could not save ' + filename + ': ' + str(e))
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+    return True
+
+
+
+
+# Append lines to a text file. If the file ends with a partially written line
+# from an interrupted run, the new lines start on a line of their own.
+# @params filename: Name of file.
+#         lines: list of strings ending with a newline.
+# @returns None.
+def append_lines(filename, lines):
+    with open(filename, 'a+b') as f:
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(''.join(lines).encode('utf8'))
+
+
+
+
+# Load the set of (station, validTime) pairs existing for a day.
+# The index holds one JSON pair per line: ["station", "validTime"].
+# If no index exists it is built from the day file, if there is one.
+# @params directory: Directory containing recorded files.
+#         day: day as a string, ex. '2020-11-12'.
+#         backend: storage backend of day files.
+# @returns set of (station, validTime) tuples.
+def load_day_index(directory, day, backend):
+    pairs = set()
+    if os.path.isfile(index_file(directory, day)):
+        with open(index_file(directory, day), 'r', encoding='utf8') as f:
+            for line in f:
+                # Skip a partially written last line from an interrupted run.
+                try:
+                    s, ts = json.loads(line)
+                except (json.JSONDecodeError, ValueError, TypeError):
+                    continue
+                pairs.add((s, ts))
+    else:
+        day_file = directory + 'MESAN_' + day + backend['extension']
+        if os.path.isfile(day_file):
+            day_data = backend['load'](day_file)
+            for s in day_data:
+                for ts in day_data[s]['frames']:
+                    pairs.add((s, ts))
+    return pairs
+
+
+
+
+# Add (station, validTime) pairs to the index of a day. Only the new pairs are written.
+# @params directory: Directory containing recorded files.
+#         day: day as a string, ex. '2020-11-12'.
+#         pairs: iterable of (station, validTime) tuples.
+# @returns None.
+def append_day_index(directory, day, pairs):
+    append_lines(index_file(directory, day), [json.dumps([s, ts], ensure_ascii=False) + '\n' for s, ts in pairs])
+
+
+
+
+# Append frames not already recorded to the segment files of their days.
+# Day files are never touched.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         data: Dictionary on recorded format, may span several days.
+#         backend: storage backend of day files.
+# @returns dict with number of appended frames per day, ex. {'2020-11-12': 456}.
+def append_frames(directory, data, backend):
+    if not os.path.isdir(directory + SEGMENT_DIR):
+        os.makedirs(directory + SEGMENT_DIR)
+
+    # Group frames by day.
+    days = {}
+    for s in data:
+        for ts in data[s]['frames']:
+            days.setdefault(hour_to_day(ts_to_hour(ts)), []).append((s, ts))
+
+    appended = {}
+    for day in sorted(days):
+        # An index built from the day file is written in full with the first new frames.
+        new_index = not os.path.isfile(index_file(directory, day))
+        pairs = load_day_index(directory, day, backend)
+        stations_seen = set(s for s, ts in pairs)
+
+        lines = []
+        new_pairs = []
+        for s, ts in days[day]:
+            # Do not overwrite old data.
+            if (s, ts) in pairs:
+                continue
+
+            record = {'station': s, 'validTime': ts, 'parameters': data[s]['frames'][ts]['parameters']}
+            if s not in stations_seen:
+                record['meta'] = {k: data[s][k] for k in data[s] if k != 'frames'}
+                stations_seen.add(s)
+            lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+            pairs.add((s, ts))
+            new_pairs.append((s, ts))
+
+        # Unchanged days are not touched.
+        n = len(lines)
+        if n > 0:
+            append_lines(segment_file(directory, day), lines)
+            append_day_index(directory, day, sorted(pairs) if new_index else new_pairs)
+        appended[day] = n
+
+    return appended
+
+
+
+
+# Merge the segment of a day into its day file and remove the segment and its index.
+# Frames already in the day file are kept. If the day file cannot be written the
+# segment is kept.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         day: day as a string, ex. '2020-11-12'.
+#         backend: storage backend of day files.
+# @returns True if the day was compacted, otherwise False.
+def compact_day(directory, day, backend):
+    day_file = directory + 'MESAN_' + day + backend['extension']
+    if os.path.isfile(day_file):
+        day_data = backend['load'](day_file)
+    else:
+        day_data = {}
+
+    with open(segment_file(directory, day), 'r', encoding='utf8') as f:
+        for line in f:
+            # Skip a partially written last line from an interrupted run.
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            s = record['station']
+            if s not in day_data:
+                day_data[s] = dict(record.get('meta', {}))
+                day_data[s]['frames'] = {}
+            if record['validTime'] not in day_data[s]['frames']:
+                day_data[s]['frames'][record['validTime']] = {'parameters': record['parameters']}
+
+    # Frames chronologically.
+    for s in day_data:
+        frames = day_data[s]['frames']
+        day_data[s]['frames'] = {ts: frames[ts] for ts in sort_timestamps(frames)}
+
+    if not save_atomic(backend['write'], day_data, day_file):
+        return False
+    # The day file holds all frames now, a later index is built from it.
+    os.remove(segment_file(directory, day))
+    if os.path.isfile(index_file(directory, day)):
+        os.remove(index_file(directory, day))
+    return True
+
+
+
+
+# Compact segments that will not receive more data into day files.
+# A day is compacted when every station in it has all 24 hours, or when it is
+# older than before_day.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         backend: storage backend of day files.
+#         before_day: optional, days before this day (string, ex. '2020-11-12') are compacted.
+#         compact_all: If True, all segments are compacted.
+# @returns list of compacted days.
+def compact_segments(directory, backend, before_day=None, compact_all=False):
+    if not os.path.isdir(directory + SEGMENT_DIR):
+        return []
+
+    compacted = []
+    for file in sorted(os.listdir(directory + SEGMENT_DIR)):
+        if not file.endswith('.seg'):
+            continue
+        day = file.split('_')[1].split('.')[0]
+
+        if compact_all or (before_day is not None and day < before_day):
+            compact = True
+        else:
+            # Check if day is complete.
+            hours = {}
+            for s, ts in load_day_index(directory, day, backend):
+                hours[s] = hours.get(s, 0) + 1
+            compact = len(hours) > 0 and min(hours.values()) == 24
+
+        if compact:
+            print('compact_segments() >>> Writing MESAN_' + day + backend['extension'] + '.')
+            if compact_day(directory, day, backend):
+                compacted.append(day)
+
+    return compacted
@@ -0,0 +1,179 @@
+# This script contains functions validating recorded MESAN day files.
+#
+# Every day file is loaded once into MESANFrames and turned into a presence
+# bitmap with shape (stations, 24, parameters). All checks are done on the
+# bitmap, so the cost is linear in the size of the archive. Only one day is
+# held in memory at a time.
+#
+# summary = validate_MESAN_archive('MESAN_RECORDED/')
+# summary['complete'] is True if no problems were found in any day.
+
+
+
+
+import os
+import json
+import numpy as np
+from MESAN_frames import *
+from MESAN_storage import *
+
+
+
+
+# Load a JSON day file and find duplicated frames, i.e. validTimes recorded twice for a station.
+# json.load keeps only the last of duplicated keys, so they are collected while parsing.
+# Only keys of frames (values holding 'parameters') are checked.
+# @params filename: Name of JSON day file.
+# @returns data: Dict on recorded format.
+#          duplicates: list of validTimes of duplicated frames.
+def load_MESAN_json_duplicates(filename):
+    duplicates = []
+
+    def hook(pairs):
+        keys = set()
+        for k, v in pairs:
+            if not (isinstance(v, dict) and 'parameters' in v):
+                continue
+            if k in keys:
+                duplicates.append(k)
+            keys.add(k)
+        return dict(pairs)
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = json.load(f, object_pairs_hook=hook)
+    return data, duplicates
+
+
+
+
+# Load a recorded MESAN day file as MESANFrames.
+# @params filename: Name of day file (.txt or .npz).
+# @returns frames: MESANFrames.
+#          duplicates: list of validTimes of duplicated frames. Always empty for .npz files.
+def load_MESAN_day(filename):
+    if filename.endswith('.npz'):
+        return load_MESAN_frames(filename), []
+    data, duplicates = load_MESAN_json_duplicates(filename)
+    return MESANFrames.from_dict(data), duplicates
+
+
+
+
+# Build presence bitmaps for one day.
+# @params frames: MESANFrames with data for the day.
+#         day: day as a string, ex. '2020-11-12'.
+# @returns hours: bool array (stations, 24), True if station has a frame for the hour.
+#          present: bool array (stations, 24, parameters), True if the value exists.
+#          misplaced: number of timestamps not belonging to day.
+def presence_bitmap(frames, day):
+    index = parse_timestamps(frames.times)
+    in_day = (index // 24) == (day_to_hour(day) // 24)
+    hour = index % 24
+
+    n_stations = len(frames.stations)
+    n_params = len(frames.parameters)
+    hours = np.zeros((n_stations, 24), dtype=np.bool_)
+    present = np.zeros((n_stations, 24, n_params), dtype=np.bool_)
+    if in_day.any():
+        hours[:, hour[in_day]] = frames.frames[:, in_day]
+        present[:, hour[in_day]] = frames.frames[:, in_day, None] & ~np.isnan(frames.values[:, in_day])
+
+    return hours, present, int((~in_day).sum())
+
+
+
+
+# Validate one recorded MESAN day file.
+# @params filename: Name of day file (.txt or .npz).
+#         day: day as a string, ex. '2020-11-12'.
+#         prev_params: optional, list of parameter keys of the previous day. Used to find parameter drift.
+# @returns result: dict with results for the day.
+#          keys: list of parameter keys of the day.
+def validate_MESAN_day(filename, day, prev_params=None):
+    frames, duplicates = load_MESAN_day(filename)
+    return validate_MESAN_frames(frames, day, duplicates, prev_params, filename)
+
+
+
+
+# Validate one day of recorded MESAN data already loaded, see load_MESAN_day.
+# @params frames: MESANFrames with data for the day.
+#         day: day as a string, ex. '2020-11-12'.
+#         duplicates: optional, list of validTimes of duplicated frames.
+#         prev_params: optional, list of parameter keys of the previous day. Used to find parameter drift.
+#         filename: optional, name of day file, included in the result.
+# @returns result: dict with results for the day.
+#          keys: list of parameter keys of the day.
+def validate_MESAN_frames(frames, day, duplicates=None, prev_params=None, filename=''):
+    if duplicates is None:
+        duplicates = []
+    hours, present, misplaced = presence_bitmap(frames, day)
+    keys = [p['key'] for p in frames.parameters]
+    station_ids = [s.id for s in frames.stations]
+
+    # Missing hours per station.
+    missing_hours = {}
+    for i in np.nonzero(~hours.all(axis=1))[0]:
+        missing_hours[station_ids[i]] = np.nonzero(~hours[i])[0].tolist()
+
+    # Missing values per parameter in existing frames.
+    missing_values = (hours[:, :, None] & ~present).sum(axis=(0, 1))
+    incomplete_params = {}
+    for k in np.nonzero(missing_values)[0]:
+        incomplete_params[keys[k]] = int(missing_values[k])
+
+    result = {'file': os.path.basename(filename),
+              'stations': len(station_ids),
+              'hours': int(hours.any(axis=0).sum()),
+              'parameters': len(keys),
+              'missing_hours': missing_hours,
+              'duplicate_frames': duplicates,
+              'misplaced_frames': misplaced,
+              'incomplete_parameters': incomplete_params,
+              'parameters_added': [],
+              'parameters_removed': []}
+    if prev_params is not None:
+        result['parameters_added'] = [k for k in keys if k not in prev_params]
+        result['parameters_removed'] = [k for k in prev_params if k not in keys]
+
+    result['complete'] = (not missing_hours and not duplicates and misplaced == 0 and
+                          not incomplete_params and not result['parameters_added'] and
+                          not result['parameters_removed'])
+    return result, keys
+
+
+
+
+# Validate all recorded MESAN day files in a directory.
+# If a day exists both as .txt and .npz, the .npz file is used.
+# @params directory: Directory containing recorded files, ex. 'MESAN_RECORDED/'.
+#         summary_file: optional, name of file to write summary to as JSON.
+# @returns summary: dict with results per day, missing days and overall 'complete' flag.
+def validate_MESAN_archive(directory, summary_file=None):
+
+    day_files = list_day_files(directory)
+
+    summary = {'directory': directory, 'days': {}, 'missing_days': [], 'complete': True}
+    days = sorted(day_files)
+    prev_params = None
+    for day in days:
+        print('validate_MESAN_archive() >>> Checking ' + os.path.basename(day_files[day]) + '.')
+        result, prev_params = validate_MESAN_day(day_files[day], day, prev_params)
+        summary['days'][day] = result
+        if not result['complete']:
+            summary['complete'] = False
+
+    # Find days without file between first and last day.
+    if days:
+        for hour in range(day_to_hour(days[0]), day_to_hour(days[-1]) + 24, 24):
+            day = hour_to_day(hour)
+            if day not in day_files:
+                summary['missing_days'].append(day)
+    if summary['missing_days']:
+        summary['complete'] = False
+
+    if summary_file is not None:
+        with open(summary_file, 'w', encoding='utf8') as f:
+            f.write(json.dumps(summary, indent=4, ensure_ascii=False))
+
+    return summary
@@ -3,9 +3,17 @@
 
 
 
+import os
+import sys
 import json
+import hashlib
 import requests
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from timestamp_index import *
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from web_utils import *
 
 
 
@@ -73,35 +81,108 @@ def sort_by_list(X, Y):
 
 
 
+# ========== DISK CACHE ==========
+# Responses from get_from_api can be kept on disk, so repeated queries are read
+# locally and work offline (see DiskCache in Common/web_utils.py).
+# API_CACHE.info() gives hits, misses and size, API_CACHE.clear() removes all entries.
+
+API_CACHE = DiskCache('API_CACHE/')
+
+
+
+
+# Save a json object to a file without formatting. Used for cache entries.
+# @params data: json object.
+#         filename: Name of saved file.
+# @returns None.
+def save_json(data, filename):
+    with open(filename, 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+
+
 # Tries to access an url for json object data.
-# @params data: Dictionary to be saved.
+# @params url: url to be accessed.
+#         session: optional, requests.Session to reuse keep-alive connections.
+#         cache: optional, if True the response is read through the disk cache.
+#         max_age: optional, maximum age in seconds of a cached response. None if it never expires.
 # @returns Dictionary of json object.
-def get_from_api(url):
+def get_from_api(url, session=None, cache=False, max_age=None):
+
+    if cache:
+        key = 'API_' + hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+        filename = API_CACHE.get(key, max_age)
+        if filename is not None:
+            return load_dict(filename)
 
     try:
         # Try accessing API.
-        r = requests.get(url)
+        if session is None:
+            r = requests.get(url)
+        else:
+            r = session.get(url)
+        # Error responses are neither cached nor returned, even if the body is JSON.
+        r.raise_for_status()
     except requests.exceptions.RequestException as e:
         # If accessing API fails
         print('get_from_api() >>> Request failed.\n' + str(e.__str__()))
+
+        # Use expired data rather than nothing, ex. when offline.
+        if cache and API_CACHE.get_expired(key) is not None:
+            print('get_from_api() >>> Using expired cached data.')
+            return load_dict(API_CACHE.get_expired(key))
         return None
 
     # This is necessary if returned data is not JSON format.
     try:
-        return r.json()
+        data = r.json()
     except json.JSONDecodeError:
         print('get_from_api() >>> Data is not in JSON format.')
         print(r.text)
         return None
 
+    if cache:
+        API_CACHE.put(key, save_json, data)
+    return data
+
+
+
+
+# Access several urls concurrently for json object data.
+# At most max_workers requests are in flight at the same time and every
+# worker thread reuses its own keep-alive session. The sessions are closed when done.
+# @params urls: list of urls to be accessed.
+#         max_workers: concurrency cap, number of simultaneous requests.
+# @returns list of json objects in the same order as urls. None for failed requests.
+def get_many_from_api(urls, max_workers=16):
+
+    with ThreadSessions() as sessions:
+        if max_workers <= 1:
+            session = sessions.get()
+            return [get_from_api(url, session) for url in urls]
+
+        def fetch(url):
+            return get_from_api(url, sessions.get())
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(fetch, urls))
+
 
 
 # Convert historic json LANTMET data to list of observations.
-# @params data: Dictionary to be saved.
+# @params data: list of observations as given from the API, or columns as returned from stream_LANTMET.
 #         params: optional, parameters to be included. Default is all.
 # @returns Dictionary containing list of measurements.
 def LANTMET_to_lists(data):
 
+    # Columns from stream_LANTMET.
+    if isinstance(data, dict):
+        list_data = {'startTime': data['startTime'], 'endTime': data['endTime']}
+        for i, name in enumerate(data['params']):
+            list_data[name] = data['value'][data['param'] == i].tolist()
+        return list_data
+
     list_data = {'startTime': None, 'endTime': None}
     list_data['startTime'] = data[0]['timeMeasured']
     list_data['endTime'] = data[-1]['timeMeasured']
@@ -174,17 +255,57 @@ def MESAN_to_lists(data):
 #         end_date: as a string.
 #         startTime: as a string, ex. '08'
 #         endTime: as a string.
+#         columns: optional, if True the response is streamed into typed columns (see stream_LANTMET)
+#                  instead of being returned as a list of observations.
+#         cache: optional, if True the response is read through the disk cache (see get_from_api).
+#                Only used if columns is False.
 # @returns dictionary with parameters for the specified station between given dates
-def get_LANTMET_data_station(stationId,startDate,endDate,startTime,endTime): 
+def get_LANTMET_data_station(stationId,startDate,endDate,startTime,endTime,columns=False,cache=False): 
     
     url_lantmet = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm?weatherStationID='+stationId+'&startDate='+startDate+'&endDate='+endDate+'&startTime='+startTime+'&endTime='+endTime
-    data_lantmet = get_from_api(url_lantmet) 
+    if columns:
+        return stream_LANTMET(url_lantmet)
+    if not cache:
+        return get_from_api(url_lantmet)
+    data_lantmet = get_from_api(url_lantmet, cache=True, max_age=API_CACHE.max_age(endDate))
     
     return data_lantmet
 
 
 
 
+# Group historic json LANTMET observations into frames in one pass.
+# @params param_data: list of observations as given from the API (returned from get_LANTMET_data_station).
+# @returns frames dictionary, chronologically sorted, on the same form as sampled MESAN data.
+#          {validTime: {'parameters': [{'name': ..., 'logIntervalId': ..., 'values': [...]}, ...]}, ...}
+def LANTMET_frames(param_data):
+
+    # Group observations by timestamp. Observations keep their order within each timestamp.
+    # Minutes and seconds are kept, so sub-hourly observations get frames of their own.
+    grouped = {}
+    for e in param_data:
+        # Convert time format from '+01:00' to 'Z'.
+        ts = e['timeMeasured'][:19] + 'Z'
+
+        # Make temporary dictionary. This will become the elements under 'parameters'.
+        tmp_dict = {}
+        tmp_dict['name'] = e['elementMeasurementTypeId']
+        tmp_dict['logIntervalId'] = e['logIntervalId']
+        tmp_dict['values'] = [e['value']]
+
+        if ts not in grouped:
+            grouped[ts] = []
+        grouped[ts].append(tmp_dict)
+
+    # Add frames from earliest to latest. Timestamps of the same format sort chronologically as strings.
+    frames = {}
+    for ts in sorted(grouped):
+        frames[ts] = {'parameters': grouped[ts]}
+    return frames
+
+
+
+
 # Create a new dictionary for historic json LANTMET for ONE STATION between start date/time and end date/time.
 # OBS. The format of the dictionary is the same as for sampled MESAN data.
 # @params station: station data as given from the API (returned form get_LANTMET_data_station)
@@ -211,41 +332,11 @@ def LANTMET_dict(station,startDate,endDate,startTime,endTime):
 
     # Get parameter data.
     param_data = get_LANTMET_data_station(station_id,startDate,endDate,startTime,endTime)
+    if not param_data:
+        print('LANTMET_dict() >>> No data for station ' + station_id + '.')
+        return new_data[station_id]
 
-    # Collect all timestamps and sort from earliest to latest.
-    timestamps = {}
-    for e in param_data:
-        # Convert time format from '+01:00' to 'Z'.
-        timestamps[e['timeMeasured'].split('+')[0] + 'Z'] = None
-
-    timestamps = list(timestamps.keys())
-
-    # Need list of datetime representations of timestamps in order to compare chronologically and sort.
-    dt_timestamps = []
-    for ts in timestamps:
-        dt_timestamps.append(ts_to_datetime(ts))
-
-    # Sort string timestamps based on how dt_timestamps would be sorted.
-    timestamps = sort_by_list(timestamps, dt_timestamps)
-
-    # Now we have sorted string timestamps. Loop over these and find corresponding measurements.
-    for ts in timestamps:
-
-        new_data[station_id]['frames'][ts] = {'parameters': []}
-
-        for e in param_data:
-
-            # Skip observations not made on this timestamp.
-            e_timestamp = e['timeMeasured'].split('+')[0] + 'Z'
-            if e_timestamp != ts:
-                continue
-
-            # Make temporary dictionary. This will become the elements under 'parameters'.
-            tmp_dict = {}
-            tmp_dict['name'] = e['elementMeasurementTypeId']
-            tmp_dict['logIntervalId'] = e['logIntervalId']
-            tmp_dict['values'] = [e['value']]
-            new_data[station_id]['frames'][ts]['parameters'].append(tmp_dict)
+    new_data[station_id]['frames'] = LANTMET_frames(param_data)
             
     return new_data[station_id]
 
@@ -267,12 +358,51 @@ def get_LANTMET_data(startDate,endDate,startTime,endTime):
     new_data_stations = {}
     for station in stations:
         new_data_stations[station['weatherStationId']] = LANTMET_dict(station,startDate,endDate,startTime,endTime)
-        # Remove this printing later
-        print_dict(new_data_stations)
+        print('get_LANTMET_data() >>> Collected LANTMET data for station: ' + str(station['weatherStationId']) + '.')
     return new_data_stations
 
 
 
+
+# Save historic json LANTMET data for ALL stations between start date/time and end date/time to a file.
+# Each station is written to the file as soon as it has been collected, so only one station
+# is held in memory at a time. The file has the same content as the dict returned from
+# get_LANTMET_data and can be read with load_dict.
+# @params filename: Name of saved file.
+#         startDate: as a string, ex. '2020-01-02'.
+#         endDate: as a string.
+#         startTime: as a string, ex. '08'
+#         endTime: as a string.
+# @returns number of stations written.
+def save_LANTMET_data(filename,startDate,endDate,startTime,endTime):
+    stations_url = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm?'
+
+    # Get list of all stations.
+    stations = get_from_api(stations_url)
+    if not stations:
+        print('save_LANTMET_data() >>> No stations found.')
+        return 0
+
+    # Write to a temporary file which replaces filename when all stations are written.
+    tmp_filename = filename + '.tmp'
+    n = 0
+    with open(tmp_filename, 'w', encoding='utf8') as f:
+        f.write('{')
+        for station in stations:
+            station_data = LANTMET_dict(station,startDate,endDate,startTime,endTime)
+            if n > 0:
+                f.write(',')
+            f.write('\n' + json.dumps(str(station['weatherStationId'])) + ': ')
+            f.write(json.dumps(station_data, ensure_ascii=False))
+            n = n + 1
+            print('save_LANTMET_data() >>> Saved LANTMET data for station: ' + str(station['weatherStationId']) + '.')
+        f.write('\n}')
+    os.replace(tmp_filename, filename)
+
+    return n
+
+
+
 # Find all unique timestamps in recorded MESAN data.
 # @params data: data to be checked.
 # @returns list of timestamps.
@@ -0,0 +1,95 @@
+from METCOMP_utils import *
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import time
+
+
+# Checks fetching of MESAN points and the per-thread sessions of web_utils.py against a local
+# stub of the SMHI point API instead of SMHI.
+# Run from Sampling/. MESAN_Recording.py can be run against the same kind of server by
+# setting SMHI_URL, ex. SMHI_URL='http://127.0.0.1:8000/lon/{lon}/lat/{lat}/data.json'.
+
+
+
+
+# Stub of the SMHI point API. Every point is answered with a json object holding its coordinates.
+# Points with lon 0 get a server error and points with lon 1 get a body which is not json.
+# Answers are delayed more for points with low lon, so concurrent requests finish out of order.
+# The client port of every request is kept in ports, one port per connection.
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ports = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        StubHandler.ports.append(self.client_address[1])
+        parts = self.path.strip('/').split('/')
+        lon = int(parts[1])
+        lat = int(parts[3])
+        time.sleep((40 - lon)*0.002)
+
+        status = 200
+        body = json.dumps({'lon': lon, 'lat': lat})
+        if lon == 0:
+            status = 500
+            body = json.dumps({'error': 'Internal Server Error'})
+        elif lon == 1:
+            body = '<html>Not json</html>'
+
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/lon/{lon}/lat/{lat}/data.json'
+
+# One url per station, as in MESAN_Recording.py. Two stations fail.
+points = [(lon, 60 + lon % 3) for lon in range(2, 40)]
+points.insert(5, (0, 61))
+points.insert(17, (1, 62))
+urls = [url.replace('{lon}', str(lon)).replace('{lat}', str(lat)) for lon, lat in points]
+expected = [None if lon in (0, 1) else {'lon': lon, 'lat': lat} for lon, lat in points]
+
+# CHECK THAT RESPONSES KEEP THE ORDER OF URLS AND FAILED REQUESTS GIVE None
+for max_workers in (1, 16):
+    responses = get_many_from_api(urls, max_workers=max_workers)
+    if responses == expected:
+        print('get_many_from_api() with ' + str(max_workers) + ' workers is correct.')
+    else:
+        print('get_many_from_api() with ' + str(max_workers) + ' workers is NOT correct.')
+
+# CHECK THAT EVERY THREAD KEEPS ITS OWN SESSION AND CONNECTION UNTIL close_sessions
+sessions = {}
+
+# Fetch two points with the session of the calling thread.
+# @params name: name the sessions and the number of connections used are kept under in sessions.
+def fetch(name):
+    sessions[name] = [get_session(), get_session()]
+    StubHandler.ports.clear()
+    get_from_api(urls[0], sessions[name][0])
+    get_from_api(urls[1], sessions[name][1])
+    sessions[name].append(len(set(StubHandler.ports)))
+
+fetch('main')
+worker = threading.Thread(target=fetch, args=('worker',))
+worker.start()
+worker.join()
+reused = sessions['main'][0] is sessions['main'][1] and sessions['main'][2] == 1
+separate = sessions['main'][0] is not sessions['worker'][0]
+
+close_sessions()
+closed = len(sessions['main'][0].get_adapter(url).poolmanager.pools) == 0 and get_session() is not sessions['main'][0]
+if reused and separate and closed:
+    print('get_session() and close_sessions() are correct.')
+else:
+    print('get_session() and close_sessions() are NOT correct.')
+
+server.shutdown()
@@ -1,4 +1,5 @@
 from METCOMP_utils import *
+from MESAN_validation import *
 import os
 
 
@@ -22,28 +23,16 @@ def get_timestamps(data):
 # @params data: Data to be checked.
 # @returns bool: True if all hours are logged for each stations. Otherwise false.
 def check_if_complete(data):
-    for s in data:
-
-        # Create list of timestamps as reference.
-        timestamps_ref = []
-        for i in range(0, 23):
-            hour_str = ''
-            if i < 10:
-                hour_str = '0' + str(i)
-            else:
-                hour_str = str(i)
-            tmp_str = '2020-11-11T' + hour_str + ':00:00Z'
-            timestamps_ref.append(tmp_str)
-
-        # Find all timestamps.
-        timestamps = list(data[s]['frames'].keys())
 
-        print(timestamps_ref)
-        print(timestamps)
-        quit()
+    # Day of data is given by the earliest timestamp.
+    frames = MESANFrames.from_dict(data)
+    if not frames.times:
+        return False
+    day = hour_to_day(ts_to_hour(frames.times[0]))
 
-
-        # Check if all timestamps exist.
+    # Check if all timestamps exist.
+    hours, present, misplaced = presence_bitmap(frames, day)
+    return bool(hours.all()) and misplaced == 0
 
 
 
@@ -62,23 +51,20 @@ else:
 directory = 'MESAN_RECORDED/'
 
 files = []
-for r, d, f in os.walk(dir):
+for r, d, f in os.walk(directory):
     for file in f:
         if '.txt' in file:
             files.append(file)
 
 days = []
-dt_days = []
 for file in files:
     day = file.split('_')[1].split('.')[0]
     days.append(day)
 
-    dt_days.append(datetime.strptime(day, '%Y-%m-%d'))
-
-days = sort_by_list(days, dt_days)
+days = sorted(days, key=day_to_hour)
 latest_file = 'MESAN_' + days[-1] + '.txt'
 
-data = load_dict(dir + latest_file)
+data = load_dict(directory + latest_file)
 
 timestamps = get_timestamps(data)
 
@@ -0,0 +1,37 @@
+from MESAN_validation import *
+import sys
+
+# Validates all recorded MESAN day files in MESAN_RECORDED/.
+# Writes a summary as JSON and exits with status 1 if any day is incomplete,
+# so the script can be used to gate the pipeline.
+# Usage: python Validate_MESAN_archive.py [summary_file]
+
+directory = 'MESAN_RECORDED/'
+summary_file = 'MESAN_validation.json'
+if len(sys.argv) > 1:
+    summary_file = sys.argv[1]
+
+summary = validate_MESAN_archive(directory, summary_file)
+
+for day in summary['days']:
+    result = summary['days'][day]
+    if result['complete']:
+        continue
+    print(day + ': ' + str(len(result['missing_hours'])) + ' stations missing hours, ' +
+          str(len(result['duplicate_frames'])) + ' duplicate frames, ' +
+          str(result['misplaced_frames']) + ' misplaced frames, ' +
+          str(len(result['incomplete_parameters'])) + ' incomplete parameters, ' +
+          str(len(result['parameters_added'])) + ' parameters added, ' +
+          str(len(result['parameters_removed'])) + ' parameters removed.')
+
+if summary['missing_days']:
+    print('Missing days:')
+    for day in summary['missing_days']:
+        print(day)
+
+if summary['complete']:
+    print('All ' + str(len(summary['days'])) + ' days are complete.')
+    sys.exit(0)
+else:
+    print('Archive is not complete. See ' + summary_file + '.')
+    sys.exit(1)
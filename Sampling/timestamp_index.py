@@ -0,0 +1,98 @@
+# This script contains a shared timestamp index.
+#
+# Every timestamp is mapped once to an integer, the number of hours since
+# 1970-01-01T00:00:00. Sorting, grouping and comparing timestamps can then be
+# done on integers instead of reparsing strings.
+#
+# Both MESAN ('2020-11-12T05:00:00Z') and LantMet ('2020-11-12T05:00:00+01:00')
+# timestamps are accepted. As before, the UTC offset of LantMet timestamps is
+# ignored, i.e. '2020-11-12T05:00:00+01:00' gets the same index as
+# '2020-11-12T05:00:00Z'.
+#
+# ts_to_hour('2020-11-12T05:00:00Z')   -> 445877
+# hour_to_ts(445877)                   -> '2020-11-12T05:00:00Z'
+# hour_to_day(445877)                  -> '2020-11-12'
+
+
+
+
+import numpy as np
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+
+
+
+EPOCH = datetime(1970, 1, 1)
+CACHE_SIZE = 65536
+
+
+
+
+# Convert string timestamp to hour index. Results are cached.
+# @params timestamp: string timestamp (YYYY-MM-DDTHH:MM:SSZ or YYYY-MM-DDTHH:MM:SS+01:00).
+# @returns hour index as an int.
+@lru_cache(maxsize=CACHE_SIZE)
+def ts_to_hour(timestamp):
+    dt = datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]), int(timestamp[11:13]))
+    return (dt - EPOCH) // timedelta(hours=1)
+
+
+
+
+# Convert hour index to string timestamp. Results are cached.
+# @params hour: hour index as an int.
+# @returns string timestamp (YYYY-MM-DDTHH:MM:SSZ).
+@lru_cache(maxsize=CACHE_SIZE)
+def hour_to_ts(hour):
+    return (EPOCH + timedelta(hours=int(hour))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+
+
+# Convert hour index to day string. Results are cached.
+# @params hour: hour index as an int.
+# @returns day as a string, ex. '2020-11-12'.
+@lru_cache(maxsize=CACHE_SIZE)
+def hour_to_day(hour):
+    return (EPOCH + timedelta(days=int(hour) // 24)).strftime('%Y-%m-%d')
+
+
+
+
+# Convert day string to hour index of its first hour. Results are cached.
+# @params day: day as a string, ex. '2020-11-12'.
+# @returns hour index as an int.
+@lru_cache(maxsize=CACHE_SIZE)
+def day_to_hour(day):
+    return ts_to_hour(day + 'T00:00:00Z')
+
+
+
+
+# Convert many string timestamps to hour indices at once.
+# @params timestamps: list or array of string timestamps.
+# @returns int64 array of hour indices.
+def parse_timestamps(timestamps):
+    # Truncating to 19 characters removes 'Z' and UTC offsets.
+    arr = np.asarray(timestamps, dtype='U19')
+    return arr.astype('datetime64[h]').astype(np.int64)
+
+
+
+
+# Convert many hour indices to string timestamps at once.
+# @params hours: list or array of hour indices.
+# @returns array of string timestamps (YYYY-MM-DDTHH:MM:SSZ).
+def format_timestamps(hours):
+    arr = np.asarray(hours, dtype=np.int64).astype('datetime64[h]')
+    return np.char.add(np.datetime_as_string(arr, unit='s'), 'Z')
+
+
+
+
+# Sort string timestamps chronologically.
+# @params timestamps: list of string timestamps.
+# @returns sorted list of string timestamps.
+def sort_timestamps(timestamps):
+    return sorted(timestamps, key=ts_to_hour)
@@ -1,12 +1,145 @@
 import os
+import sys
+import json
+import bisect
+import time
 import datetime
 import requests
+import zipfile
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from web_utils import *
+
+
+
+
+# Used if folder is a string to translate to boolean.
+trans_dict = {'MESAN_CSV': True,
+              'MESAN': True,
+              'LANTMET_CSV': False,
+              'LANTMET': False}
+
+# Directories of day CSV files and of the consolidated store for each data source.
+CSV_DIRS = {True: 'MESAN_CSV/', False: 'LANTMET_CSV/'}
+STORE_DIRS = {True: 'MESAN_STORE/', False: 'LANTMET_STORE/'}
+PREFIXES = {True: 'MESAN_', False: 'LANTMET_'}
+
+# Column types used when reading typed data (see read_CSV). Timestamp is parsed to datetime64.
+# Parameters are read as float32, which keeps all digits of observed values, except
+# where more significant digits are needed. Numeric columns not listed are read as DEFAULT_DTYPE,
+# other columns not listed, ex. text, keep the type pandas gives them.
+DEFAULT_DTYPE = 'float32'
+SCHEMA = {True: {'Timestamp': 'datetime64[ns]',
+                 # SMHI point API names.
+                 't': 'float32',         # Temperature (C).
+                 'r': 'float32',         # Relative humidity [0, 1].
+                 'prec1h': 'float32',    # Precipitation last hour (mm).
+                 'prec3h': 'float32',
+                 'prec24h': 'float32',
+                 'ws': 'float32',        # Wind speed (m/s).
+                 'wd': 'float32',        # Wind direction (degrees).
+                 'gust': 'float32',
+                 'vis': 'float32',
+                 'tcc': 'float32',
+                 'msl': 'float64',       # Air pressure (hPa/Pa).
+                 # GRIB names, <shortName>_<levelType>.
+                 't_sfc': 'float32',
+                 'r_sfc': 'float32',
+                 'u_sfc': 'float32',
+                 'v_sfc': 'float32'},
+          False: {'Timestamp': 'datetime64[ns]',
+                  'TM': 'float32',       # Temperature (C).
+                  'UM': 'float32',       # Relative humidity [0, 100].
+                  'RR': 'float32',       # Precipitation (mm).
+                  'FM2': 'float32'}}     # Wind speed at 2 m (m/s).
+
+
+
+
+# Translate folder argument to data source.
+# @params folder: True/False or a string, example: folder = 'MESAN' or 'LANTMET'
+# @returns True for MESAN, False for LANTMET, None if folder can not be used to specify data source.
+def get_source(folder):
+    # If folder is a string, check if folder is a key in trans_dict.
+    if isinstance(folder, str):
+        try:
+            # folder is assigned a boolean value corresponding to data source.
+            return trans_dict[folder]
+        except KeyError:
+            # User provided key not existing in trans_dict.
+            print('Key \'' + folder + '\' can not be used to specify data source.')
+            return None
+    return bool(folder)
+
+
+
+
+# Convert a Timestamp column to datetime64 without time zone.
+# Timestamps keep 'YYYY-MM-DDTHH:MM:SS' as written, i.e. 'Z' or UTC offset is dropped.
+# Missing timestamps become NaT.
+# @params col: pandas Series of timestamp strings or datetimes.
+#         dtype: optional, datetime type of result.
+# @returns pandas Series of type dtype.
+def to_datetime_column(col, dtype='datetime64[ns]'):
+    if pd.api.types.is_datetime64_any_dtype(col):
+        if getattr(col.dt, 'tz', None) is not None:
+            col = col.dt.tz_localize(None)
+        return col.astype(dtype)
+    col = pd.to_datetime(col.astype(object).str[:19], format='%Y-%m-%dT%H:%M:%S', errors='coerce')
+    return col.astype(dtype)
+
+
+
+
+# Apply SCHEMA types to one column.
+# @params values: column as a pandas Series or numpy array.
+#         col: name of column.
+#         folder: True for MESAN, False for LANTMET.
+# @returns typed column.
+def _schema_column(values, col, folder):
+    if col == 'Timestamp':
+        return to_datetime_column(pd.Series(values), SCHEMA[folder][col]).to_numpy()
+    if col in SCHEMA[folder]:
+        return np.asarray(values).astype(SCHEMA[folder][col])
+    values = np.asarray(values)
+    if values.dtype.kind in 'iuf':
+        return values.astype(DEFAULT_DTYPE)
+    return values
+
+
+
+
+# Apply SCHEMA types to a dataframe, ex. one read without typed=True.
+# @params df: dataframe with a Timestamp column.
+#         folder: True for MESAN, False for LANTMET.
+# @returns dataframe with Timestamp as datetime64 and parameters as compact floats.
+def apply_schema(df, folder):
+    for col in df.columns:
+        df[col] = _schema_column(df[col], col, folder)
+    return df
+
+
+
+
+# Get arguments of pd.read_csv reading a day file directly into SCHEMA types,
+# so columns in SCHEMA are never held with their default types. Columns not in SCHEMA
+# are converted afterwards with _schema_column, since they may hold text.
+# @params folder: True for MESAN, False for LANTMET.
+# @returns dict of keyword arguments.
+def _schema_read_args(folder):
+    dtypes = {}
+    for col in SCHEMA[folder]:
+        if col != 'Timestamp':
+            dtypes[col] = SCHEMA[folder][col]
+    return {'dtype': dtypes, 'parse_dates': ['Timestamp']}
 
 
 
 
 # Combine data from all CSV files into a dataframe.
+# If a consolidated store (see import_CSV_store) covers the whole interval, data is read from it instead.
 # @params stationId: station id as a string.
 #         start_date: date object. Includes this date when reading.
 #                     example: datetime.date(2020, 9, 1)
@@ -16,51 +149,54 @@ import pandas as pd
 #                 folder = False -> LANTMET
 #                 Can also be a string.
 #                 example: folder = 'MESAN' or 'LANTMET'
+#         columns: optional, list of parameters to read. Timestamp is always read. Default is all.
+#         typed: optional, if True types in SCHEMA are used, i.e. Timestamp as datetime64 and
+#                parameters as float32. Columns are read directly into these types, which uses about
+#                half the memory, and timestamps need not be parsed again. Missing timestamps are NaT.
+#                Text columns are kept as text. float32 keeps about 7 significant digits, so read
+#                without typed to keep all digits of data written back with save_LANTMET.
 # @returns comb_df: concatenated dataframe containing all csv data
 #                   chronologically. None if a file was not found.
-def read_CSV(stationId, folder, start_date, end_date):
+def read_CSV(stationId, folder, start_date, end_date, columns=None, typed=False):
     
-    # Used if folder is a string to translate to boolean.
-    trans_dict = {'MESAN_CSV': True,
-                  'MESAN': True,
-                  'LANTMET_CSV': False,
-                  'LANTMET': False}
+    folder = get_source(folder)
+    if folder is None:
+        return None
     
-    # If folder is a string, check if folder is a key in trans_dict.
-    if isinstance(folder, str):
-        try:
-            # folder is assigned a boolean value corresponding to data source.
-            folder = trans_dict[folder]
-        except KeyError:
-            # User provided key not existing in trans_dict.
-            print('Key \'' + folder + '\' can not be used to specify data source.')
-            return None
+    # Read from consolidated store if it covers all dates.
+    comb_df = read_store(stationId, folder, start_date, end_date, columns, typed)
+    if comb_df is not None:
+        return comb_df
     
-    if folder:
-        station_dir = 'MESAN_CSV/' + stationId + '/'
-    else:
-        station_dir = 'LANTMET_CSV/' + stationId + '/'
+    station_dir = CSV_DIRS[folder] + stationId + '/'
     
     # Check if dir exists.
     if not os.path.isdir(station_dir):
         print('read_CSV() >>> No directory: ' + station_dir)
+
+    usecols = None
+    if columns is not None:
+        usecols = lambda col: col == 'Timestamp' or col in columns
+    read_args = _schema_read_args(folder) if typed else {}
     
     # Loop over days
     current_date = start_date
     frames = []
     for n in range(0, (end_date - start_date + datetime.timedelta(days=1)).days):
         date_str = current_date.strftime('%Y-%m-%d')
-        if folder:
-            current_file = 'MESAN_' + date_str + '.csv'
-        else:
-            current_file = 'LANTMET_' + date_str + '.csv'
+        current_file = PREFIXES[folder] + date_str + '.csv'
         
         # Try to read file, if file not found, return a None object.
         try:
-            frames.append(pd.read_csv(station_dir + current_file, sep=';'))
+            df = pd.read_csv(station_dir + current_file, sep=';', usecols=usecols, **read_args)
         except IOError as e:
             print('read_CSV() >>> File not found. (' + current_file + ')')
             return None
+        if typed:
+            for col in df.columns:
+                if col == 'Timestamp' or col not in SCHEMA[folder]:
+                    df[col] = _schema_column(df[col], col, folder)
+        frames.append(df)
         
         current_date = current_date + datetime.timedelta(days=1)
     comb_df = pd.concat(frames, ignore_index=True)
@@ -69,160 +205,549 @@ def read_CSV(stationId, folder, start_date, end_date):
 
 
 
+# ========== CONSOLIDATED STORE ==========
+# Day CSV files of a station are consolidated into one compressed npz file per month:
+# MESAN_STORE/<stationId>/MESAN_YYYY-MM.npz (LANTMET_STORE/ for LANTMET).
+# Each column of the month is a separate array. Text columns are stored as strings with
+# a separate null mask (<column>__null), so missing values are read back as NaN.
+# index.json in the station directory holds, for every month, its columns, the row range
+# of every day and the modification time of every day file, so only the months covering
+# an interval are opened, only the rows of requested days are read and a day file changed
+# after it was imported is read from the CSV file instead.
+
+
+
+
+# Load index of a station in the consolidated store.
+# @params station_dir: directory of station in store.
+# @returns index as a dict. Empty index if no index exists.
+def load_store_index(station_dir):
+    try:
+        with open(station_dir + 'index.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {'partitions': {}}
+
+
+
+
+# Get modification times of day files, used to find days changed after they were imported.
+# @params csv_dir: directory of day files of a station.
+#         prefix: prefix of day files, ex. 'MESAN_'.
+#         days: list of days, ex. ['2020-09-01', '2020-09-02'].
+# @returns dict with day as key and modification time in nanoseconds as value.
+#          Days without a file are left out.
+def _day_mtimes(csv_dir, prefix, days):
+    mtimes = {}
+    for day in days:
+        try:
+            mtimes[day] = os.stat(csv_dir + prefix + day + '.csv').st_mtime_ns
+        except OSError:
+            continue
+    return mtimes
+
+
+
+
+# Consolidate day CSV files of one station into the store.
+# Months already in the store with the same, unchanged day files are skipped.
+# @params stationId: station id as a string.
+#         folder: True/'MESAN' or False/'LANTMET'.
+#         overwrite: If True, all months are rewritten.
+# @returns list of written months, ex. ['2020-09', '2020-10'].
+def import_CSV_store(stationId, folder, overwrite=False):
+    folder = get_source(folder)
+    if folder is None:
+        return []
+
+    csv_dir = CSV_DIRS[folder] + stationId + '/'
+    station_dir = STORE_DIRS[folder] + stationId + '/'
+    prefix = PREFIXES[folder]
+    if not os.path.isdir(csv_dir):
+        print('import_CSV_store() >>> No directory: ' + csv_dir)
+        return []
+    os.makedirs(station_dir, exist_ok=True)
+
+    # Group day files by month.
+    months = {}
+    for file in sorted(os.listdir(csv_dir)):
+        if file.startswith(prefix) and file.endswith('.csv'):
+            day = file[len(prefix):-len('.csv')]
+            months.setdefault(day[:7], []).append(day)
+
+    index = load_store_index(station_dir)
+    written = []
+    for month in sorted(months):
+        days = months[month]
+        mtimes = _day_mtimes(csv_dir, prefix, days)
+        if not overwrite and month in index['partitions'] and index['partitions'][month].get('mtimes') == mtimes:
+            continue
+
+        # Read days and keep track of row range of each day.
+        frames = []
+        offsets = {}
+        rows = 0
+        for day in days:
+            df = pd.read_csv(csv_dir + prefix + day + '.csv', sep=';')
+            offsets[day] = [rows, rows + df.shape[0]]
+            rows = rows + df.shape[0]
+            frames.append(df)
+        month_df = pd.concat(frames, ignore_index=True)
+
+        arrays = {}
+        for col in month_df.columns:
+            values = month_df[col].to_numpy()
+            if values.dtype == object or not isinstance(values, np.ndarray):
+                null = month_df[col].isna().to_numpy()
+                values = month_df[col].where(~null, '').astype(str).to_numpy(dtype=str)
+                if null.any():
+                    arrays[col + '__null'] = null
+            arrays[col] = values
+
+        file = prefix + month + '.npz'
+        with open(station_dir + file + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(station_dir + file + '.tmp', station_dir + file)
+
+        index['partitions'][month] = {'file': file,
+                                      'columns': list(month_df.columns),
+                                      'days': days,
+                                      'offsets': offsets,
+                                      'mtimes': mtimes}
+        written.append(month)
+
+    with open(station_dir + 'index.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(station_dir + 'index.json.tmp', station_dir + 'index.json')
+
+    print('import_CSV_store() >>> Wrote ' + str(len(written)) + ' months for station ' + stationId + '.')
+    return written
+
+
+
+
+# Consolidate day CSV files of all stations in MESAN_CSV/ or LANTMET_CSV/ into the store.
+# @params folder: True/'MESAN' or False/'LANTMET'.
+#         overwrite: If True, all months are rewritten.
+# @returns dict with written months per station.
+def import_CSV_tree(folder, overwrite=False):
+    folder = get_source(folder)
+    if folder is None:
+        return {}
+
+    written = {}
+    for stationId in sorted(os.listdir(CSV_DIRS[folder])):
+        if os.path.isdir(CSV_DIRS[folder] + stationId):
+            written[stationId] = import_CSV_store(stationId, folder, overwrite)
+    return written
+
+
+
+
+# Read a range of rows of one array in a npz file without reading the rest of the array.
+# Rows before first_row are skipped while decompressing and never held in memory.
+# @params zf: npz file opened as zipfile.ZipFile.
+#         name: name of array.
+#         first_row: first row read.
+#         last_row: row after last row read.
+# @returns numpy array with rows first_row to last_row - 1.
+def _read_rows(zf, name, first_row, last_row):
+    with zf.open(name + '.npy') as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        n = max(min(last_row, shape[0]) - first_row, 0)
+        if n == 0:
+            return np.empty((0,) + shape[1:], dtype=dtype)
+        if dtype.hasobject or fortran_order:
+            return np.lib.format.read_array(f, allow_pickle=False)[first_row:last_row]
+        row_bytes = dtype.itemsize*int(np.prod(shape[1:]))
+        f.seek(f.tell() + first_row*row_bytes)
+        return np.frombuffer(f.read(n*row_bytes), dtype=dtype).reshape((n,) + shape[1:])
+
+
+
+
+# Read data for a station between two dates from the consolidated store.
+# Only months covering the interval are opened and only requested rows are read.
+# @params stationId: station id as a string.
+#         folder: True/'MESAN' or False/'LANTMET'.
+#         start_date: date object. Includes this date when reading.
+#         end_date: date object. Includes this date when reading.
+#         columns: optional, list of parameters to read. Timestamp is always read. Default is all.
+#         typed: optional, if True columns are converted to SCHEMA types one at a time, see read_CSV.
+# @returns dataframe on the same form as read_CSV. None if the store does not contain every day
+#          or a day file was changed after it was imported.
+def read_store(stationId, folder, start_date, end_date, columns=None, typed=False):
+    folder = get_source(folder)
+    if folder is None:
+        return None
+
+    station_dir = STORE_DIRS[folder] + stationId + '/'
+    index = load_store_index(station_dir)
+    if not index['partitions']:
+        return None
+
+    # Collect requested days per month and check that all exist and are up to date.
+    csv_dir = CSV_DIRS[folder] + stationId + '/'
+    months = {}
+    current_date = start_date
+    while current_date <= end_date:
+        day = current_date.strftime('%Y-%m-%d')
+        partition = index['partitions'].get(day[:7])
+        if partition is None or day not in partition['offsets']:
+            return None
+        mtime = _day_mtimes(csv_dir, PREFIXES[folder], [day]).get(day)
+        if mtime is not None and mtime != partition.get('mtimes', {}).get(day):
+            print('read_store() >>> ' + PREFIXES[folder] + day + '.csv changed since import, reading CSV files. '
+                  + 'Run import_CSV_store to update the store.')
+            return None
+        months.setdefault(day[:7], []).append(day)
+        current_date = current_date + datetime.timedelta(days=1)
+
+    frames = []
+    for month in months:
+        partition = index['partitions'][month]
+        # Days are consecutive, so requested rows are one range.
+        first_row = partition['offsets'][months[month][0]][0]
+        last_row = partition['offsets'][months[month][-1]][1]
+        # Columns are stored separately, so only requested columns are decompressed.
+        cols = [col for col in partition['columns'] if columns is None or col == 'Timestamp' or col in columns]
+        data = {}
+        with zipfile.ZipFile(station_dir + partition['file']) as zf:
+            names = set(zf.namelist())
+            for col in cols:
+                values = _read_rows(zf, col, first_row, last_row)
+                if values.dtype.kind == 'U':
+                    values = values.astype(object)
+                    if col + '__null.npy' in names:
+                        values[_read_rows(zf, col + '__null', first_row, last_row)] = np.nan
+                if typed:
+                    values = _schema_column(values, col, folder)
+                data[col] = values
+        frames.append(pd.DataFrame(data))
+
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+
+
+# ========== MULTI-STATION PANEL ==========
+
+# Unit conversions applied to reference (LANTMET) columns when loading a panel.
+# LANTMET relative humidity in [0, 100]. Rescale to [0, 1] to follow SMHI convention.
+UNIT_CONVERSIONS = {'UM': 1/100}
+
+
+
+
+# Read MESAN and/or LANTMET data of one station and join them on Timestamp.
+# Used by load_panel in worker processes.
+# @params args: tuple (stationId, sources, start_date, end_date, convert).
+# @returns (stationId, dataframe). dataframe is None if data is missing for a source.
+def _load_station(args):
+    stationId, sources, start_date, end_date, convert = args
+
+    joined = None
+    for source in sources:
+        df = read_CSV(stationId, source, start_date, end_date)
+        if df is None:
+            return stationId, None
+
+        if convert and not get_source(source):
+            for col in UNIT_CONVERSIONS:
+                if col in df.columns:
+                    df[col] = df[col]*UNIT_CONVERSIONS[col]
+
+        df = df.drop_duplicates('Timestamp', keep='last').set_index('Timestamp')
+        if joined is None:
+            joined = df
+        else:
+            joined = joined.join(df, how='outer', rsuffix='_' + source)
+
+    return stationId, joined.sort_index()
+
+
+
+
+# Load data for several stations at once as one aligned panel.
+# Stations are loaded in parallel processes. For every station, the sources are joined
+# on Timestamp and all stations are aligned to the same timestamps.
+# Example:
+# panel = load_panel(['40010', '40013'], datetime.date(2019, 1, 1), datetime.date(2019, 12, 31))
+# panel.loc['40010', ['t', 'TM']]
+# @params stations: list of station ids as strings.
+#         start_date: date object. Includes this date when reading.
+#         end_date: date object. Includes this date when reading.
+#         sources: optional, list of data sources to join. Default ['MESAN', 'LANTMET'].
+#         convert: optional, if True UNIT_CONVERSIONS are applied to LANTMET columns.
+#         max_workers: optional, number of processes. Default is number of cores.
+# @returns dataframe with index (Station, Timestamp) and one column per parameter.
+#          None if no station could be loaded.
+def load_panel(stations, start_date, end_date, sources=None, convert=True, max_workers=None):
+
+    if sources is None:
+        sources = ['MESAN', 'LANTMET']
+    tasks = [(stationId, sources, start_date, end_date, convert) for stationId in stations]
+    if max_workers == 1:
+        results = [_load_station(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_load_station, tasks))
+
+    frames = {}
+    for stationId, df in results:
+        if df is None:
+            print('load_panel() >>> Missing data for station ' + stationId + '. Skipping station.')
+            continue
+        frames[stationId] = df
+    if not frames:
+        return None
+    return _align_stations(frames)
+
+
+
+
+# Align dataframes of several stations on the same timestamps and combine them into a panel.
+# @params frames: dict with one dataframe indexed by Timestamp per station.
+# @returns dataframe with index (Station, Timestamp).
+def _align_stations(frames):
+    timestamps = pd.Index(sorted(set().union(*[df.index for df in frames.values()])), name='Timestamp')
+    for stationId in frames:
+        frames[stationId] = frames[stationId].reindex(timestamps)
+    return pd.concat(frames, names=['Station', 'Timestamp'])
+
+
+
+
+# Combine already loaded MESAN and LANTMET dataframes into a panel, see load_panel.
+# No unit conversion is made.
+# @params MESAN_data: dict with one dataframe per station, as returned from read_CSV.
+#         LANTMET_data: dict with one dataframe per station, as returned from read_CSV.
+# @returns dataframe with index (Station, Timestamp) and one column per parameter.
+#          Stations missing in either dict are skipped.
+def make_panel(MESAN_data, LANTMET_data):
+    frames = {}
+    for stationId in MESAN_data:
+        if stationId not in LANTMET_data or MESAN_data[stationId] is None or LANTMET_data[stationId] is None:
+            print('make_panel() >>> Missing data for station ' + stationId + '. Skipping station.')
+            continue
+        df_MESAN = MESAN_data[stationId].drop_duplicates('Timestamp', keep='last').set_index('Timestamp')
+        df_LANTMET = LANTMET_data[stationId].drop_duplicates('Timestamp', keep='last').set_index('Timestamp')
+        frames[stationId] = df_MESAN.join(df_LANTMET, how='outer', rsuffix='_LANTMET').sort_index()
+    if not frames:
+        return None
+    return _align_stations(frames)
+
+
+
+
+# Get a panel as a station x time x parameter array.
+# @params panel: dataframe as returned from load_panel.
+#         params: optional, list of columns. Default is all columns.
+# @returns cube: float array (stations, timestamps, params).
+#          stations: list of station ids.
+#          timestamps: list of timestamps.
+#          params: list of columns.
+def panel_to_cube(panel, params=None):
+    if params is None:
+        params = list(panel.columns)
+    stations = list(panel.index.get_level_values('Station').unique())
+    timestamps = list(panel.index.get_level_values('Timestamp').unique())
+    cube = panel[params].to_numpy(dtype=float).reshape(len(stations), len(timestamps), len(params))
+    return cube, stations, timestamps, params
+
+
+
+
+# ========== DISK CACHE ==========
+# Downloaded LANTMET data is kept on disk, so rerunning an analysis reads it locally
+# and works offline (see DiskCache in Common/web_utils.py).
+# LANTMET_CACHE.info() gives hits, misses and size, LANTMET_CACHE.clear() removes all entries.
+
+LANTMET_CACHE = DiskCache('LANTMET_CACHE/')
+
+
+
+
+# Save LANTMET columns as returned from stream_LANTMET to a .npz file.
+# @params columns: dict of columns.
+#         filename: name of file.
+# @returns None.
+def save_columns(columns, filename):
+    with open(filename, 'wb') as f:
+        np.savez(f, time=columns['time'], param=columns['param'], value=columns['value'],
+                 params=np.array(columns['params'], dtype=str))
+
+
+
+
+# Load LANTMET columns saved with save_columns.
+# @params filename: name of file.
+# @returns dict of columns.
+def load_columns(filename):
+    with np.load(filename) as f:
+        return {'time': f['time'], 'param': f['param'], 'value': f['value'], 'params': f['params'].tolist()}
+
+
+
+
+LANTMET_URL = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm'
+
+
+
+
+# Get LANTMET observations for one chunk of days. Observations are read through the disk cache,
+# so an interrupted or failed get_LANTMET can resume without downloading the chunk again.
+# If all attempts fail, expired cached data is used if it exists.
+# @params id: station id as a string, example: id='149'
+#         chunk_start: date object, first day of chunk.
+#         chunk_end: date object, last day of chunk.
+#         retries: number of attempts before giving up.
+#         cache: optional, if False the disk cache is neither read nor written.
+# @returns observations as columns (see stream_LANTMET). None if all attempts failed.
+def get_LANTMET_chunk(id, chunk_start, chunk_end, retries=3, cache=True):
+    tmp_start = chunk_start.strftime('%Y-%m-%d')
+    tmp_end = chunk_end.strftime('%Y-%m-%d')
+
+    if cache:
+        key = 'LANTMET_' + id + '_' + tmp_start + '_' + tmp_end + '.npz'
+        filename = LANTMET_CACHE.get(key, LANTMET_CACHE.max_age(tmp_end))
+        if filename is not None:
+            return load_columns(filename)
+
+    url = LANTMET_URL + '?weatherStationID=' + id + '&startDate=' + tmp_start + '&endDate=' + tmp_end
+    for attempt in range(0, retries):
+        if attempt > 0:
+            # Wait a bit longer after every failed attempt.
+            time.sleep(2**attempt)
+
+        # Try accessing API. If it fails or data is not in JSON format, try again.
+        columns = stream_LANTMET(url, hourly=True)
+        if columns is None:
+            continue
+
+        if cache:
+            LANTMET_CACHE.put(key, save_columns, columns)
+        return columns
+
+    # Use expired data rather than nothing, ex. when offline.
+    if cache and LANTMET_CACHE.get_expired(key) is not None:
+        print('get_LANTMET() >>> Using expired cached data for ' + tmp_start + ' - ' + tmp_end + '.')
+        return load_columns(LANTMET_CACHE.get_expired(key))
+
+    print('get_LANTMET() >>> Giving up on ' + tmp_start + ' - ' + tmp_end + ' after ' + str(retries) + ' attempts.')
+    return None
+
+
+
+
+# Split an interval into chunks aligned to calendar months. Every chunk covers chunk_months
+# months counted from January, so the same chunks are used by every interval overlapping
+# them and can be shared in the disk cache. Chunks do not end later than end_date or today,
+# whichever is later.
+# @params start_date: date object, first day of interval.
+#         end_date: date object, last day of interval.
+#         chunk_months: number of months per chunk.
+# @returns list of (first day, last day) of every chunk as date objects.
+def month_chunks(start_date, end_date, chunk_months=3):
+    last_day = max(end_date, datetime.date.today())
+    chunks = []
+    month = (start_date.year*12 + start_date.month - 1) // chunk_months * chunk_months
+    while True:
+        chunk_start = datetime.date(month // 12, month % 12 + 1, 1)
+        if chunk_start > end_date:
+            break
+        month = month + chunk_months
+        chunk_end = datetime.date(month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+        chunks.append((chunk_start, min(chunk_end, last_day)))
+    return chunks
+
+
+
+
 # Get LANTMET parameter data for a selected station over a time interval
 # as a pandas dataframe. Missing datapoints is filled to ensure continuity and
 # chronological sorting.
 # UPDATED: Since LANTMETS api seems to not allow an extraction for a large time interval, the extraction
-# is made in chunks of chunk_size(default=200) days.
+# is made in chunks of chunk_months(default=3) calendar months (see month_chunks). Chunks are
+# downloaded concurrently and each chunk is retried on failure. Downloaded chunks are kept in the
+# disk cache (see LANTMET_CACHE), so a repeated, overlapping or failed call does not download them again.
 # @params id: station id as a string, example: id='149'
 #         start_date: date object representing earliest date in selected time interval.
 #         end_date: date object representing latest date in selected time interval.
+#         chunk_months: optional, number of months per request. At most 6.
+#         max_workers: optional, number of chunks downloaded at the same time.
+#         retries: optional, number of attempts per chunk.
+#         cache: optional, if False the disk cache is neither read nor written.
 # @returns pandas dataframe with one column for each timestamp and one
 #          column per parameter where each row is separated by one hour.
-def get_LANTMET(id, start_date, end_date):
-    #start_str = start_date.strftime('%Y-%m-%d')
-    #end_str = end_date.strftime('%Y-%m-%d')
-    #url = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm?weatherStationID=' + id + '&startDate=' + start_str + '&endDate=' + end_str
-    
-    chunk_size = 200
-    
+def get_LANTMET(id, start_date, end_date, chunk_months=3, max_workers=4, retries=3, cache=True):
+
     total_days = (end_date - start_date + datetime.timedelta(days=1)).days
-    n200 = total_days // chunk_size
-    remainder_days = total_days % chunk_size
-    #print(total_days)
-    #print(n200)
-    #print(remainder_days)
-    
-    # List of dicts. Will be converted to DataFrame.
-    dict_list = []
-    
-    # Loop over number of 200d intervals in total interval.
-    current_date = start_date
-    for i200 in range(0, n200):
-        
-        tmp_start = current_date.strftime('%Y-%m-%d')
-        tmp_end = (current_date + datetime.timedelta(days=chunk_size)).strftime('%Y-%m-%d')
-        url = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm?weatherStationID=' + id + '&startDate=' + tmp_start + '&endDate=' + tmp_end
-        #print(tmp_start)
-        #print(tmp_end)
-        #print(url)
-        #continue
-        
-        #print(current_date)
-        
-        # Try accessing API.
-        try:
-            r = requests.get(url)
-        except requests.exceptions.RequestException as e:
-            # If accessing API fails
-            print('get_LANTMET() >>> Request failed.\n' + str(e.__str__()))
-            return None
+    chunks = month_chunks(start_date, end_date, chunk_months)
 
-        # If data is not in JSON format, return.
-        try:
-            data = r.json()
-        except json.JSONDecodeError:
-            print('get_LANTMET() >>> Fetched data is not in JSON format.')
-            print(r.text)
-            return None
-        
-        # Reformat data to bring search time to O(1).
-        tmp_dict = {}
-        for e in data:
-            tmp_dict[e['timeMeasured']] = {'Timestamp': e['timeMeasured'].split('+')[0] + 'Z'}
-        for e in data:
-            tmp_dict[e['timeMeasured']][e['elementMeasurementTypeId']] = e['value']
-        
-        for d in range(0, chunk_size):#+1):
-            
-            for h in range(0, 24):
-                hour_str = ''
-                if h < 10:
-                    hour_str = '0' + str(h)
-                else:
-                    hour_str = str(h)
-                    
-                datetime_str = current_date.strftime('%Y-%m-%d') + 'T' + hour_str + ':00:00'
-                
-                # Append dict corresponding to current datetime. If not found, warn user.
-                try:
-                    dict_list.append(tmp_dict[datetime_str + '+01:00'])
-                except KeyError:
-                    print('get_LANTMET() >>> Missing data for ' + datetime_str + '.')
-                    tmp = {'Timestamp': datetime_str + 'Z'}
-                    dict_list.append(tmp)
-            
-            current_date = current_date + datetime.timedelta(days=1)
-        #current_date = current_date + datetime.timedelta(days=1)
-        #print(current_date)
-    
-    
-    
-    
-    # Fetch remaining days.
-    tmp_start = current_date.strftime('%Y-%m-%d')
-    tmp_end = (current_date + datetime.timedelta(days=remainder_days-1)).strftime('%Y-%m-%d')
-    url = 'https://www.ffe.slu.se/lm/json/DownloadJS.cfm?weatherStationID=' + id + '&startDate=' + tmp_start + '&endDate=' + tmp_end
-    
-    # Try accessing API.
-    try:
-        r = requests.get(url)
-    except requests.exceptions.RequestException as e:
-        # If accessing API fails
-        print('get_LANTMET() >>> Request failed.\n' + str(e.__str__()))
-        return None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda c: get_LANTMET_chunk(id, c[0], c[1], retries, cache), chunks))
 
-    # If data is not in JSON format, return.
-    try:
-        data = r.json()
-    except json.JSONDecodeError:
-        print('get_LANTMET() >>> Fetched data is not in JSON format.')
-        print(r.text)
+    if any(data is None for data in results):
+        print('get_LANTMET() >>> Failed to download all chunks.')
         return None
-    
-    # Reformat data to bring search time to O(1).
-    tmp_dict = {}
-    for e in data:
-        tmp_dict[e['timeMeasured']] = {'Timestamp': e['timeMeasured'].split('+')[0] + 'Z'}
-    for e in data:
-        tmp_dict[e['timeMeasured']][e['elementMeasurementTypeId']] = e['value']
-    
-    #print(tmp_start)
-    #print(tmp_end)
-    #print(url) 
-    for d in range(0, remainder_days):
-        for h in range(0, 24):
-            hour_str = ''
-            if h < 10:
-                hour_str = '0' + str(h)
-            else:
-                hour_str = str(h)
-                    
-            datetime_str = current_date.strftime('%Y-%m-%d') + 'T' + hour_str + ':00:00'
-                
-            # Append dict corresponding to current datetime. If not found, warn user.
-            try:
-                dict_list.append(tmp_dict[datetime_str + '+01:00'])
-            except KeyError:
-                print('get_LANTMET() >>> Missing data for ' + datetime_str + '.')
-                tmp = {'Timestamp': datetime_str + 'Z'}
-                dict_list.append(tmp)
-            
-        current_date = current_date + datetime.timedelta(days=1)
-    
-    return(pd.DataFrame(dict_list))
+
+    # Collect observations within each chunk and the interval.
+    obs_list = []
+    for (chunk_start, chunk_end), columns in zip(chunks, results):
+        first_hour = np.datetime64(max(chunk_start, start_date), 'h').astype(np.int64)
+        last_hour = np.datetime64(min(chunk_end, end_date) + datetime.timedelta(days=1), 'h').astype(np.int64)
+        within = (columns['time'] >= first_hour) & (columns['time'] < last_hour)
+        obs = pd.DataFrame({'Time': columns['time'][within].astype('datetime64[h]').astype('datetime64[ns]'),
+                            'elementMeasurementTypeId': np.array(columns['params'], dtype=object)[columns['param'][within]],
+                            'value': columns['value'][within]})
+        obs_list.append(obs)
+    obs = pd.concat(obs_list, ignore_index=True)
+
+    # Parameters in order of first appearance, a later observation of the same parameter
+    # and hour replaces an earlier one.
+    obs = obs.sort_values('Time', kind='stable')
+    params = list(pd.unique(obs['elementMeasurementTypeId']))
+    obs = obs.drop_duplicates(['Time', 'elementMeasurementTypeId'], keep='last')
+    table = obs.pivot(index='Time', columns='elementMeasurementTypeId', values='value')
+
+    # Reindex onto every hour in interval.
+    hours = pd.date_range(pd.Timestamp(start_date), periods=total_days*24, freq='h')
+    for missing in hours.difference(table.index):
+        print('get_LANTMET() >>> Missing data for ' + missing.strftime('%Y-%m-%dT%H:%M:%S') + '.')
+    table = table.reindex(index=hours, columns=params).infer_objects()
+
+    df = pd.DataFrame({'Timestamp': hours.strftime('%Y-%m-%dT%H:%M:%SZ')})
+    for param in params:
+        df[param] = table[param].to_numpy()
+
+    return df
 
 
 
 
 # Saving a data frame into CSV files (one for each day). 
+# The data frame is split into days once and the day files are written in parallel.
+# Every file is written to a temporary file first and renamed when complete, so an
+# interrupted call never leaves a truncated file. Days without data get a file with
+# only the header.
 # @params stationId: station id as a string.
 #                    example: '35004'
-#         df: data frame as returned from function get_LANTMET. 
+#         df: data frame as returned from function get_LANTMET, or read_CSV. Values are written
+#             with the precision of their type, so float32 columns (read_CSV with typed=True)
+#             keep about 7 significant digits.
 #         start_date: date object. OBS: Includes this date when reading.
 #                     example: datetime.date(2020, 9, 1)
 #         end_date: date object. OBS: Includes this date when reading.
-def save_LANTMET(stationId, df, startDate, endDate):
+#         max_workers: optional, number of files written at the same time.
+# @returns manifest, list with one dict per written file:
+#          {'date': '2020-09-01', 'file': 'LANTMET_CSV/35004/LANTMET_2020-09-01.csv', 'rows': 24}
+def save_LANTMET(stationId, df, startDate, endDate, max_workers=8):
     csv_dir = 'LANTMET_CSV'
     
     # Create directory for LANTMET .csv files.
@@ -238,38 +763,137 @@ def save_LANTMET(stationId, df, startDate, endDate):
     else:
         print('Creating ' + csv_dir + '/' + stationId + '/' + 'directory.')
         os.mkdir(csv_dir + '/' + stationId + '/')
-        
-    currentDate = startDate
-    for i in range(0,(endDate - startDate + datetime.timedelta(days=1)).days):
-        
-        # Split out one day from the data frame.
-        df_temp = df[df['Timestamp'].str.contains(str(currentDate))]
-        
+
+    # Split data frame into days once. String timestamps start with the date. Typed
+    # timestamps (see read_CSV) are written in the same form as string timestamps.
+    if pd.api.types.is_datetime64_any_dtype(df['Timestamp']):
+        df = df[df['Timestamp'].notna()]
+        day_keys = df['Timestamp'].dt.strftime('%Y-%m-%d')
+        df = df.assign(Timestamp=df['Timestamp'].dt.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    else:
+        day_keys = df['Timestamp'].str[:10]
+    days = dict(list(df.groupby(day_keys, sort=False)))
+
+    def save_day(i):
+        currentDate = str(startDate + datetime.timedelta(days=i))
+        df_temp = days.get(currentDate, df.iloc[0:0])
+        filename = csv_dir + '/' + stationId + '/' + 'LANTMET_' + currentDate + '.csv'
+
         # Save data into .csv.
-        print('Saving ' + 'LANTMET_' + str(currentDate) + '.csv')
-        df_temp.to_csv(csv_dir + '/' + stationId + '/' + 'LANTMET_' + str(currentDate) + '.csv', sep = ';', index=False)
-        currentDate = currentDate + datetime.timedelta(days=1)
+        print('Saving ' + 'LANTMET_' + currentDate + '.csv')
+        df_temp.to_csv(filename + '.tmp', sep = ';', index=False)
+        os.replace(filename + '.tmp', filename)
+        return {'date': currentDate, 'file': filename, 'rows': len(df_temp)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(save_day, range(0, (endDate - startDate + datetime.timedelta(days=1)).days)))
         
         
         
 
+# ========== TIME BINS ==========
+# Timestamps are parsed once and every row gets its bins (month, week, hour, ...)
+# as integer or label arrays. Bins are returned as arrays of row positions, so
+# selecting rows of a bin is a df.iloc lookup instead of a string scan.
+#
+# bins = time_bins(df, ['month', 'hour'])
+# groups = bin_indices(df, ['season', 'hour'])   # {('winter', 0): array([...]), ...}
+# df.iloc[groups[('winter', 0)]]
+
+# Months of every season.
+SEASONS = {'spring': [3, 4, 5], 'summer': [6, 7, 8], 'fall': [9, 10, 11], 'winter': [12, 1, 2]}
+
+# Functions computing a bin for every timestamp in a DatetimeIndex.
+BINS = {'year': lambda t: t.year.to_numpy(),
+        'month': lambda t: t.month.to_numpy(),
+        'week': lambda t: t.isocalendar().week.to_numpy(dtype=np.int64),
+        'day': lambda t: t.dayofyear.to_numpy(),
+        'hour': lambda t: t.hour.to_numpy(),
+        'season': lambda t: _month_seasons()[t.month.to_numpy()]}
+
+
+
+
+# Get season of every month as an array indexed by month number.
+# @returns array of season names, index 0 is unused.
+def _month_seasons():
+    seasons = np.empty(13, dtype=object)
+    for season in SEASONS:
+        seasons[SEASONS[season]] = season
+    return seasons
+
+
+
+
+# Parse the Timestamp column of a dataframe. Already parsed timestamps are used as they are.
+# @params df: dataframe with a Timestamp column, as returned from read_CSV.
+# @returns pandas DatetimeIndex.
+def parse_timestamps(df):
+    if pd.api.types.is_datetime64_any_dtype(df['Timestamp']):
+        return pd.DatetimeIndex(df['Timestamp'])
+    # Keep 'YYYY-MM-DDTHH:MM:SS', i.e. drop 'Z' or UTC offset.
+    return pd.DatetimeIndex(pd.to_datetime(df['Timestamp'].str[:19], format='%Y-%m-%dT%H:%M:%S'))
+
+
+
+
+# Compute time bins for every row of a dataframe. Timestamps are parsed once.
+# @params df: dataframe with a Timestamp column, as returned from read_CSV.
+#         by: name or list of names of bins, see BINS.
+#             'year', 'month', 'week' (ISO week), 'day' (day of year), 'hour', 'season'.
+#         custom: optional, dict with custom bins. Maps name to a function taking a pandas
+#                 DatetimeIndex and returning one bin per timestamp.
+#                 example: custom = {'daytime': lambda t: (t.hour >= 6) & (t.hour < 18)}
+# @returns dataframe with one column per bin, same index as df.
+def time_bins(df, by, custom=None):
+    if custom is None:
+        custom = {}
+    if isinstance(by, str):
+        by = [by]
+    times = parse_timestamps(df)
+
+    bins = {}
+    for name in by:
+        if name in custom:
+            bins[name] = np.asarray(custom[name](times))
+        elif name in BINS:
+            bins[name] = BINS[name](times)
+        else:
+            print('time_bins() >>> Unknown bin: ' + str(name) + '.')
+            return None
+    return pd.DataFrame(bins, index=df.index)
+
+
+
+
+# Find rows of every time bin.
+# @params df: dataframe with a Timestamp column, as returned from read_CSV.
+#         by: name or list of names of bins, see time_bins.
+#         custom: optional, dict with custom bins, see time_bins.
+# @returns dictionary with an array of row positions for every bin, in chronological order.
+#          Keys are bin values for one bin and tuples of bin values for several bins.
+#          Bins are ordered by first appearance.
+#          example: {1: array([0, 1, ..., 743]), 2: array([744, ...]), ...}
+def bin_indices(df, by, custom=None):
+    bins = time_bins(df, by, custom)
+    if bins is None:
+        return None
+
+    keys = [bins[name].to_numpy() for name in bins.columns]
+    if isinstance(by, str):
+        keys = keys[0]
+    return pd.Series(np.arange(len(df))).groupby(keys, sort=False).indices
+
+
+
+
 # Splitting dataframe into bins corresponding to months 
 # @params df: dataframe as returned from read_CSV.
 # @returns dictionary with keys for each month containing all rows of the corresponding month.
 # {1: df_january, 2: df_february, ..., 12: df_december}
 def divide_months(df):
-    months = {}
-    for month in range(1, 13):
-        
-        # Get hour string as two character string.
-        month_str = ''
-        if month < 10:
-            month_str = '0' + str(month)
-        else:
-            month_str = str(month)
-        months[month] = df[df['Timestamp'].str.contains('-' + month_str + '-')]
-        
-    return months
+    indices = bin_indices(df, 'month')
+    return {month: df.iloc[indices.get(month, [])] for month in range(1, 13)}
 
 
 
@@ -277,40 +901,11 @@ def divide_months(df):
 # Splitting dataframe into bins corresponding to weeks 
 # @params df: dataframe as returned from read_CSV.
 # @returns dictionary with keys for each week containing all rows of the corresponding week.
+#          Weeks are in order of first appearance.
 # {1: df_week1, 2: df_week2, ..., 52: df_week52}
 def divide_weeks(df):
-    
-    # Initialize variables.
-    week = df.iloc[0]['Timestamp'].split('T')[0]
-    week = datetime.datetime.strptime(week, '%Y-%m-%d').isocalendar()[1]
-    prev_week = week
-    weeks = {}
-    start_index = 0
-    end_index = 0
-    
-    # Loop over every row.
-    for index, df_row in df.iterrows():
-        
-        # Find week number.
-        current_dt = df_row['Timestamp'].split('T')[0]
-        current_dt = datetime.datetime.strptime(current_dt, '%Y-%m-%d')
-        week = current_dt.isocalendar()[1]
-        
-        # If change in current week, slice all rows appertaining to previous week and try to concatenate with previous dataframes.
-        if not week == prev_week:       
-            end_index = index
-            try:
-                # If previous data exists, concatenate dataframes
-                weeks[prev_week] = pd.concat([weeks[prev_week], df.iloc[start_index:end_index]])
-            except KeyError:
-                # If no previous data exists, initialize key and concatenate to None object.
-                weeks[prev_week] = None
-                weeks[prev_week] = pd.concat([weeks[prev_week], df.iloc[start_index:end_index]])
-            start_index = end_index
-        
-        prev_week = week
-    
-    return weeks
+    indices = bin_indices(df, 'week')
+    return {int(week): df.iloc[indices[week]] for week in indices}
 
 
 
@@ -320,17 +915,388 @@ def divide_weeks(df):
 # @returns dictionary with keys for each hour containing all rows of the corresponding hour.
 # {0: hour0, 1: df_hour1, ..., 23: df_hour23}
 def divide_hours(df):
-    
-    hours = {}
-    
-    for hour in range(0, 24):
-        
-        # Get hour string as two character string.
-        hour_str = ''
-        if hour < 10:
-            hour_str = '0' + str(hour)
+    indices = bin_indices(df, 'hour')
+    return {hour: df.iloc[indices.get(hour, [])] for hour in range(0, 24)}
+
+
+
+
+# ========== COMPARISON ==========
+
+# Translating SMHI parameter names to corresponding parameters in LANTMET.
+PARAM_DICT = {'t': 'TM', 'r': 'UM', 'prec1h': 'RR', 'ws': 'FM2'}
+
+
+
+
+# Compare MESAN with LANTMET for every station, parameter and time bin in one pass.
+# Only hours where both values exist are used. Error is MESAN - LANTMET.
+# Example:
+# panel = load_panel(stations, start_date, end_date)
+# table = compare(panel, by=['month', 'hour'])
+# table[(table['Parameter'] == 't') & (table['month'] == 7)]
+# @params panel: dataframe as returned from load_panel or make_panel.
+#         param_dict: optional, dict translating SMHI parameter names to LANTMET parameters.
+#         by: optional, list of time bins, see time_bins. Default ['month', 'hour'].
+#             Empty list for one row per station and parameter.
+#         custom: optional, dict with custom bins, see time_bins.
+# @returns dataframe with one row per station, time bin and parameter and columns
+#          Station, <bins>, Parameter,
+#          n: number of hours compared,
+#          bias: mean error,
+#          mae: mean absolute error,
+#          rmse: root mean square error,
+#          std: standard deviation of error,
+#          ae_std: standard deviation of absolute error,
+#          r: Pearson correlation between MESAN and LANTMET.
+def compare(panel, param_dict=PARAM_DICT, by=None, custom=None):
+    if by is None:
+        by = ['month', 'hour']
+    params = [param for param in param_dict if param in panel.columns and param_dict[param] in panel.columns]
+    for param in param_dict:
+        if param not in params:
+            print('compare() >>> Parameter ' + param + ' or ' + param_dict[param] + ' missing in panel.')
+    if not params:
+        return None
+
+    # Keys of every row: station and time bins.
+    keys = pd.DataFrame({'Station': panel.index.get_level_values('Station')})
+    if by:
+        bins = time_bins(pd.DataFrame({'Timestamp': panel.index.get_level_values('Timestamp')}), by, custom)
+        if bins is None:
+            return None
+        for name in bins.columns:
+            keys[name] = bins[name].to_numpy()
+
+    # Sums needed for all statistics, one block of rows per parameter.
+    sums = []
+    for param in params:
+        x = panel[param].to_numpy(dtype=float)
+        y = panel[param_dict[param]].to_numpy(dtype=float)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        error = np.where(valid, x - y, 0)
+
+        # Correlation does not depend on the mean, so values are centered for numerical stability.
+        if valid.any():
+            x = x - x[valid].mean()
+            y = y - y[valid].mean()
+        x = np.where(valid, x, 0)
+        y = np.where(valid, y, 0)
+
+        block = keys.copy()
+        block['Parameter'] = param
+        block['n'] = valid.astype(np.int64)
+        block['e'] = error
+        block['abs_e'] = np.abs(error)
+        block['e2'] = error**2
+        block['x'] = x
+        block['y'] = y
+        block['x2'] = x**2
+        block['y2'] = y**2
+        block['xy'] = x*y
+        sums.append(block)
+
+    group_keys = list(keys.columns) + ['Parameter']
+    sums = pd.concat(sums, ignore_index=True).groupby(group_keys, sort=True).sum()
+    sums = sums[sums['n'] > 0]
+
+    n = sums['n'].to_numpy(dtype=float)
+    table = pd.DataFrame(index=sums.index)
+    table['n'] = sums['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['bias'] = sums['e'].to_numpy()/n
+        table['mae'] = sums['abs_e'].to_numpy()/n
+        table['rmse'] = np.sqrt(sums['e2'].to_numpy()/n)
+        table['std'] = np.sqrt(np.maximum(sums['e2'].to_numpy()/n - table['bias'].to_numpy()**2, 0))
+        table['ae_std'] = np.sqrt(np.maximum(sums['e2'].to_numpy()/n - table['mae'].to_numpy()**2, 0))
+        cov = n*sums['xy'].to_numpy() - sums['x'].to_numpy()*sums['y'].to_numpy()
+        var_x = n*sums['x2'].to_numpy() - sums['x'].to_numpy()**2
+        var_y = n*sums['y2'].to_numpy() - sums['y'].to_numpy()**2
+        table['r'] = np.where((var_x > 0) & (var_y > 0), cov/np.sqrt(var_x*var_y), np.nan)
+
+    return table.reset_index()
+
+
+
+
+# ========== ONLINE STATISTICS ==========
+# Error statistics as in compare(), but updated one day file at a time so memory
+# use does not grow with the number of days. For every station, parameter, month and
+# hour the moments of MESAN (x) and LANTMET (y) are kept as running means and sums of
+# squared deviations (Welford). Moments of two sets of data can be merged exactly
+# (Chan et al.), and a single observation is merged as a set of one.
+#
+# acc = update_accumulators(stations)    # reads new day files, saves ERROR_STATS.npz
+# table = accumulator_stats(acc)          # same columns as compare(panel)
+
+ACCUMULATOR_FILE = 'ERROR_STATS.npz'
+
+# Moments kept per station. Every field is an array (parameters, 12 months, 24 hours).
+# n: number of hours, mean_x/mean_y: means, m2_x/m2_y: sums of squared deviations,
+# c_xy: sum of co-deviations, mean_ae: mean absolute error.
+ACC_FIELDS = ['n', 'mean_x', 'mean_y', 'm2_x', 'm2_y', 'c_xy', 'mean_ae']
+
+
+
+
+# Create empty accumulators.
+# @params param_dict: optional, dict translating SMHI parameter names to LANTMET parameters.
+# @returns dict {'params': param_dict, 'stations': {stationId: array}, 'processed': {stationId: ranges}}
+#          Station arrays have shape (len(ACC_FIELDS), parameters, 12, 24).
+#          Processed days are kept as ranges of consecutive days, see add_processed.
+def new_accumulators(param_dict=PARAM_DICT):
+    return {'params': dict(param_dict), 'stations': {}, 'processed': {}}
+
+
+
+
+# Merge ranges of days into sorted ranges without overlaps or adjacent ranges.
+# @params ranges: list of [first day, last day] as strings, ex. [['2020-09-01', '2020-09-30']].
+# @returns list of merged ranges.
+def _merge_ranges(ranges):
+    merged = []
+    for first, last in sorted(ranges):
+        if merged:
+            next_day = str(datetime.date.fromisoformat(merged[-1][1]) + datetime.timedelta(days=1))
+            if first <= next_day:
+                merged[-1][1] = max(merged[-1][1], last)
+                continue
+        merged.append([first, last])
+    return merged
+
+
+
+
+# Mark a day of a station as processed. Days are kept as ranges of consecutive days,
+# so the accumulators do not grow with the number of days, only with gaps between them.
+# @params acc: accumulators. Updated in place.
+#         stationId: station id as a string.
+#         day: day as a string, ex. '2020-09-01'.
+# @returns None.
+def add_processed(acc, stationId, day):
+    acc['processed'][stationId] = _merge_ranges(acc['processed'].get(stationId, []) + [[day, day]])
+
+
+
+
+# Check if a day of a station has been processed.
+# @params acc: accumulators.
+#         stationId: station id as a string.
+#         day: day as a string, ex. '2020-09-01'.
+# @returns True if processed.
+def is_processed(acc, stationId, day):
+    ranges = acc['processed'].get(stationId, [])
+    i = bisect.bisect_right(ranges, [day, '9999-12-31']) - 1
+    return i >= 0 and ranges[i][0] <= day <= ranges[i][1]
+
+
+
+
+# Merge moments b into moments a.
+# @params a: array (len(ACC_FIELDS), ...). Updated in place.
+#         b: array with the same shape as a.
+# @returns None.
+def _merge_moments(a, b):
+    n_a, n_b = a[0], b[0]
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(n > 0, n_b/n, 0)
+    dx = b[1] - a[1]
+    dy = b[2] - a[2]
+    a[3] = a[3] + b[3] + dx*dx*n_a*w
+    a[4] = a[4] + b[4] + dy*dy*n_a*w
+    a[5] = a[5] + b[5] + dx*dy*n_a*w
+    a[1] = a[1] + dx*w
+    a[2] = a[2] + dy*w
+    a[6] = a[6] + (b[6] - a[6])*w
+    a[0] = n
+
+
+
+
+# Add one or more days of data for a station to the accumulators.
+# @params acc: accumulators as returned from new_accumulators.
+#         stationId: station id as a string.
+#         df_MESAN: dataframe as returned from read_CSV, with typed=True or not.
+#         df_LANTMET: dataframe as returned from read_CSV. Units should already be converted.
+# @returns None.
+def accumulate(acc, stationId, df_MESAN, df_LANTMET):
+    params = acc['params']
+    if stationId not in acc['stations']:
+        acc['stations'][stationId] = np.zeros((len(ACC_FIELDS), len(params), 12, 24))
+
+    # Rows are matched on Timestamp, so both need the same type.
+    frames = [df_MESAN[df_MESAN['Timestamp'].notna()], df_LANTMET[df_LANTMET['Timestamp'].notna()]]
+    if any(pd.api.types.is_datetime64_any_dtype(f['Timestamp']) for f in frames):
+        frames = [f.assign(Timestamp=parse_timestamps(f).to_numpy()) for f in frames]
+    df = frames[0].drop_duplicates('Timestamp', keep='last').merge(
+         frames[1].drop_duplicates('Timestamp', keep='last'), on='Timestamp', suffixes=('', '_LANTMET'))
+    if len(df) == 0:
+        return
+    bins = time_bins(df, ['month', 'hour', 'date'], {'date': lambda t: t.normalize()})
+    month = bins['month'].to_numpy() - 1
+    hour = bins['hour'].to_numpy()
+
+    # Every row is merged as a set of one observation. Rows of the same month and hour
+    # (several days) are merged one day at a time.
+    day = bins['date'].to_numpy()
+    for current_day in pd.unique(day):
+        rows = day == current_day
+        batch = np.zeros((len(ACC_FIELDS), len(params), 12, 24))
+        for k, param in enumerate(params):
+            ref = params[param] if params[param] != param else param + '_LANTMET'
+            if param not in df.columns or ref not in df.columns:
+                continue
+            x = df[param].to_numpy(dtype=float)[rows]
+            y = df[ref].to_numpy(dtype=float)[rows]
+            valid = ~(np.isnan(x) | np.isnan(y))
+            m, h = month[rows][valid], hour[rows][valid]
+            batch[0, k, m, h] = 1
+            batch[1, k, m, h] = x[valid]
+            batch[2, k, m, h] = y[valid]
+            batch[6, k, m, h] = np.abs(x[valid] - y[valid])
+        _merge_moments(acc['stations'][stationId], batch)
+
+
+
+
+# Merge two accumulators, ex. computed on different stations or periods.
+# Days processed in both are counted twice.
+# @params a: accumulators. Updated in place.
+#         b: accumulators with the same parameters as a.
+# @returns a.
+def merge_accumulators(a, b):
+    if a['params'] != b['params']:
+        print('merge_accumulators() >>> Accumulators have different parameters.')
+        return None
+    for stationId in b['stations']:
+        if stationId in a['stations']:
+            _merge_moments(a['stations'][stationId], b['stations'][stationId])
         else:
-            hour_str = str(hour)
-        hours[hour] = df[df['Timestamp'].str.contains('T' + hour_str)]
-        
-    return hours
+            a['stations'][stationId] = b['stations'][stationId].copy()
+    for stationId in b['processed']:
+        a['processed'][stationId] = _merge_ranges(a['processed'].get(stationId, []) + b['processed'][stationId])
+    return a
+
+
+
+
+# Save accumulators to a .npz file. The file is replaced only when completely written.
+# @params acc: accumulators.
+#         filename: optional, name of file.
+# @returns None.
+def save_accumulators(acc, filename=ACCUMULATOR_FILE):
+    arrays = {'params': np.array([[k, v] for k, v in acc['params'].items()], dtype=str),
+              'processed': np.array([[stationId, first, last] for stationId in sorted(acc['processed'])
+                                     for first, last in acc['processed'][stationId]], dtype=str).reshape(-1, 3)}
+    for stationId in acc['stations']:
+        arrays['station_' + stationId] = acc['stations'][stationId]
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename + '.tmp', filename)
+
+
+
+
+# Load accumulators saved with save_accumulators.
+# @params filename: optional, name of file.
+# @returns accumulators.
+def load_accumulators(filename=ACCUMULATOR_FILE):
+    with np.load(filename) as f:
+        acc = {'params': {k: v for k, v in f['params'].tolist()},
+               'stations': {},
+               'processed': {}}
+        processed = f['processed']
+        if processed.ndim == 1:
+            # Older files list every day as 'stationId/YYYY-MM-DD'.
+            processed = [item.split('/') + [item.split('/')[1]] for item in processed.tolist()]
+        for stationId, first, last in np.asarray(processed, dtype=str).reshape(-1, 3).tolist():
+            acc['processed'].setdefault(stationId, []).append([first, last])
+        for stationId in acc['processed']:
+            acc['processed'][stationId] = _merge_ranges(acc['processed'][stationId])
+        for key in f.files:
+            if key.startswith('station_'):
+                acc['stations'][key[len('station_'):]] = f[key]
+    return acc
+
+
+
+
+# Update accumulators with day files from MESAN_CSV and LANTMET_CSV not processed before.
+# Only one day is read at a time. Accumulators are saved after each station, so an
+# interrupted update can be continued.
+# @params stations: list of station ids as strings.
+#         filename: optional, file accumulators are loaded from and saved to.
+#         param_dict: optional, dict translating SMHI parameter names to LANTMET parameters.
+#                     Must be the same as for saved accumulators.
+#         convert: optional, if True UNIT_CONVERSIONS are applied to LANTMET columns.
+# @returns accumulators. None if saved accumulators have different parameters.
+def update_accumulators(stations, filename=ACCUMULATOR_FILE, param_dict=PARAM_DICT, convert=True):
+    if os.path.isfile(filename):
+        acc = load_accumulators(filename)
+        if acc['params'] != param_dict:
+            print('update_accumulators() >>> ' + filename + ' has different parameters.')
+            return None
+    else:
+        acc = new_accumulators(param_dict)
+
+    for stationId in stations:
+        days = {}
+        for source in [True, False]:
+            station_dir = CSV_DIRS[source] + stationId + '/'
+            if not os.path.isdir(station_dir):
+                days[source] = set()
+                continue
+            days[source] = set([file[len(PREFIXES[source]):-len('.csv')] for file in os.listdir(station_dir)
+                                if file.startswith(PREFIXES[source]) and file.endswith('.csv')])
+        new_days = sorted([day for day in days[True] & days[False] if not is_processed(acc, stationId, day)])
+
+        for day in new_days:
+            df_MESAN = pd.read_csv(CSV_DIRS[True] + stationId + '/' + PREFIXES[True] + day + '.csv', sep=';')
+            df_LANTMET = pd.read_csv(CSV_DIRS[False] + stationId + '/' + PREFIXES[False] + day + '.csv', sep=';')
+            if convert:
+                for col in UNIT_CONVERSIONS:
+                    if col in df_LANTMET.columns:
+                        df_LANTMET[col] = df_LANTMET[col]*UNIT_CONVERSIONS[col]
+            accumulate(acc, stationId, df_MESAN, df_LANTMET)
+            add_processed(acc, stationId, day)
+
+        if new_days:
+            print('update_accumulators() >>> Added ' + str(len(new_days)) + ' days for station ' + stationId + '.')
+            save_accumulators(acc, filename)
+
+    return acc
+
+
+
+
+# Get error statistics from accumulators.
+# @params acc: accumulators.
+# @returns dataframe with the same columns as compare() with by=['month', 'hour'].
+def accumulator_stats(acc):
+    params = list(acc['params'])
+    tables = []
+    for stationId in acc['stations']:
+        n, mean_x, mean_y, m2_x, m2_y, c_xy, mean_ae = acc['stations'][stationId]
+        k, m, h = np.nonzero(n)
+        n, mean_x, mean_y = n[k, m, h], mean_x[k, m, h], mean_y[k, m, h]
+        m2_x, m2_y, c_xy, mean_ae = m2_x[k, m, h], m2_y[k, m, h], c_xy[k, m, h], mean_ae[k, m, h]
+
+        bias = mean_x - mean_y
+        var = np.maximum((m2_x + m2_y - 2*c_xy)/n, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.where((m2_x > 0) & (m2_y > 0), c_xy/np.sqrt(m2_x*m2_y), np.nan)
+        tables.append(pd.DataFrame({'Station': stationId,
+                                    'month': m + 1,
+                                    'hour': h,
+                                    'Parameter': np.array(params, dtype=object)[k],
+                                    'n': n.astype(np.int64),
+                                    'bias': bias,
+                                    'mae': mean_ae,
+                                    'rmse': np.sqrt(var + bias**2),
+                                    'std': np.sqrt(var),
+                                    'ae_std': np.sqrt(np.maximum(var + bias**2 - mean_ae**2, 0)),
+                                    'r': r}))
+    if not tables:
+        return None
+    return pd.concat(tables, ignore_index=True).sort_values(['Station', 'month', 'hour', 'Parameter'], ignore_index=True)